@@ -5,9 +5,7 @@ import json
 from tqdm import tqdm
 from pathlib import Path
 from multiprocessing import Pool
-from nltk.stem.porter import *
-
-stemmer = PorterStemmer()
+from utils.stemming import stem_tokens
 
 
 class Preparer(object):
@@ -34,7 +32,7 @@ class Preparer(object):
 
 
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return stem_tokens(word_list)
 
 
 def stem_text(text):
@@ -1,17 +1,15 @@
+import re
 import spacy
 import subprocess
-from collections import Counter
-from nltk.stem.porter import *
 from nltk.tokenize import wordpunct_tokenize
-from transformers import BertTokenizer
+from transformers import BertTokenizer, BertTokenizerFast
+from utils.stemming import stem_tokens
 
 KP_SEP = ';'
 TITLE_SEP = '[sep]'
 PRESENT_EOS = '[psep]'
 DIGIT = '[digit]'
 
-stemmer = PorterStemmer()
-
 SPECIAL_TOKENS = [KP_SEP, TITLE_SEP, PRESENT_EOS]
 UNUSED_TOKEN_MAP = {
     '[unused0]': PRESENT_EOS,
@@ -20,15 +18,22 @@ UNUSED_TOKEN_MAP = {
 
 
 class SpacyTokenizer(object):
+    """
+    The tokens of the spaCy model. A batch of texts is piped through the tokenizer of the pipeline,
+    batch_size texts at a time, the other components do not change the tokens.
+    """
 
     def __init__(self, **kwargs):
         model = kwargs.get('model', 'en')
-        nlp_kwargs = {'parser': False, 'tagger': False, 'entity': False}
-        self.nlp = spacy.load(model, **nlp_kwargs)
+        self.batch_size = kwargs.get('batch_size', 1000)
+        # only the tokenizer is used
+        self.nlp = spacy.load(model, disable=['tagger', 'parser', 'ner'])
 
     def tokenize(self, text):
-        doc = self.nlp(text)
-        return [token.text for token in doc]
+        return self.tokenize_batch([text])[0]
+
+    def tokenize_batch(self, texts):
+        return [[token.text for token in doc] for doc in self.nlp.tokenizer.pipe(texts, batch_size=self.batch_size)]
 
     @property
     def vocab(self):
@@ -48,21 +53,71 @@ class WhiteSpaceTokenizer(object):
         return None
 
 
+class FastBertTokenizer(object):
+    """
+    The wordpieces of BertTokenizer from the Rust tokenizers library (BertTokenizerFast), a batch of texts
+    is tokenized in one call. DIGIT is an added token, it is never split into '[ digit ]'.
+    """
+
+    def __init__(self, model='bert-base-uncased'):
+        self.tokenizer = BertTokenizerFast.from_pretrained(model)
+        # the wordpiece vocabulary, without the added tokens
+        self._vocab = self.tokenizer.get_vocab()
+        self.tokenizer.add_tokens([DIGIT])
+
+    def tokenize(self, text):
+        return self.tokenize_batch([text])[0]
+
+    def tokenize_batch(self, texts):
+        encodings = self.tokenizer.backend_tokenizer.encode_batch(texts, add_special_tokens=False)
+        return [encoding.tokens for encoding in encodings]
+
+    @property
+    def vocab(self):
+        return self._vocab
+
+
+TOKENIZER_TYPES = ['BertTokenizer', 'BertTokenizerFast', 'SpacyTokenizer', 'WhiteSpace']
+# tokenizers loaded in this process, see get_tokenizer()
+_tokenizers = {}
+
+
+def get_tokenizer(tokenizer_type, spacy_batch_size=1000):
+    """
+    :return: the tokenizer of the type, loaded once per process
+    """
+    if tokenizer_type not in _tokenizers:
+        if tokenizer_type == 'BertTokenizer':
+            _tokenizers[tokenizer_type] = BertTokenizer.from_pretrained('bert-base-uncased')
+        elif tokenizer_type == 'BertTokenizerFast':
+            _tokenizers[tokenizer_type] = FastBertTokenizer('bert-base-uncased')
+        elif tokenizer_type == 'SpacyTokenizer':
+            _tokenizers[tokenizer_type] = SpacyTokenizer(model='en_core_web_sm',
+                                                         batch_size=spacy_batch_size)
+        elif tokenizer_type == 'WhiteSpace':
+            _tokenizers[tokenizer_type] = WhiteSpaceTokenizer()
+        else:
+            raise ValueError('Unknown tokenizer type!')
+    return _tokenizers[tokenizer_type]
+
+
 class MultiprocessingTokenizer(object):
+    """
+    Processes the examples in Pool workers. The tokenizer is not part of the object, every worker loads it
+    once in initializer() and the object sent along with every chunk of examples stays small.
+    """
 
     def __init__(self, args):
         self.args = args
-        if self.args['tokenizer'] == 'BertTokenizer':
-            self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        elif self.args['tokenizer'] == 'SpacyTokenizer':
-            self.tokenizer = SpacyTokenizer(model='en_core_web_sm')
-        elif self.args['tokenizer'] == 'WhiteSpace':
-            self.tokenizer = WhiteSpaceTokenizer()
-        else:
+        if self.args['tokenizer'] not in TOKENIZER_TYPES:
             raise ValueError('Unknown tokenizer type!')
 
     def initializer(self):
-        pass
+        get_tokenizer(self.args['tokenizer'], self.args.get('spacy_batch_size', 1000))
+
+    @property
+    def tokenizer(self):
+        return get_tokenizer(self.args['tokenizer'], self.args.get('spacy_batch_size', 1000))
 
     @property
     def vocab(self):
@@ -72,7 +127,15 @@ class MultiprocessingTokenizer(object):
         tokens = self.tokenizer.tokenize(text)
         return ' '.join(tokens)
 
-    def process(self, example):
+    def tokenize_batch(self, texts):
+        if hasattr(self.tokenizer, 'tokenize_batch'):
+            return [' '.join(tokens) for tokens in self.tokenizer.tokenize_batch(texts)]
+        return [self.tokenize(text) for text in texts]
+
+    def prepare(self, example):
+        """
+        :return: the lowercased title, abstract, present and absent keyphrases of the example, before tokenization
+        """
         title = example['title'].strip().lower()
         abstract = example['abstract'].strip().lower()
 
@@ -80,7 +143,7 @@ class MultiprocessingTokenizer(object):
             keywords = example['keyword'].lower().split(self.args['kp_separator'])
             keywords = [kp.strip() for kp in keywords]
             present_keywords, absent_keywords = separate_present_absent(
-                title + ' ' + abstract, keywords
+                title + ' ' + abstract, keywords, substring_match=self.args.get('substring_match', False)
             )
         else:
             present_keywords = example['present_keywords']
@@ -98,48 +161,70 @@ class MultiprocessingTokenizer(object):
             absent_keywords = [fn_replace_digits(akp, tokenizer=self.args['replace_digit_tokenizer'])
                                for akp in absent_keywords]
 
-        title_tokenized = self.tokenize(title)
-        abstract_tokenized = self.tokenize(abstract)
-        pkp_tokenized = [self.tokenize(pkp) for pkp in present_keywords]
-        akp_tokenized = [self.tokenize(akp) for akp in absent_keywords]
-
-        # TODO: how can we add [digit] as never_split token in BertTokenizer?
-        title_tokenized = title_tokenized.replace('[ digit ]', DIGIT)
-        abstract_tokenized = abstract_tokenized.replace('[ digit ]', DIGIT)
-        pkp_tokenized = [pkp.replace('[ digit ]', DIGIT) for pkp in pkp_tokenized]
-        akp_tokenized = [akp.replace('[ digit ]', DIGIT) for akp in akp_tokenized]
-
-        return {
-            'id': example['id'],
-            'title': {
-                'text': title,
-                'tokenized': title_tokenized
-            },
-            'abstract': {
-                'text': abstract,
-                'tokenized': abstract_tokenized
-            },
-            'present_kps': {
-                'text': present_keywords,
-                'tokenized': pkp_tokenized
-            },
-            'absent_kps': {
-                'text': absent_keywords,
-                'tokenized': akp_tokenized
-            }
-        }
-
-
-def create_vocab(dataset):
-    vocabulary = Counter()
-    for ex in dataset:
-        vocabulary.update(ex['title']['tokenized'].split())
-        vocabulary.update(ex['abstract']['tokenized'].split())
-        pkp_tokens = [kp.split() for kp in ex['present_kps']['tokenized']]
-        akp_tokens = [kp.split() for kp in ex['absent_kps']['tokenized']]
-        kp_tokens = [token for kp in pkp_tokens + akp_tokens for token in kp]
-        vocabulary.update(kp_tokens)
+        return title, abstract, present_keywords, absent_keywords
+
+    def process(self, example):
+        return self.process_batch([example])[0]
+
+    def process_batch(self, examples):
+        """
+        Process a list of examples, the texts of all the examples are tokenized in a single batch
+        """
+        prepared = [self.prepare(example) for example in examples]
+        texts = []
+        for title, abstract, present_keywords, absent_keywords in prepared:
+            texts += [title, abstract] + present_keywords + absent_keywords
+        # BertTokenizer splits [digit] into '[ digit ]'
+        tokenized = [text.replace('[ digit ]', DIGIT) for text in self.tokenize_batch(texts)]
+
+        processed = []
+        offset = 0
+        for example, (title, abstract, present_keywords, absent_keywords) in zip(examples, prepared):
+            title_tokenized, abstract_tokenized = tokenized[offset], tokenized[offset + 1]
+            offset += 2
+            pkp_tokenized = tokenized[offset:offset + len(present_keywords)]
+            offset += len(present_keywords)
+            akp_tokenized = tokenized[offset:offset + len(absent_keywords)]
+            offset += len(absent_keywords)
+            processed.append({
+                'id': example['id'],
+                'title': {
+                    'text': title,
+                    'tokenized': title_tokenized
+                },
+                'abstract': {
+                    'text': abstract,
+                    'tokenized': abstract_tokenized
+                },
+                'present_kps': {
+                    'text': present_keywords,
+                    'tokenized': pkp_tokenized
+                },
+                'absent_kps': {
+                    'text': absent_keywords,
+                    'tokenized': akp_tokenized
+                }
+            })
+        return processed
+
+
+def update_vocab(vocabulary, ex):
+    """
+    Add the token counts of a processed example to vocabulary, a Counter
+    """
+    vocabulary.update(ex['title']['tokenized'].split())
+    vocabulary.update(ex['abstract']['tokenized'].split())
+    pkp_tokens = [kp.split() for kp in ex['present_kps']['tokenized']]
+    akp_tokens = [kp.split() for kp in ex['absent_kps']['tokenized']]
+    kp_tokens = [token for kp in pkp_tokens + akp_tokens for token in kp]
+    vocabulary.update(kp_tokens)
+
 
+def get_vocab_items(vocabulary):
+    """
+    :param vocabulary: Counter of the tokens, see update_vocab()
+    :return: list of tokens, the special tokens first and then by decreasing frequency
+    """
     vocab_items = list()
     for (token, freq) in vocabulary.most_common():
         vocab_items.append(token)
@@ -163,7 +248,7 @@ def count_file_lines(file_path):
 
 
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return stem_tokens(word_list)
 
 
 def stem_text(text):
@@ -182,13 +267,40 @@ def fn_replace_digits(text, tokenizer='wordpunct'):
     return ' '.join(out_tokens)
 
 
-def separate_present_absent(source_text, keyphrases):
+def separate_present_absent(source_text, keyphrases, substring_match=False):
+    """
+    Split the keyphrases into those present in the source text and the absent ones, after stemming.
+    A keyphrase is present if its stemmed tokens are a contiguous sequence of the stemmed source tokens,
+    looked up in the set of the source n-grams starting with the first token of a keyphrase.
+    :param substring_match: the former test, the stemmed keyphrase is a substring of the stemmed source,
+        which also matches inside words (e.g. 'net' in 'network')
+    """
     present_kps = []
     absent_kps = []
-    stemmed_source = stem_text(source_text)
-    for kp in keyphrases:
-        stemmed_kp = stem_text(kp)
-        if stemmed_kp in stemmed_source:
+    if substring_match:
+        stemmed_source = stem_text(source_text)
+        for kp in keyphrases:
+            stemmed_kp = stem_text(kp)
+            if stemmed_kp in stemmed_source:
+                present_kps.append(kp)
+            else:
+                absent_kps.append(kp)
+        return present_kps, absent_kps
+
+    stemmed_source_tokens = stem_word_list(source_text.split())
+    stemmed_kps = [tuple(stem_word_list(kp.split())) for kp in keyphrases]
+    # first token -> lengths of the keyphrases starting with it
+    kp_lengths = {}
+    for stemmed_kp in stemmed_kps:
+        if stemmed_kp:
+            kp_lengths.setdefault(stemmed_kp[0], set()).add(len(stemmed_kp))
+    source_ngrams = set()
+    for i, token in enumerate(stemmed_source_tokens):
+        for n in kp_lengths.get(token, ()):
+            source_ngrams.add(tuple(stemmed_source_tokens[i:i + n]))
+    for kp, stemmed_kp in zip(keyphrases, stemmed_kps):
+        # an empty keyphrase is present, as it is a substring of any text
+        if not stemmed_kp or stemmed_kp in source_ngrams:
             present_kps.append(kp)
         else:
             absent_kps.append(kp)
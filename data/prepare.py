@@ -1,21 +1,29 @@
 import os
 import argparse
+import contextlib
+import itertools
 import json
 
 from tqdm import tqdm
 from pathlib import Path
+from collections import Counter
 from multiprocessing import Pool
 from data.prep_util import *
+from utils.pool_util import imap_bounded
 
 
-def load_data(filename, dataset_name):
-    data = []
+def iter_data(filename, dataset_name):
+    """
+    Read the examples of a split one at a time
+    :param filename: (source, target) files of KP20k and the cross-domain datasets, a jsonl file otherwise
+    """
+    num_examples = 0
     # for KP20k and cross-domain datasets
     if dataset_name in ['KP20k', 'inspec', 'krapivin', 'semeval', 'nus']:
         if not os.path.exists(filename[0]):
-            return []
+            return
         with open(filename[0]) as f1, open(filename[1]) as f2:
-            for source, target in tqdm(zip(f1, f2), total=count_file_lines(filename[0])):
+            for source, target in zip(f1, f2):
                 source = source.strip()
                 target = target.strip()
                 if not source:
@@ -36,19 +44,20 @@ def load_data(filename, dataset_name):
                 present_keywords = [kp.strip() for kp in keywords[0].split(';') if kp]
                 absent_keywords = [kp.strip() for kp in keywords[1].split(';') if kp]
                 ex = {
-                    'id': len(data),
+                    'id': num_examples,
                     'title': title,
                     'abstract': abstract,
                     'present_keywords': present_keywords,
                     'absent_keywords': absent_keywords
                 }
-                data.append(ex)
+                num_examples += 1
+                yield ex
         print('Dataset loaded from %s and %s.' % (filename[0], filename[1]))
     else:
         if not os.path.exists(filename):
-            return []
+            return
         with open(filename) as f:
-            for line in tqdm(f, total=count_file_lines(filename)):
+            for line in f:
                 ex = json.loads(line)
                 if dataset_name == 'StackEx':
                     ex = {
@@ -70,135 +79,226 @@ def load_data(filename, dataset_name):
                     }
                 else:
                     if 'id' not in ex:
-                        ex['id'] = len(data)
+                        ex['id'] = num_examples
                     if 'keywords' in ex:
                         ex['keyword'] = ex['keywords']
                         ex.pop('keywords')
 
-                data.append(ex)
+                num_examples += 1
+                yield ex
         print('Dataset loaded from %s.' % filename)
-    return data
-
-
-def main(config, TOK):
-    pool = Pool(config.workers, initializer=TOK.initializer)
-
-    train_dataset = []
-    dataset = load_data(config.train, config.dataset)
-    if dataset:
-        with tqdm(total=len(dataset), desc='Processing') as pbar:
-            for i, ex in enumerate(pool.imap(TOK.process, dataset, 100)):
-                pbar.update()
-                train_dataset.append(ex)
-        with open(os.path.join(config.out_dir, 'train.json'), 'w', encoding='utf-8') as fw:
-            fw.write('\n'.join([json.dumps(ex) for ex in train_dataset]))
-
-    valid_dataset = []
-    dataset = load_data(config.valid, config.dataset)
-    if dataset:
-        with tqdm(total=len(dataset), desc='Processing') as pbar:
-            for i, ex in enumerate(pool.imap(TOK.process, dataset, 100)):
-                pbar.update()
-                valid_dataset.append(ex)
-        with open(os.path.join(config.out_dir, 'valid.json'), 'w', encoding='utf-8') as fw:
-            fw.write('\n'.join([json.dumps(ex) for ex in valid_dataset]))
-
-    test_dataset = []
-    dataset = load_data(config.test, config.dataset)
-    if dataset:
-        with tqdm(total=len(dataset), desc='Processing') as pbar:
-            for i, ex in enumerate(pool.imap(TOK.process, dataset, 100)):
-                pbar.update()
-                test_dataset.append(ex)
-        with open(os.path.join(config.out_dir, 'test.json'), 'w', encoding='utf-8') as fw:
-            fw.write('\n'.join([json.dumps(ex) for ex in test_dataset]))
-
-    if config.form_vocab:
-        if config.tokenizer == 'BertTokenizer':
-            with open(os.path.join(config.out_dir, 'vocab.txt'), 'w') as fw:
-                for token, index in TOK.vocab.items():
-                    if token in UNUSED_TOKEN_MAP:
-                        if UNUSED_TOKEN_MAP[token] not in TOK.vocab:
-                            token = UNUSED_TOKEN_MAP[token]
-                    fw.write('{} {}'.format(token.lower(), index) + '\n')
-        else:
-            vocab = create_vocab(train_dataset + valid_dataset + test_dataset)
-            with open(os.path.join(config.out_dir, 'vocab.txt'), 'w', encoding='utf-8') as fw:
-                fw.write('\n'.join(['{} {}'.format(v, i) for i, v in enumerate(vocab)]))
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='prepare.py',
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-data_dir', required=True,
-                        help='Directory where the source files are located')
-    parser.add_argument('-out_dir', required=True,
-                        help='Directory where the output files will be saved')
-    parser.add_argument('-tokenizer', default='BertTokenizer',
-                        choices=['BertTokenizer', 'SpacyTokenizer', 'WhiteSpace'])
-    parser.add_argument('-dataset', required=True)
-    parser.add_argument('-workers', type=int, default=20)
+class Split(object):
+    """
+    One split of a dataset to process: its input file(s), the output file and the tokenizer with the options
+    of the dataset
+    """
 
-    opt = parser.parse_args()
-    opt.form_vocab = True
+    def __init__(self, config, name, filename, TOK, vocabulary=None):
+        self.config = config
+        self.name = name
+        self.filename = filename
+        self.out_file = os.path.join(config.out_dir, '{}.json'.format(name))
+        self.TOK = TOK
+        # if given, a Counter the tokens of the processed examples are counted in
+        self.vocabulary = vocabulary
+
+    @property
+    def source_file(self):
+        return self.filename[0] if isinstance(self.filename, tuple) else self.filename
+
+
+def iter_tasks(splits, chunk_size):
+    """
+    :return: generator of (split index, tokenizer, examples), a task per chunk_size examples of every split in turn
+    """
+    for split_idx, split in enumerate(splits):
+        examples = iter_data(split.filename, split.config.dataset)
+        chunk = list(itertools.islice(examples, chunk_size))
+        while chunk:
+            yield split_idx, split.TOK, chunk
+            chunk = list(itertools.islice(examples, chunk_size))
+
+
+def process_task(task):
+    """
+    :return: (split index, processed examples) of a task of iter_tasks(), the split itself stays in the
+             main process with its vocabulary
+    """
+    split_idx, TOK, examples = task
+    return split_idx, TOK.process_batch(examples)
+
+
+def process_splits(pool, splits, chunk_size, max_pending_tasks):
+    """
+    Tokenize the examples of all the splits in the pool, the next split is read while the last chunks of the
+    previous one are being processed. Every processed example is written to the out_file of its split as
+    soon as it is ready, one json per line without a newline after the last one. Nothing is written for a
+    split without examples.
+    """
+    splits = [split for split in splits if os.path.exists(split.source_file)]
+    total = sum(count_file_lines(split.source_file) for split in splits)
+    with contextlib.ExitStack() as stack:
+        pbar = stack.enter_context(tqdm(total=total, desc='Processing'))
+        split, fw = None, None
+        for split_idx, examples in imap_bounded(pool, process_task, iter_tasks(splits, chunk_size),
+                                                max_pending_tasks):
+            task_split = splits[split_idx]
+            if task_split is not split:
+                if fw is not None:
+                    fw.close()
+                split, fw = task_split, open(task_split.out_file, 'w', encoding='utf-8')
+                stack.callback(fw.close)
+                separator = ''
+            for ex in examples:
+                fw.write(separator)
+                fw.write(json.dumps(ex))
+                separator = '\n'
+                if split.vocabulary is not None:
+                    update_vocab(split.vocabulary, ex)
+            pbar.update(len(examples))
+
+
+def write_vocab(config, TOK, vocabulary):
+    if config.tokenizer in ['BertTokenizer', 'BertTokenizerFast']:
+        with open(os.path.join(config.out_dir, 'vocab.txt'), 'w') as fw:
+            for token, index in sorted(TOK.vocab.items(), key=lambda item: item[1]):
+                if token in UNUSED_TOKEN_MAP:
+                    if UNUSED_TOKEN_MAP[token] not in TOK.vocab:
+                        token = UNUSED_TOKEN_MAP[token]
+                fw.write('{} {}'.format(token.lower(), index) + '\n')
+    else:
+        vocab = get_vocab_items(vocabulary)
+        with open(os.path.join(config.out_dir, 'vocab.txt'), 'w', encoding='utf-8') as fw:
+            fw.write('\n'.join(['{} {}'.format(v, i) for i, v in enumerate(vocab)]))
 
-    if not os.path.exists(opt.data_dir):
-        raise FileNotFoundError
 
-    Path(opt.out_dir).mkdir(parents=True, exist_ok=True)
+def main(datasets, workers, chunk_size=100):
+    """
+    Process the train, valid and test splits of all the datasets in one pool, the workers and their
+    tokenizer are started once
+    :param datasets: list of (config, TOK), see get_dataset_config(); the datasets use the same tokenizer
+    """
+    splits = []
+    vocabularies = []
+    for config, TOK in datasets:
+        # the vocabulary of BertTokenizer is its wordpiece vocabulary, others count the tokens of all splits
+        vocabulary = None
+        if config.form_vocab and config.tokenizer not in ['BertTokenizer', 'BertTokenizerFast']:
+            vocabulary = Counter()
+        vocabularies.append(vocabulary)
+        for name, filename in [('train', config.train), ('valid', config.valid), ('test', config.test)]:
+            splits.append(Split(config, name, filename, TOK, vocabulary))
+
+    with Pool(workers, initializer=datasets[0][1].initializer) as pool:
+        # bounded, the examples waiting for a worker are at most two chunks per worker
+        process_splits(pool, splits, chunk_size, 2 * workers)
+
+    for (config, TOK), vocabulary in zip(datasets, vocabularies):
+        if config.form_vocab:
+            write_vocab(config, TOK, vocabulary)
+
+
+def get_dataset_config(opt, dataset):
+    """
+    :param opt: the command line options, -out_dir may contain {dataset}
+    :return: the options of the dataset with its split files, the options of its MultiprocessingTokenizer
+    """
+    config = argparse.Namespace(**vars(opt))
+    config.dataset = dataset
+    config.out_dir = opt.out_dir.format(dataset=dataset)
+    config.form_vocab = True
 
     options = dict()
-    options['tokenizer'] = opt.tokenizer
+    options['tokenizer'] = config.tokenizer
+    options['spacy_batch_size'] = config.spacy_batch_size
+    options['substring_match'] = config.substring_match
     options['replace_digit_tokenizer'] = 'wordpunct'
     options['kp_separator'] = ';'
 
-    if opt.dataset == 'KPTimes':
-        opt.train = os.path.join(opt.data_dir, 'KPTimes.train.jsonl')
-        opt.valid = os.path.join(opt.data_dir, 'KPTimes.valid.jsonl')
-        opt.test = os.path.join(opt.data_dir, 'KPTimes.test.jsonl')
+    if config.dataset == 'KPTimes':
+        config.train = os.path.join(config.data_dir, 'KPTimes.train.jsonl')
+        config.valid = os.path.join(config.data_dir, 'KPTimes.valid.jsonl')
+        config.test = os.path.join(config.data_dir, 'KPTimes.test.jsonl')
 
-    if opt.dataset == 'OAGK':
+    if config.dataset == 'OAGK':
         options['kp_separator'] = ','
-        opt.train = os.path.join(opt.data_dir, 'oagk_train.txt')
-        opt.valid = os.path.join(opt.data_dir, 'oagk_val.txt')
-        opt.test = os.path.join(opt.data_dir, 'oagk_test.txt')
+        config.train = os.path.join(config.data_dir, 'oagk_train.txt')
+        config.valid = os.path.join(config.data_dir, 'oagk_val.txt')
+        config.test = os.path.join(config.data_dir, 'oagk_test.txt')
 
-    if opt.dataset == 'KP20k':
+    if config.dataset == 'KP20k':
         options['replace_digit_tokenizer'] = None
         options['kp_separator'] = None
-        opt.train = (os.path.join(opt.data_dir, 'train_src.txt'),
-                     os.path.join(opt.data_dir, 'train_trg.txt'))
-        opt.valid = (os.path.join(opt.data_dir, 'valid_src.txt'),
-                     os.path.join(opt.data_dir, 'valid_trg.txt'))
-        opt.test = (os.path.join(opt.data_dir, 'test_src.txt'),
-                    os.path.join(opt.data_dir, 'test_trg.txt'))
-
-    if opt.dataset in ['inspec', 'krapivin', 'semeval', 'nus']:
+        config.train = (os.path.join(config.data_dir, 'train_src.txt'),
+                        os.path.join(config.data_dir, 'train_trg.txt'))
+        config.valid = (os.path.join(config.data_dir, 'valid_src.txt'),
+                        os.path.join(config.data_dir, 'valid_trg.txt'))
+        config.test = (os.path.join(config.data_dir, 'test_src.txt'),
+                       os.path.join(config.data_dir, 'test_trg.txt'))
+
+    if config.dataset in ['inspec', 'krapivin', 'semeval', 'nus']:
         options['replace_digit_tokenizer'] = None
         options['kp_separator'] = None
-        opt.form_vocab = False
-        opt.train = ('', '')
-        opt.valid = ('', '')
-        opt.test = (
-            os.path.join(opt.data_dir, 'word_{}_testing_context.txt'.format(opt.dataset)),
-            os.path.join(opt.data_dir, 'word_{}_testing_allkeywords.txt'.format(opt.dataset))
+        config.form_vocab = False
+        config.train = ('', '')
+        config.valid = ('', '')
+        config.test = (
+            os.path.join(config.data_dir, 'word_{}_testing_context.txt'.format(config.dataset)),
+            os.path.join(config.data_dir, 'word_{}_testing_allkeywords.txt'.format(config.dataset))
         )
 
-    if opt.dataset == 'StackEx':
-        opt.train = os.path.join(opt.data_dir, 'stackexchange_train.json')
-        opt.valid = os.path.join(opt.data_dir, 'stackexchange_valid.json')
-        opt.test = os.path.join(opt.data_dir, 'stackexchange_test.json')
+    if config.dataset == 'StackEx':
+        config.train = os.path.join(config.data_dir, 'stackexchange_train.json')
+        config.valid = os.path.join(config.data_dir, 'stackexchange_valid.json')
+        config.test = os.path.join(config.data_dir, 'stackexchange_test.json')
 
-    if opt.dataset == 'OpenKP':
+    if config.dataset == 'OpenKP':
         options['kp_separator'] = None
-        opt.train = os.path.join(opt.data_dir, 'OpenKPTrain.jsonl')
-        opt.valid = os.path.join(opt.data_dir, 'OpenKPDev.jsonl')
-        opt.test = os.path.join(opt.data_dir, 'OpenKPEvalPublic.jsonl')
+        config.train = os.path.join(config.data_dir, 'OpenKPTrain.jsonl')
+        config.valid = os.path.join(config.data_dir, 'OpenKPDev.jsonl')
+        config.test = os.path.join(config.data_dir, 'OpenKPEvalPublic.jsonl')
+
+    if config.dataset == 'MSMARCO':
+        config.train = os.path.join(config.data_dir, 'train.json')
+        config.valid = os.path.join(config.data_dir, 'valid.json')
+        config.test = ''
 
-    if opt.dataset == 'MSMARCO':
-        opt.train = os.path.join(opt.data_dir, 'train.json')
-        opt.valid = os.path.join(opt.data_dir, 'valid.json')
-        opt.test = ''
+    return config, options
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prepare.py',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-data_dir', required=True,
+                        help='Directory where the source files are located')
+    parser.add_argument('-out_dir', required=True,
+                        help='Directory where the output files will be saved, '
+                             'with several datasets a pattern with {dataset}, e.g. {dataset}/processed')
+    parser.add_argument('-tokenizer', default='BertTokenizer',
+                        choices=TOKENIZER_TYPES)
+    parser.add_argument('-dataset', required=True, nargs='+',
+                        help='Name of the dataset, several datasets are processed by the same workers')
+    parser.add_argument('-workers', type=int, default=20)
+    parser.add_argument('-chunk_size', type=int, default=100,
+                        help='Number of examples sent to a worker at once, and tokenized in one batch')
+    parser.add_argument('-spacy_batch_size', type=int, default=1000,
+                        help='Number of texts piped through the spaCy tokenizer at once (SpacyTokenizer)')
+    parser.add_argument('-substring_match', action='store_true',
+                        help='Present keyphrases are substrings of the text (former behavior, also matches '
+                             'inside words) instead of token sequences')
+
+    opt = parser.parse_args()
+
+    if not os.path.exists(opt.data_dir):
+        raise FileNotFoundError
+    if len(opt.dataset) > 1 and '{dataset}' not in opt.out_dir:
+        raise ValueError('-out_dir must contain {dataset} to process several datasets')
 
-    TOK = MultiprocessingTokenizer(options)
-    main(opt, TOK)
+    datasets = []
+    for dataset in opt.dataset:
+        config, options = get_dataset_config(opt, dataset)
+        Path(config.out_dir).mkdir(parents=True, exist_ok=True)
+        datasets.append((config, MultiprocessingTokenizer(options)))
+    main(datasets, opt.workers, opt.chunk_size)
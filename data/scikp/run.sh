@@ -40,14 +40,12 @@ if [[ ! -d $OUTDIR ]]; then
         -valid_file kp20k/${OUTDIR}/valid.json \
         -test_file kp20k/${OUTDIR}/test.json
     echo "============Processing Cross-Domain datasets============"
-    for dataset in inspec nus krapivin semeval; do
-        PYTHONPATH=$SRC_DIR python -W ignore ../prepare.py \
-            -dataset $dataset \
-            -data_dir cross_domain_separated \
-            -out_dir ${dataset}/${OUTDIR} \
-            -tokenizer $1 \
-            -workers 60
-    done
+    PYTHONPATH=$SRC_DIR python -W ignore ../prepare.py \
+        -dataset inspec nus krapivin semeval \
+        -data_dir cross_domain_separated \
+        -out_dir "{dataset}/${OUTDIR}" \
+        -tokenizer $1 \
+        -workers 60
 fi
 
 }
@@ -1,20 +1,81 @@
+import os
 import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import itertools
 from tqdm import tqdm
-from fairseq.data.encoders.gpt2_bpe import GPT2BPE
+from multiprocessing import Pool
+from utils.bpe_hypotheses import load_token_bytes, decode_bpe_ids
+from utils.pool_util import imap_bounded
+
+DEFAULT_ENCODER_JSON = 'https://dl.fbaipublicfiles.com/fairseq/gpt2_bpe/encoder.json'
+
+
+def get_encoder_json(encoder_json=None):
+    """
+    :return: local path of encoder_json, by default the encoder.json GPT2BPE(None) downloads
+    """
+    if encoder_json is None or encoder_json.startswith('http'):
+        from fairseq import file_utils
+        return file_utils.cached_path(encoder_json or DEFAULT_ENCODER_JSON)
+    return encoder_json
+
+
+def init_worker(encoder_json):
+    # the id -> bytes table is built once per worker
+    global token_bytes
+    token_bytes = load_token_bytes(encoder_json)
+
+
+def decode_chunk(lines):
+    global token_bytes
+    return [decode_bpe_ids(token_bytes, line.split()) for line in lines]
+
+
+def read_chunks(lines, chunk_size):
+    lines = iter(lines)
+    chunk = list(itertools.islice(lines, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(lines, chunk_size))
+
+
+def decode_lines(lines, encoder_json=None, workers=1, chunk_size=1000):
+    """
+    Decode lines of GPT-2 BPE ids (e.g. fairseq-generate hypotheses) in memory
+    :param lines: an iterable of lines of space separated BPE ids, read lazily
+    :param workers: number of decoding processes, the decoded lines are yielded in order and at most two chunks
+                    per worker are read ahead of them
+    :return: a generator of the decoded strings
+    """
+    encoder_json = get_encoder_json(encoder_json)
+    if workers <= 1:
+        init_worker(encoder_json)
+        for chunk in read_chunks(lines, chunk_size):
+            yield from decode_chunk(chunk)
+        return
+    with Pool(workers, initializer=init_worker, initargs=(encoder_json,)) as pool:
+        for decoded_chunk in imap_bounded(pool, decode_chunk, read_chunks(lines, chunk_size), 2 * workers):
+            yield from decoded_chunk
 
 
-def decode(in_file, out_file):
-    bpe = GPT2BPE(None)
+def decode(in_file, out_file, encoder_json=None, workers=1, chunk_size=1000):
     with open(in_file) as in_f, open(out_file, 'w') as out_f:
-        for line in tqdm(in_f.readlines()):
-            decoded_string = bpe.decode(line.strip())
+        for decoded_string in tqdm(decode_lines(in_f, encoder_json, workers, chunk_size), unit=' lines'):
             out_f.write(decoded_string)
             out_f.write('\n')
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python fairseq_gpt2_decode.py in_file_name out_file_name")
-        exit()
+    parser = argparse.ArgumentParser(description='Decode GPT-2 BPE ids to text, one line at a time')
+    parser.add_argument('in_file', type=str, help="File of space separated BPE ids")
+    parser.add_argument('out_file', type=str, help="Path of the decoded file")
+    parser.add_argument('--encoder_json', type=str, default=None,
+                        help="Path of the GPT-2 encoder.json, the one of fairseq's GPT2BPE by default")
+    parser.add_argument('--workers', type=int, default=1, help="Number of decoding processes")
+    parser.add_argument('--chunk_size', type=int, default=1000, help="Number of lines decoded by a worker at once")
+    args = parser.parse_args()
 
-    decode(sys.argv[1], sys.argv[2])
+    decode(args.in_file, args.out_file, args.encoder_json, args.workers, args.chunk_size)
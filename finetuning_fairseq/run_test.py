@@ -0,0 +1,291 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glob
+import json
+import hashlib
+import argparse
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.evaluate import Evaluator, load_references
+from utils.evaluate_runs import write_comparison_table
+from utils.generate_stream import score_generation_stream
+
+HOME_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# benchmark name given to run_test.sh -> (directory under the data root, evaluation datasets)
+BENCHMARKS = {
+    'kp20k': ('scikp', ['kp20k', 'inspec', 'krapivin', 'nus', 'semeval']),
+    'kptimes': ('', ['kptimes']),
+}
+GENERATE_ARGS = ['--task', 'translation', '--batch-size', '64', '--beam', '1', '--no-repeat-ngram-size', '0',
+                 '--max-len-b', '60']
+STATE_FILE = 'run_test_state.json'
+
+
+class StageState(object):
+    """
+    Checksums of the inputs and outputs of every stage that ran, kept in {save_dir}/run_test_state.json.
+    A stage is up to date when its inputs and configuration hash to the recorded value and its outputs still
+    have the recorded checksums. File checksums are cached by size and modification time, so the checkpoint
+    is hashed once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages, self.files = {}, {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.stages, self.files = state['stages'], state['files']
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def inputs_hash(self, input_files, config):
+        sha1 = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8'))
+        for path in input_files:
+            sha1.update('{}\0{}\0'.format(os.path.abspath(path), self.file_hash(path)).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def is_up_to_date(self, key, input_files, config, output_files):
+        recorded = self.stages.get(key)
+        if recorded is None or recorded['inputs'] != self.inputs_hash(input_files, config):
+            return False
+        return all(os.path.exists(path) and self.file_hash(path) == recorded['outputs'].get(path)
+                   for path in output_files)
+
+    def record(self, key, input_files, config, output_files):
+        self.stages[key] = {'inputs': self.inputs_hash(input_files, config),
+                            'outputs': {path: self.file_hash(path) for path in output_files}}
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fw:
+            json.dump({'stages': self.stages, 'files': self.files}, fw, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class Stage(object):
+    """
+    One step of the test pipeline of a dataset: its input and output files, the configuration it depends on,
+    and the function computing the outputs
+    """
+
+    def __init__(self, name, dataset, input_files, output_files, config, function, args):
+        self.name = name
+        self.dataset = dataset
+        self.input_files = input_files
+        self.output_files = output_files
+        self.config = config
+        self.function = function
+        self.args = args
+
+    @property
+    def key(self):
+        return '{}/{}'.format(self.dataset, self.name)
+
+
+def get_hypothesis_parser(encoder_json=None):
+    if encoder_json is None:
+        return None
+    from utils.bpe_hypotheses import BPEHypothesisParser
+    return BPEHypothesisParser(encoder_json)
+
+
+def generate(data_dir, checkpoint, out_file, hyp_file, src_dir, results_file, prediction_file, metrics_json,
+             k_list, encoder_json=None, ranking=False, gpu=None):
+    """
+    Run fairseq-generate and score every document as soon as its hypothesis is printed (see generate_stream.py).
+    The fairseq-generate output is saved to out_file, the hypotheses in document order to hyp_file (what `tee`,
+    `grep ^H | sort -V | cut -f3-` did), and the evaluation outputs are the same as those of evaluate()
+    """
+    env = dict(os.environ)
+    if gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    parse_hypothesis = get_hypothesis_parser(encoder_json)
+    process = subprocess.Popen(['fairseq-generate', data_dir, '--path', checkpoint] + GENERATE_ARGS,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, encoding='utf-8')
+    with Evaluator(k_list, ranking=ranking) as evaluator:
+        # the references are prepared while fairseq-generate loads the model
+        references = load_references(src_dir)
+        accumulator = evaluator.new_accumulator(total=len(references))
+        missing_documents = None
+        try:
+            score_generation_stream(process.stdout, references, accumulator, parse_hypothesis, out_file, hyp_file,
+                                    prediction_file, disable_progress_bar=True)
+        except ValueError as e:
+            missing_documents = e
+        if process.wait() != 0:
+            raise RuntimeError('fairseq-generate failed on {}, see {}'.format(data_dir, out_file))
+        if missing_documents is not None:
+            raise missing_documents
+        metrics = evaluator.report(accumulator, results_file, description={'hyp_file': hyp_file})
+    with open(metrics_json, 'w') as fw:
+        json.dump(metrics, fw, indent=2)
+    return metrics
+
+
+def text_decode(hyp_file, decoded_file, encoder_json=None):
+    from fairseq_gpt2_decode import decode
+    decode(hyp_file, decoded_file, encoder_json)
+
+
+def evaluate(src_dir, hyp_file, results_file, prediction_file, metrics_json, k_list, encoder_json=None,
+             ranking=False):
+    """
+    Score the BPE id hypotheses of one dataset and save the reported metrics to metrics_json for the table
+    """
+    with Evaluator(k_list, ranking=ranking) as evaluator, open(hyp_file) as f:
+        metrics = evaluator.evaluate_hypotheses(load_references(src_dir), f, results_file, prediction_file,
+                                                disable_progress_bar=True, description={'hyp_file': hyp_file},
+                                                parse_hypothesis=get_hypothesis_parser(encoder_json))
+    with open(metrics_json, 'w') as fw:
+        json.dump(metrics, fw, indent=2)
+    return metrics
+
+
+def get_dataset_stages(dataset, data_dir_prefix, args):
+    """
+    :return: the GPU stage (generation, which also evaluates), the evaluation stage, run on its own when only
+             the evaluation is out of date, and the text decoding stage
+    """
+    src_dir = os.path.join(data_dir_prefix, dataset, 'fairseq')
+    data_dir = os.path.join(src_dir, 'gpt2_bpe', 'binary')
+    checkpoint = os.path.join(args.save_dir, 'checkpoint_best.pt')
+    prefix = os.path.join(args.save_dir, dataset)
+    out_file = prefix + '_out.txt'
+    # the BPE ids printed by fairseq-generate, and the text they decode to
+    raw_hyp_file, hyp_file = prefix + '_hypotheses_raw.txt', prefix + '_hypotheses.txt'
+    results_file = os.path.join(args.save_dir, 'results_log_{}.txt'.format(dataset))
+    prediction_file, metrics_json = prefix + '_predictions.txt', prefix + '_metrics.json'
+    k_list = [str(topk) for topk in args.k_list]
+
+    generate_stage = Stage('generate', dataset,
+                           [checkpoint] + sorted(glob.glob(os.path.join(data_dir, 'test.*')) +
+                                                 glob.glob(os.path.join(data_dir, 'dict.*'))),
+                           [out_file, raw_hyp_file], {'generate_args': GENERATE_ARGS},
+                           generate, (data_dir, checkpoint, out_file, raw_hyp_file, src_dir, results_file,
+                                      prediction_file, metrics_json, k_list, args.bpe_encoder_json,
+                                      args.ranking_metrics, args.gpu))
+    evaluate_stage = Stage('evaluate', dataset,
+                           [raw_hyp_file, os.path.join(src_dir, 'test.source'), os.path.join(src_dir, 'test.target'),
+                            args.bpe_encoder_json],
+                           [results_file, prediction_file, metrics_json],
+                           {'k_list': k_list, 'ranking': args.ranking_metrics},
+                           evaluate, (src_dir, raw_hyp_file, results_file, prediction_file, metrics_json, k_list,
+                                      args.bpe_encoder_json, args.ranking_metrics))
+    decode_stage = Stage('text_decode', dataset, [raw_hyp_file, args.bpe_encoder_json], [hyp_file], {},
+                         text_decode, (raw_hyp_file, hyp_file, args.bpe_encoder_json))
+    return generate_stage, evaluate_stage, decode_stage
+
+
+def run_pipeline(datasets, data_dir_prefix, args):
+    """
+    Generate the datasets one after another on the GPU, scoring every document as it is generated, while the
+    hypotheses of the datasets generated so far are decoded to text in a pool of args.workers processes.
+    Stages whose outputs are up to date are skipped; the evaluation runs in the pool on the saved hypotheses
+    when only the evaluation is out of date.
+    """
+    state = StageState(os.path.join(args.save_dir, STATE_FILE))
+    pending = deque()
+
+    def is_up_to_date(stage):
+        return not args.force and state.is_up_to_date(stage.key, stage.input_files, stage.config,
+                                                      stage.output_files)
+
+    def record(stage):
+        state.record(stage.key, stage.input_files, stage.config, stage.output_files)
+
+    def finish_oldest():
+        stage, future = pending.popleft()
+        future.result()
+        record(stage)
+        print('[{}] done'.format(stage.key))
+
+    with ProcessPoolExecutor(args.workers) as executor:
+        for dataset in datasets:
+            generate_stage, evaluate_stage, decode_stage = get_dataset_stages(dataset, data_dir_prefix, args)
+            cpu_stages = [decode_stage, evaluate_stage]
+            if is_up_to_date(generate_stage):
+                print('[{}] up to date'.format(generate_stage.key))
+            else:
+                print('[{}] running'.format(generate_stage.key))
+                generate_stage.function(*generate_stage.args)
+                record(generate_stage)
+                # the hypotheses were scored while they were generated
+                record(evaluate_stage)
+                cpu_stages = [decode_stage]
+            for stage in cpu_stages:
+                if is_up_to_date(stage):
+                    print('[{}] up to date'.format(stage.key))
+                    continue
+                # bounded, a slow stage holds back the generation of the next datasets
+                while len(pending) >= 2 * args.workers:
+                    finish_oldest()
+                print('[{}] running'.format(stage.key))
+                pending.append((stage, executor.submit(stage.function, *stage.args)))
+        while pending:
+            finish_oldest()
+
+
+def write_results_table(datasets, save_dir, benchmark):
+    """
+    Write {save_dir}/results_{benchmark}.tsv, one row of metrics per dataset
+    """
+    metrics_list = []
+    for dataset in datasets:
+        with open(os.path.join(save_dir, '{}_metrics.json'.format(dataset))) as f:
+            metrics_list.append(json.load(f))
+    field_list = list(metrics_list[0])
+    out_file = os.path.join(save_dir, 'results_{}.tsv'.format(benchmark))
+    write_comparison_table(out_file, datasets, field_list, [[metrics[f] for f in field_list]
+                                                            for metrics in metrics_list])
+    for dataset, metrics in zip(datasets, metrics_list):
+        print('{}\t{}'.format(dataset, '\t'.join('{}={:.5}'.format(f, v) for f, v in metrics.items()
+                                                 if f.startswith('macro_avg_f1'))))
+    return out_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate and evaluate the test sets of a benchmark')
+    parser.add_argument('--gpu', type=str, default=None, help="GPU id (works best with single GPU)")
+    parser.add_argument('--dataset', type=str, required=True, choices=list(BENCHMARKS),
+                        help="Name of the evaluation benchmark, kp20k evaluates on all five scientific datasets")
+    parser.add_argument('--save_dir', type=str, required=True, help="Directory with checkpoint_best.pt")
+    parser.add_argument('--datasets', nargs='+', default=None, help="Evaluate only these datasets of the benchmark")
+    parser.add_argument('--data_root', type=str, default=os.path.join(HOME_DIR, 'data'),
+                        help="Directory with the prepared datasets, see preprocess.sh")
+    parser.add_argument('--workers', type=int, default=2, help="Number of processes decoding and evaluating")
+    parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values for evaluation')
+    parser.add_argument('--ranking_metrics', action='store_true',
+                        help="Also report the ranking metrics MAP@k, NDCG@k and AlphaNDCG@k")
+    parser.add_argument('--bpe_encoder_json', type=str,
+                        default=os.path.join(HOME_DIR, 'models', 'gpt2_bpe', 'encoder.json'),
+                        help="Path of the GPT-2 encoder.json, see preprocess.sh")
+    parser.add_argument('--force', action='store_true', help="Rerun the stages that are up to date")
+    args = parser.parse_args()
+    # every stage hashes the encoder, fail here rather than in the middle of the pipeline
+    if not os.path.isfile(args.bpe_encoder_json):
+        parser.error('--bpe_encoder_json {} does not exist, run preprocess.sh to download the GPT-2 BPE files to '
+                     'models/gpt2_bpe or pass the path of encoder.json'.format(args.bpe_encoder_json))
+
+    data_subdir, datasets = BENCHMARKS[args.dataset]
+    data_dir_prefix = os.path.join(args.data_root, data_subdir)
+    if args.datasets:
+        datasets = [dataset for dataset in datasets if dataset in args.datasets]
+    run_pipeline(datasets, data_dir_prefix, args)
+    print('Results written to {}'.format(write_results_table(datasets, args.save_dir, args.dataset)))
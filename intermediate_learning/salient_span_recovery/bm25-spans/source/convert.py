@@ -1,14 +1,15 @@
 import os
+import sys
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../..'))
+
 import json
 import argparse
 import subprocess
 from tqdm import tqdm
-from nltk.stem.porter import *
 from nltk.tokenize import wordpunct_tokenize
-
-stemmer = PorterStemmer()
+from utils.stemming import stem_tokens
 
 
 def count_file_lines(file_path):
@@ -23,7 +24,7 @@ def count_file_lines(file_path):
 
 
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return stem_tokens(word_list)
 
 
 def stem_text(text):
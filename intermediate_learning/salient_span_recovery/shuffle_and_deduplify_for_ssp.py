@@ -1,16 +1,23 @@
+import os
 import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
 import random
 from fairseq.data.encoders.gpt2_bpe import GPT2BPE
 from tqdm import tqdm
+from utils.bpe_hypotheses import build_token_bytes, decode_bpe_ids
 
 
 global bpe
 bpe = GPT2BPE(None)
+# decodes a line with one lookup per BPE id
+token_bytes = build_token_bytes(bpe.bpe.encoder)
 
 
 def dedupe_bpe_line(bpe_line):
     global bpe
-    decoded_string = bpe.decode(bpe_line.strip())
+    decoded_string = decode_bpe_ids(token_bytes, bpe_line.split())
     phrases = [x.strip() for x in decoded_string.split(';') if len(x.strip()) > 0]
     phrases_new = []
     for x in phrases:
@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from utils.bpe_hypotheses import bytes_to_unicode
+
+# (source, target, prediction) lines as in test.source, test.target and _hypotheses.txt
+DOCUMENTS = [
+    # '_' joined keyphrases are duplicates of the same words split by ' '
+    ('deep learning for graph networks [sep] we study deep learning of graph_networks .',
+     'deep learning;graph networks;graph_networks',
+     'deep_learning;deep learning;graph networks;graph_networks;learning'),
+    # [unk], ',' and '.' make a prediction invalid, one word predictions are all kept
+    ('a network of networks [sep] the network is learned',
+     'network;networks of networks;absent phrase',
+     '[unk];network;networks;network , learned;learned network .;absent phrase;absent'),
+    # empty and duplicate keyphrases
+    ('title only [sep] ', ';;title;title', ';;title;;title only;title'),
+    # no targets, no predictions
+    ('some text without a title', '', ''),
+    # stemming makes these duplicates, and matches them to the target
+    ('running runners run [sep] they ran', 'running runners;run', 'run runner;running runners;runs;ran'),
+    # '[digit]' is kept as one token, wordpieces are joined
+    ('model [digit] scores [sep] [digit] layers', '[digit] layers;model [ digit ]',
+     '[ digit ] layers;model [digit];sc ##ores'),
+    # more than 200 predictions, only the first 200 are scored
+    ('one two three [sep] four five six', 'two;five six;seven',
+     ';'.join(['w{}'.format(i) for i in range(198)] + ['two', 'five six', 'seven'])),
+]
+
+
+def write_documents(src_dir, documents, hyp_file=None):
+    """
+    Write test.source and test.target of the documents to src_dir, and their predictions to hyp_file
+    """
+    with open(os.path.join(src_dir, 'test.source'), 'w') as fs, open(os.path.join(src_dir, 'test.target'), 'w') as ft:
+        for src_l, trg_l, _ in documents:
+            fs.write(src_l + '\n')
+            ft.write(trg_l + '\n')
+    if hyp_file is not None:
+        with open(hyp_file, 'w') as fw:
+            for _, _, pred_l in documents:
+                fw.write(pred_l + '\n')
+
+
+def make_encoder(merged_tokens):
+    """
+    A GPT-2 style encoder.json: every single byte plus the merged tokens, written with the byte to unicode table
+    """
+    byte_encoder = bytes_to_unicode()
+    tokens = [byte_encoder[b] for b in range(256)]
+    tokens += [''.join(byte_encoder[b] for b in token.encode('utf-8')) for token in merged_tokens]
+    return {token: idx for idx, token in enumerate(tokens)}
+
+
+def encode(encoder, pieces):
+    """
+    The ids of the pieces, a piece that is not a token of the encoder is split into its bytes
+    """
+    byte_encoder = bytes_to_unicode()
+    ids = []
+    for piece in pieces:
+        token = ''.join(byte_encoder[b] for b in piece.encode('utf-8'))
+        ids += [encoder[token]] if token in encoder else [encoder[c] for c in token]
+    return ' '.join(str(idx) for idx in ids)
+
+
+@pytest.fixture
+def documents():
+    return list(DOCUMENTS)
+
+
+@pytest.fixture
+def src_dir(tmp_path):
+    """
+    A directory with the test.source and test.target of DOCUMENTS, and their predictions in hypotheses.txt
+    """
+    src_dir = tmp_path / 'data'
+    src_dir.mkdir()
+    write_documents(str(src_dir), DOCUMENTS, str(src_dir / 'hypotheses.txt'))
+    return str(src_dir)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from utils import bootstrap
+from utils.evaluate import Evaluator, ScoreAccumulator, load_references, score_hypotheses
+from utils.bootstrap import bootstrap_means, compare_score_tables, compute_macro_f1, report_comparison
+
+
+def test_bootstrap_means_matches_resampling(monkeypatch):
+    # small blocks, so that several blocks of resamples are drawn
+    monkeypatch.setattr(bootstrap, 'BLOCK_ENTRIES', 50)
+    rng = np.random.default_rng(1)
+    values = rng.random((13, 4))
+    num_resamples = 17
+    means = bootstrap_means(values, num_resamples, seed=3)
+
+    draw_rng = np.random.default_rng(3)
+    block_size = max(1, min(num_resamples, 50 // values.shape[0]))
+    expected = []
+    for start in range(0, num_resamples, block_size):
+        indices = draw_rng.integers(0, values.shape[0],
+                                    size=(min(block_size, num_resamples - start), values.shape[0]))
+        expected += [values[resample].mean(axis=0) for resample in indices]
+    assert np.allclose(means, np.array(expected))
+
+
+def test_compute_macro_f1():
+    assert compute_macro_f1(np.array([0.5, 0.0]), np.array([0.25, 0.0])).tolist() == [1 / 3, 0.0]
+
+
+def score_table(src_dir, hypotheses):
+    with Evaluator([5, 'M']) as evaluator:
+        accumulator = ScoreAccumulator(evaluator.k_list)
+        score_hypotheses(load_references(src_dir), hypotheses, accumulator, disable_progress_bar=True)
+        return accumulator.table, evaluator.report(accumulator)
+
+
+def test_compare_score_tables(src_dir, documents):
+    table_a, metrics_a = score_table(src_dir, [pred_l for _, _, pred_l in documents])
+    # the second system misses every present keyphrase of the first document
+    table_b, metrics_b = score_table(src_dir, [''] + [pred_l for _, _, pred_l in documents[1:]])
+    rows = compare_score_tables(table_a, table_b, num_resamples=200)
+    assert [row['metric'] for row in rows] == ['F1@5_present', 'F1@M_present', 'F1@5_absent', 'F1@M_absent']
+    for row in rows:
+        topk, tag = row['metric'][len('F1@'):].split('_')
+        assert row['f1_a'] == metrics_a['macro_avg_f1@{}_{}'.format(topk, tag)]
+        assert row['f1_b'] == metrics_b['macro_avg_f1@{}_{}'.format(topk, tag)]
+        assert row['ci_a'][0] <= row['ci_a'][1] and row['ci_delta'][0] <= row['ci_delta'][1]
+        assert 0 < row['p_value'] <= 1
+    assert rows[0]['delta'] > 0
+    # the same system: no difference on any resample
+    rows = compare_score_tables(table_a, table_a, num_resamples=200)
+    assert all(row['delta'] == 0 and row['ci_delta'] == [0, 0] and row['p_value'] == 1 for row in rows)
+    assert report_comparison(rows, 'a', 'b').count('\n') == len(rows) + 1
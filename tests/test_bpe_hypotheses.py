@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import subprocess
+import numpy as np
+import pytest
+from utils import evaluate
+from utils.evaluate import Evaluator, ScoreAccumulator, clean_keyphrases, load_references, score_hypotheses, \
+    stem_word_list
+from utils.bpe_hypotheses import BPEHypothesisParser
+from conftest import encode, make_encoder, write_documents
+
+K_LIST = [5, 10, 'M']
+MERGED_TOKENS = [' ;', ';', ';)', ' net', 'work', ' [', 'unk', ']', ' deep', '_', ' ##', 'ing', ' [ digit ]']
+
+
+@pytest.fixture
+def encoder_json(tmp_path):
+    encoder_json = str(tmp_path / 'encoder.json')
+    with open(encoder_json, 'w', encoding='utf-8') as fw:
+        json.dump(make_encoder(MERGED_TOKENS), fw)
+    return encoder_json
+
+
+def test_bpe_hypothesis_parser_matches_text_decoding(tmp_path, encoder_json):
+    encoder = make_encoder(MERGED_TOKENS)
+    lines = [
+        ['D', 'eep', ' net', 'work', ' ;', ' net', 'work', 's'],
+        [' deep', '_', 'l', 'earn', 'ing', ' ;', ' ;', ' [', 'unk', ']', ';', ''],
+        # a merged ';)' id, the keyphrases are split on the decoded text
+        ['(', 'a', ';)', ' b', ' ;', ' c'],
+        [' net', ' ##', 'work', ' ;', ' [ digit ]', ' l', 'ay', 'ers', ' ;'],
+        ['w', 'x', ' ;'] * 210,
+        ['é', ' ;', ' ', ' ;'],
+    ]
+    parser = BPEHypothesisParser(encoder_json)
+    for pieces in lines:
+        line = encode(encoder, [piece for piece in pieces if piece])
+        text = ''.join(pieces)
+        expected = [kp.strip().split(' ') for kp in clean_keyphrases(text)[:200]]
+        # twice, the second time from the keyphrase cache
+        for _ in range(2):
+            pred_token_2dlist, stemmed = parser(line)
+            assert pred_token_2dlist == expected
+            assert stemmed == [stem_word_list(token_list) for token_list in expected]
+
+    # scored the same as the text
+    src_dir = str(tmp_path)
+    documents = [('deep networks [sep] the deep_learning of networks', 'deep networks;deep learning', '')] * len(lines)
+    write_documents(src_dir, documents)
+    references = load_references(src_dir)
+    accumulators = [ScoreAccumulator(K_LIST, capacity=len(lines)) for _ in range(2)]
+    score_hypotheses(references, [''.join(pieces) for pieces in lines], accumulators[0], disable_progress_bar=True)
+    score_hypotheses(references, [encode(encoder, [p for p in pieces if p]) for pieces in lines], accumulators[1],
+                     disable_progress_bar=True, parse_hypothesis=parser)
+    assert np.array_equal(accumulators[0].table.scores, accumulators[1].table.scores)
+
+
+@pytest.mark.parametrize('options', [['--workers', '1'], ['--workers', '2'], ['--workers', '2', '--streaming']])
+def test_command_line(tmp_path, src_dir, documents, encoder_json, options):
+    results_file, prediction_file = str(tmp_path / 'results_log_text.txt'), str(tmp_path / 'text_predictions.txt')
+    with Evaluator(K_LIST) as evaluator:
+        evaluator.evaluate_src_dir(src_dir, os.path.join(src_dir, 'hypotheses.txt'), results_file, prediction_file)
+    # every character is split into its bytes, ';' is a KP_SEP id
+    with open(encoder_json, encoding='utf-8') as f:
+        encoder = json.load(f)
+    with open(str(tmp_path / 'run_hypotheses.txt'), 'w') as fw:
+        fw.write(''.join(encode(encoder, [pred_l]) + '\n' for _, _, pred_l in documents))
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(evaluate.__file__), 'evaluate.py'),
+                    '--src_dir', src_dir, '--bpe_encoder_json', encoder_json, '--file_prefix', str(tmp_path / 'run'),
+                    '--tgt_dir', str(tmp_path), '--log_file', 'run', '--k_list'] + [str(topk) for topk in K_LIST] +
+                   options, check=True, stderr=subprocess.DEVNULL)
+    for expected_file, output_file in [(results_file, 'results_log_run.txt'), (prediction_file, 'run_predictions.txt')]:
+        with open(expected_file) as f1, open(str(tmp_path / output_file)) as f2:
+            assert f1.read() == f2.read()
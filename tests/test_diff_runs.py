@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import subprocess
+import numpy as np
+import pytest
+from utils import diff_runs
+from utils.diff_runs import diff_match_vectors, report_diff
+from utils.evaluate import Evaluator
+from utils.score_table import load_match_vectors
+
+K_LIST = [5, 10, 'M']
+
+
+@pytest.fixture
+def match_files(tmp_path, src_dir, documents):
+    """
+    Match vectors of the hypotheses of the documents (run a) and of a run b where the first document has no
+    predictions and the second one exactly its present targets
+    """
+    hyp_file = os.path.join(src_dir, 'hypotheses.txt')
+    new_hyp_file = str(tmp_path / 'new_hypotheses.txt')
+    with open(new_hyp_file, 'w') as fw:
+        fw.write('\n' + 'network;networks of networks\n' + ''.join(pred_l + '\n' for _, _, pred_l in documents[2:]))
+    match_files = [str(tmp_path / 'a.npy'), str(tmp_path / 'b.npy')]
+    with Evaluator(K_LIST) as evaluator:
+        for run_hyp_file, match_file in zip([hyp_file, new_hyp_file], match_files):
+            evaluator.evaluate_src_dir(src_dir, run_hyp_file, match_file=match_file)
+    return match_files
+
+
+def test_diff_match_vectors(match_files, documents):
+    match_vectors_a, match_vectors_b = [load_match_vectors(match_file) for match_file in match_files]
+    order, delta, (f1_a, f1_b), (hits_a, hits_b) = diff_match_vectors(match_vectors_a, match_vectors_b, '5', 'present')
+    assert len(order) == len(delta) == len(documents)
+    assert delta.tolist() == (f1_b.astype(np.float64) - f1_a).tolist()
+    # only the two changed documents moved
+    assert delta[0] < 0 and hits_b[0] == 0 and f1_b[0] == 0
+    assert delta[1] > 0 and hits_b[1] == 2 and f1_b[1] == pytest.approx(2 * 0.4 * 1.0 / 1.4)
+    assert np.all(delta[2:] == 0)
+    assert order[0] == 1 and order[-1] == 0
+    # ties stay in document order
+    assert order[1:-1].tolist() == list(range(2, len(documents)))
+
+    output_str = report_diff(match_vectors_a, match_vectors_b, '5', 'present', top=10)
+    lines = output_str.splitlines()
+    assert lines[0].startswith('F1@5_present: 1 documents gained, 1 lost, {} unchanged'.format(len(documents) - 2))
+    assert lines[1:4:2] == ['Top gains', '1\t{:.4f}\t{:.4f}\t{:+.4f}\t{}\t2\t2'.format(
+        f1_a[1], f1_b[1], delta[1], hits_a[1])]
+    assert lines[4] == 'Top losses' and lines[6].split('\t')[0] == '0'
+
+
+def test_diff_match_vectors_checks_the_runs(match_files):
+    match_vectors_a, match_vectors_b = [load_match_vectors(match_file) for match_file in match_files]
+    with pytest.raises(AssertionError, match='same documents'):
+        diff_match_vectors(match_vectors_a, match_vectors_b[:3])
+    with pytest.raises(AssertionError, match='--k_list'):
+        diff_match_vectors(match_vectors_a, match_vectors_b, '20')
+
+
+def test_command_line(tmp_path, match_files, documents):
+    out_file = str(tmp_path / 'diff.tsv')
+    output = subprocess.run([sys.executable, diff_runs.__file__, '--match_files'] + match_files +
+                            ['--k', '5', '--out_file', out_file], check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert output == report_diff(*[load_match_vectors(match_file) for match_file in match_files])
+    rows = np.loadtxt(out_file, skiprows=1, ndmin=2)
+    assert rows[:, 0].astype(int).tolist() == [1] + list(range(2, len(documents))) + [0]
@@ -0,0 +1,100 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import threading
+import pytest
+from utils import evaluate
+from utils.evaluate import Evaluator, ReferenceDocument
+from utils.reference_cache import CachedReferences
+from utils.eval_server import EvaluationService, create_server, evaluate_remote, request_server
+
+K_LIST = [5, 10, 'M']
+
+
+@pytest.fixture
+def hypotheses(documents):
+    return [pred_l for _, _, pred_l in documents]
+
+
+def evaluate_locally(src_dir, k_list=K_LIST):
+    with Evaluator(k_list) as evaluator:
+        return evaluator.evaluate_src_dir(src_dir, os.path.join(src_dir, 'hypotheses.txt'))
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_references_stay_resident(tmp_path, src_dir, hypotheses, monkeypatch, use_cache):
+    service = EvaluationService(K_LIST, cache_dir=str(tmp_path / 'cache') if use_cache else None)
+    try:
+        expected = evaluate_locally(src_dir)
+        references = service.get_references(src_dir)
+        assert isinstance(references, list) and all(isinstance(r, ReferenceDocument) for r in references)
+        # nothing is prepared or decoded again at the requests
+        monkeypatch.setattr(evaluate, 'prepare_reference', None)
+        monkeypatch.setattr(CachedReferences, 'decode', None)
+        for _ in range(2):
+            assert service.evaluate({'src_dir': src_dir, 'hypotheses': hypotheses}) == expected
+        assert service.get_references(src_dir) is references
+        assert service.status()['reference_sets'] == {os.path.abspath(src_dir): len(hypotheses)}
+    finally:
+        service.close()
+
+
+def test_evaluate_requests(tmp_path, src_dir, hypotheses):
+    service = EvaluationService(K_LIST)
+    try:
+        # a subset of the documents, with other k values
+        ids = [1, 4]
+        subset_dir = tmp_path / 'subset'
+        subset_dir.mkdir()
+        for filename in ['test.source', 'test.target', 'hypotheses.txt']:
+            with open(os.path.join(src_dir, filename)) as f:
+                lines = f.readlines()
+            with open(str(subset_dir / filename), 'w') as fw:
+                fw.write(''.join(lines[idx] for idx in ids))
+        request = {'src_dir': src_dir, 'hypotheses': [hypotheses[idx] for idx in ids], 'ids': ids, 'k_list': [5]}
+        assert service.evaluate(request) == evaluate_locally(str(subset_dir), [5])
+
+        prediction_file = str(tmp_path / 'predictions.txt')
+        metrics = service.evaluate({'src_dir': src_dir, 'hyp_file': str(subset_dir / 'hypotheses.txt'),
+                                    'ids': ids, 'prediction_file': prediction_file})
+        assert metrics == evaluate_locally(str(subset_dir))
+        assert os.path.exists(prediction_file)
+        with pytest.raises(AssertionError):
+            service.evaluate({'src_dir': src_dir, 'hypotheses': hypotheses[:2]})
+    finally:
+        service.close()
+
+
+def test_close_closes_every_evaluator(monkeypatch):
+    closed = []
+    monkeypatch.setattr(Evaluator, 'close', lambda self: closed.append(self))
+    service = EvaluationService(K_LIST)
+    evaluators = [service.default_evaluator, service.get_evaluator([5]), service.get_evaluator(['M'])]
+    assert service.get_evaluator(K_LIST) is service.default_evaluator
+    service.close()
+    assert sorted(map(id, closed)) == sorted(map(id, evaluators))
+
+
+def test_server_over_unix_socket(tmp_path, src_dir, hypotheses):
+    address = str(tmp_path / 'eval.sock')
+    service = EvaluationService(K_LIST)
+    server = create_server(service, address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert request_server('/load', {'src_dir': src_dir}, address=address)['num_documents'] == len(hypotheses)
+        metrics = evaluate_remote(src_dir, hypotheses=hypotheses, address=address)
+        assert metrics.pop('elapsed_seconds') >= 0
+        assert metrics == evaluate_locally(src_dir)
+        assert request_server('/status', address=address)['reference_sets'] == {src_dir: len(hypotheses)}
+        with pytest.raises(RuntimeError, match='unknown path'):
+            request_server('/unknown', address=address)
+        with pytest.raises(RuntimeError, match='expected {} hypotheses'.format(len(hypotheses))):
+            evaluate_remote(src_dir, hypotheses=hypotheses[:1], address=address)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        service.close()
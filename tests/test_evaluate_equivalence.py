@@ -0,0 +1,149 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import pytest
+from nltk.stem.porter import PorterStemmer
+from utils.evaluate import Evaluator, clean_keyphrases, filter_and_intern_prediction, find_unique_target
+from utils.score_table import TAGS
+
+K_LIST = [5, 10, 'M']
+
+def legacy_stem_2dlist(token_2dlist):
+    stemmer = PorterStemmer()
+    return [[stemmer.stem(w.strip().lower()) for w in word_list] for word_list in token_2dlist]
+
+
+def legacy_is_unique(token_2dlist):
+    # the '_' join of check_duplicate_keyphrases
+    seen, mask = set(), []
+    for word_list in token_2dlist:
+        mask.append('_'.join(word_list) not in seen)
+        seen.add('_'.join(word_list))
+    return mask
+
+
+def legacy_filter(token_2dlist, disable_valid_filter, disable_extra_one_word_filter):
+    keep = legacy_is_unique(token_2dlist)
+    if not disable_valid_filter:
+        keep = [k and len(w) > 0 and not any(t in ('[unk]', ',', '.') for t in w) for k, w in zip(keep, token_2dlist)]
+    if not disable_extra_one_word_filter:
+        num_one_word = 0
+        for i, word_list in enumerate(token_2dlist):
+            if len(word_list) == 1:
+                num_one_word += 1
+                keep[i] = keep[i] and num_one_word == 1
+    return [word_list for word_list, k in zip(token_2dlist, keep) if k]
+
+
+def legacy_is_present(src_tokens, word_list):
+    if ' '.join(word_list).strip() == '':
+        return False
+    return any(src_tokens[i:i + len(word_list)] == word_list for i in range(len(src_tokens) - len(word_list) + 1))
+
+
+def legacy_scores_at_ks(trg_2dlist, pred_2dlist, k_list):
+    """
+    The precision, recall and F1 of update_score_dict and compute_classification_metrics_at_ks
+    """
+    num_targets, num_predictions = len(trg_2dlist), len(pred_2dlist)
+    targets = [' '.join(w) for w in trg_2dlist]
+    is_match = [' '.join(w) in targets for w in pred_2dlist]
+    scores = []
+    for topk in k_list:
+        if num_predictions == 0:
+            scores.append((0, 0, 0))
+            continue
+        topk = num_predictions if topk == 'M' else topk
+        num_matches = sum(is_match[:topk])
+        precision = num_matches / topk if topk > 0 else 0.0
+        recall = num_matches / num_targets if num_targets > 0 else 0.0
+        f1 = float(2 * (precision * recall)) / (precision + recall) if precision + recall > 0 else 0.0
+        scores.append((precision, recall, f1))
+    return scores
+
+
+def legacy_score_document(data_idx, src_l, trg_l, pred_l, k_list):
+    """
+    The per-document loop of the original evaluate.main()
+    :return: {tag: [(precision, recall, f1) for k in k_list]}, the row of the _predictions.txt file
+    """
+    pred_token_2dlist = [s.strip().split(' ') for s in pred_l.strip().split(';')[:200]]
+    trg_token_2dlist = [s.strip().split(' ') for s in trg_l.strip().split(';')]
+    if '[sep]' in src_l:
+        title, context = src_l.strip().split('[sep]')
+    else:
+        title, context = '', src_l
+    src_tokens = legacy_stem_2dlist([title.strip().split(' ') + context.strip().split(' ')])[0]
+
+    stemmed_preds = legacy_stem_2dlist(pred_token_2dlist)
+    filtered_preds = legacy_filter(stemmed_preds, True, True)
+    is_unique = legacy_is_unique(stemmed_preds)
+    stemmed_trgs = legacy_stem_2dlist(trg_token_2dlist)
+    unique_trgs = [w for w, u in zip(stemmed_trgs, legacy_is_unique(stemmed_trgs)) if u]
+
+    is_present_mask = [legacy_is_present(src_tokens, w) for w in filtered_preds]
+    present_preds = [w for w, p in zip(filtered_preds, is_present_mask) if p]
+    absent_preds = [w for w, p in zip(filtered_preds, is_present_mask) if not p]
+    present_trgs = [w for w in unique_trgs if legacy_is_present(src_tokens, w)]
+    absent_trgs = [w for w in unique_trgs if not legacy_is_present(src_tokens, w)]
+
+    result = {'id': data_idx, 'present': [], 'absent': []}
+    unique_preds = [w for w, u in zip(pred_token_2dlist, is_unique) if u]
+    for kp_tokens, is_present in zip(unique_preds, is_present_mask):
+        result['present' if is_present else 'absent'].append(' '.join(kp_tokens))
+    scores = {'all': legacy_scores_at_ks(unique_trgs, filtered_preds, k_list),
+              'present': legacy_scores_at_ks(present_trgs, present_preds, k_list),
+              'absent': legacy_scores_at_ks(absent_trgs, absent_preds, k_list)}
+    return scores, result
+
+
+@pytest.mark.parametrize('disable_valid_filter', [True, False])
+@pytest.mark.parametrize('disable_extra_one_word_filter', [True, False])
+def test_filter_and_intern_prediction_matches_legacy_masks(documents, disable_valid_filter,
+                                                          disable_extra_one_word_filter):
+    for _, _, pred_l in documents:
+        stemmed = legacy_stem_2dlist([s.strip().split(' ') for s in pred_l.split(';')])
+        phrase2id = {}
+        filtered, ids, num_duplicated, is_unique_mask = filter_and_intern_prediction(
+            disable_valid_filter, disable_extra_one_word_filter, stemmed, phrase2id)
+        assert filtered == legacy_filter(stemmed, disable_valid_filter, disable_extra_one_word_filter)
+        assert is_unique_mask.tolist() == legacy_is_unique(stemmed)
+        assert num_duplicated == len(stemmed) - sum(legacy_is_unique(stemmed))
+        assert [phrase2id[' '.join(word_list)] for word_list in filtered] == ids.tolist()
+
+
+def test_find_unique_target_matches_legacy(documents):
+    for _, trg_l, _ in documents:
+        stemmed = legacy_stem_2dlist([s.strip().split(' ') for s in trg_l.split(';')])
+        unique, num_duplicated = find_unique_target(stemmed)
+        assert unique == [w for w, u in zip(stemmed, legacy_is_unique(stemmed)) if u]
+        assert num_duplicated == len(stemmed) - len(unique)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_document_scores_match_legacy(tmp_path, documents, workers):
+    examples = [(src_l.lower(), ';'.join(clean_keyphrases(trg_l)), ';'.join(clean_keyphrases(pred_l)))
+                for src_l, trg_l, pred_l in documents]
+    prediction_file = str(tmp_path / 'predictions.txt')
+    with Evaluator(K_LIST, workers=workers, chunk_size=2) as evaluator:
+        accumulator = evaluator.score(examples, prediction_file, total=len(examples))
+        metrics = evaluator.report(accumulator)
+
+    table = accumulator.table
+    sums = {}
+    with open(prediction_file) as f:
+        for data_idx, ((src_l, trg_l, pred_l), line) in enumerate(zip(examples, f)):
+            scores, result = legacy_score_document(data_idx, src_l, trg_l, pred_l, K_LIST)
+            assert json.loads(line) == result
+            for tag in TAGS:
+                for k_idx, topk in enumerate(K_LIST):
+                    expected = scores[tag][k_idx]
+                    assert table.scores[data_idx, TAGS.index(tag), k_idx, :3].tolist() == list(expected)
+                    sums.setdefault((tag, topk), []).append(expected)
+    # the macro averages are sum() over the documents, as over the lists of the former score_dict
+    for (tag, topk), values in sums.items():
+        assert metrics['macro_avg_p@{}_{}'.format(topk, tag)] == sum(v[0] for v in values) / len(values)
+        assert metrics['macro_avg_r@{}_{}'.format(topk, tag)] == sum(v[1] for v in values) / len(values)
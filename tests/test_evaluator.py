@@ -0,0 +1,105 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import subprocess
+import pytest
+from utils import evaluate, evaluate_runs
+from utils.evaluate import Evaluator, iter_src_dir_examples, load_references
+
+K_LIST = [5, 10, 'M']
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def expected(tmp_path, src_dir):
+    """
+    The metrics, results_log and _predictions.txt of evaluate_src_dir()
+    """
+    results_file, prediction_file = str(tmp_path / 'results_log_expected.txt'), str(tmp_path / 'expected.txt')
+    with Evaluator(K_LIST) as evaluator:
+        metrics = evaluator.evaluate_src_dir(src_dir, os.path.join(src_dir, 'hypotheses.txt'), results_file,
+                                             prediction_file)
+    return metrics, read(results_file), read(prediction_file)
+
+
+def test_entry_points_agree(tmp_path, src_dir, expected):
+    metrics, results_log, predictions = expected
+    hyp_file = os.path.join(src_dir, 'hypotheses.txt')
+    results_file, prediction_file = str(tmp_path / 'results_log.txt'), str(tmp_path / 'predictions.txt')
+    with Evaluator(K_LIST) as evaluator:
+        assert evaluator.evaluate_references(load_references(src_dir), hyp_file, results_file,
+                                             prediction_file) == metrics
+        assert (read(results_file), read(prediction_file)) == (results_log, predictions)
+        with open(hyp_file) as f:
+            assert evaluator.evaluate_hypotheses(load_references(src_dir), f.readlines(), results_file,
+                                                 prediction_file, disable_progress_bar=True) == metrics
+        assert (read(results_file), read(prediction_file)) == (results_log, predictions)
+        # with only running sums of the scores
+        assert evaluator.evaluate_references(load_references(src_dir), hyp_file,
+                                             keep_document_scores=False) == metrics
+
+
+def test_main_writes_the_predictions_by_default(tmp_path, src_dir, expected):
+    _, results_log, predictions = expected
+    hypotheses, references, sources = zip(*iter_src_dir_examples(src_dir, os.path.join(src_dir, 'hypotheses.txt')))
+    evaluate.run_eval((hypotheses, references, sources), str(tmp_path), 'x', K_LIST)
+    assert read(str(tmp_path / 'results_log_x.txt')) == results_log
+    assert read(str(tmp_path / 'x_predictions.txt')) == predictions
+
+    evaluate.main((hypotheses, references, sources), str(tmp_path), 'y', K_LIST, file_prefix=str(tmp_path / 'run'))
+    assert read(str(tmp_path / 'results_log_y.txt')) == results_log
+    assert read(str(tmp_path / 'run_predictions.txt')) == predictions
+
+
+def test_evaluate_runs(tmp_path, src_dir, expected):
+    metrics, results_log, _ = expected
+    hyp_file = os.path.join(src_dir, 'hypotheses.txt')
+    args = argparse.Namespace(src_dir=src_dir, hyp_files=[hyp_file, hyp_file], names=['a', 'b'],
+                              out_file=str(tmp_path / 'comparison.tsv'), tgt_dir=str(tmp_path), cache_dir=None,
+                              k_list=K_LIST, ranking_metrics=False, num_resamples=0)
+    evaluate_runs.main(args)
+    assert read(str(tmp_path / 'results_log_a.txt')) == read(str(tmp_path / 'results_log_b.txt')) == results_log
+    with open(args.out_file) as f:
+        header, row_a, row_b = [line.rstrip('\n').split('\t') for line in f]
+    assert header == ['run'] + list(metrics)
+    assert row_a[1:] == row_b[1:] == ['{:.5}'.format(value) for value in metrics.values()]
+
+
+@pytest.mark.parametrize('keep_document_scores', [True, False])
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_references_scored_in_workers(tmp_path, src_dir, expected, keep_document_scores, use_cache):
+    metrics, results_log, predictions = expected
+    references = load_references(src_dir, cache_dir=str(tmp_path / 'cache') if use_cache else None)
+    serial_results_file = str(tmp_path / 'results_log_serial.txt')
+    results_file, prediction_file = str(tmp_path / 'results_log.txt'), str(tmp_path / 'predictions.txt')
+    with Evaluator(K_LIST) as evaluator:
+        serial_metrics = evaluator.evaluate_references(references, os.path.join(src_dir, 'hypotheses.txt'),
+                                                       serial_results_file,
+                                                       keep_document_scores=keep_document_scores)
+    # chunks of 2 documents, more chunks than workers
+    with Evaluator(K_LIST, workers=2, chunk_size=2) as evaluator, open(os.path.join(src_dir, 'hypotheses.txt')) as f:
+        accumulator = evaluator.score_references(references, f, prediction_file, keep_document_scores)
+        assert evaluator.report(accumulator, results_file) == serial_metrics == metrics
+    assert accumulator.table.num_documents == len(references)
+    assert (read(results_file), read(prediction_file)) == (read(serial_results_file), predictions)
+    if keep_document_scores:
+        assert read(results_file) == results_log
+
+
+@pytest.mark.parametrize('options', [['--workers', '2'], ['--workers', '2', '--streaming'], ['--streaming']])
+def test_command_line_reference_cache(tmp_path, src_dir, expected, options):
+    _, results_log, predictions = expected
+    os.rename(os.path.join(src_dir, 'hypotheses.txt'), str(tmp_path / 'run_hypotheses.txt'))
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(evaluate.__file__), 'evaluate.py'),
+                    '--src_dir', src_dir, '--reference_cache', str(tmp_path / 'cache'),
+                    '--file_prefix', str(tmp_path / 'run'), '--tgt_dir', str(tmp_path), '--log_file', 'run',
+                    '--k_list'] + [str(topk) for topk in K_LIST] + options, check=True, stderr=subprocess.DEVNULL)
+    assert read(str(tmp_path / 'results_log_run.txt')) == results_log
+    assert read(str(tmp_path / 'run_predictions.txt')) == predictions
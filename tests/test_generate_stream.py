@@ -0,0 +1,103 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import random
+import subprocess
+import numpy as np
+import pytest
+from utils import generate_stream
+from utils.evaluate import Evaluator, load_references
+from utils.generate_stream import parse_generate_line, score_generation_stream
+
+K_LIST = [5, 10, 'M']
+
+
+def generate_output(documents, order, num_best=1):
+    """
+    fairseq-generate output of the documents, printed in the given order with num_best hypotheses each
+    """
+    lines = ['2024-01-01 | INFO | fairseq_cli.generate | loading model\n']
+    for data_idx in order:
+        src_l, trg_l, pred_l = documents[data_idx]
+        lines.append('S-{}\t{}\n'.format(data_idx, src_l))
+        lines.append('T-{}\t{}\n'.format(data_idx, trg_l))
+        for rank in range(num_best):
+            # the hypotheses after the best one are not scored
+            lines.append('H-{}\t{:.4f}\t{}\n'.format(data_idx, -0.1 * (rank + 1), pred_l if rank == 0 else 'worse'))
+            lines.append('D-{}\t{:.4f}\t{}\n'.format(data_idx, -0.1 * (rank + 1), pred_l))
+            lines.append('P-{}\t-0.1 -0.1\n'.format(data_idx))
+    lines.append('Generate test with beam=1: BLEU4 = 0.00\n')
+    return lines
+
+
+@pytest.fixture
+def expected(tmp_path, src_dir):
+    results_file, prediction_file = str(tmp_path / 'results_log_expected.txt'), str(tmp_path / 'expected.txt')
+    with Evaluator(K_LIST) as evaluator:
+        evaluator.evaluate_src_dir(src_dir, os.path.join(src_dir, 'hypotheses.txt'), results_file, prediction_file)
+    with open(results_file) as f1, open(prediction_file) as f2:
+        return f1.read(), f2.read()
+
+
+def test_parse_generate_line():
+    assert parse_generate_line('H-12\t-0.25\tdeep learning;graph\n') == (12, 'deep learning;graph')
+    assert parse_generate_line('H-3\t-0.25\n') == (3, '')
+    assert parse_generate_line('D-12\t-0.25\tdeep learning\n') is None
+    assert parse_generate_line('S-12\tsource\n') is None
+
+
+@pytest.mark.parametrize('num_best', [1, 2])
+def test_out_of_order_generation(tmp_path, src_dir, documents, expected, num_best):
+    results_log, predictions = expected
+    order = list(range(len(documents)))
+    random.Random(0).shuffle(order)
+    assert order != sorted(order)
+    lines = generate_output(documents, order, num_best)
+    log_file, hyp_file = str(tmp_path / 'generate.txt'), str(tmp_path / 'run_hypotheses.txt')
+    prediction_file, results_file = str(tmp_path / 'run_predictions.txt'), str(tmp_path / 'results_log_run.txt')
+    with Evaluator(K_LIST) as evaluator:
+        references = load_references(src_dir)
+        accumulator = evaluator.new_accumulator(total=len(references))
+        score_generation_stream(iter(lines), references, accumulator, log_file=log_file, hyp_file=hyp_file,
+                                prediction_file=prediction_file, disable_progress_bar=True)
+        evaluator.report(accumulator, results_file)
+        with open(log_file) as f:
+            assert f.readlines() == lines
+        # the files are in document order, the scores the same as those of the sorted hypotheses
+        with open(hyp_file) as f:
+            assert f.read() == ''.join(pred_l + '\n' for _, _, pred_l in documents)
+        with open(prediction_file) as f:
+            assert f.read() == predictions
+        with open(results_file) as f:
+            assert f.read() == results_log
+
+        with open(hyp_file) as f:
+            sorted_accumulator = evaluator.score_references(references, f, disable_progress_bar=True)
+        assert np.array_equal(accumulator.table.scores, sorted_accumulator.table.scores)
+
+
+def test_missing_document(src_dir, documents):
+    references = load_references(src_dir)
+    lines = generate_output(documents, [idx for idx in range(len(documents)) if idx != 2])
+    with Evaluator(K_LIST) as evaluator:
+        accumulator = evaluator.new_accumulator(total=len(references))
+        with pytest.raises(ValueError, match='hypotheses of {} of the {} documents'.format(
+                len(documents) - 1, len(documents))):
+            score_generation_stream(lines, references, accumulator, disable_progress_bar=True)
+
+
+def test_command_line(tmp_path, src_dir, documents, expected):
+    results_log, predictions = expected
+    lines = generate_output(documents, reversed(range(len(documents))))
+    subprocess.run([sys.executable, generate_stream.__file__, '--src_dir', src_dir, '--file_prefix',
+                    str(tmp_path / 'run'), '--tgt_dir', str(tmp_path), '--log_file', 'run',
+                    '--out_file', str(tmp_path / 'generate.txt'), '--k_list'] + [str(topk) for topk in K_LIST],
+                   input=''.join(lines), universal_newlines=True, check=True, stderr=subprocess.DEVNULL)
+    with open(str(tmp_path / 'results_log_run.txt')) as f:
+        assert f.read() == results_log
+    with open(str(tmp_path / 'run_predictions.txt')) as f:
+        assert f.read() == predictions
+    with open(str(tmp_path / 'generate.txt')) as f:
+        assert f.readlines() == lines
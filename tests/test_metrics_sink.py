@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import pytest
+from utils import metrics_sink
+from utils.evaluate import Evaluator
+from utils.metrics_sink import STAGES, StageTimer, get_peak_rss_mb
+
+K_LIST = [5, 10, 'M']
+
+
+def test_merged_timers_are_worker_seconds():
+    timer = StageTimer()
+    timer.lap('load')
+    workers = []
+    for seconds in (1.0, 2.0):
+        worker = StageTimer()
+        worker.wall['matching'], worker.cpu['matching'] = seconds, seconds / 2
+        workers.append(worker)
+        timer.merge(worker)
+    stages = timer.to_dict()
+    # the workers ran in parallel, their times are not added to the wall-clock time of the stage
+    assert stages['matching']['wall_seconds'] == stages['matching']['cpu_seconds'] == 0.0
+    assert stages['matching']['worker_wall_seconds'] == 3.0
+    assert stages['matching']['worker_cpu_seconds'] == 1.5
+    assert stages['load']['wall_seconds'] >= 0 and stages['load']['worker_wall_seconds'] == 0.0
+    # merging a merged timer keeps its worker-seconds
+    assert StageTimer().merge(timer).to_dict()['matching']['worker_wall_seconds'] == 3.0
+
+
+def test_peak_rss_without_resource(monkeypatch):
+    assert get_peak_rss_mb()['self'] > 0
+    monkeypatch.setattr(metrics_sink, 'resource', None)
+    assert get_peak_rss_mb() == {'self': None, 'children': None}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_metrics_record(tmp_path, src_dir, documents, workers):
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    hyp_file = os.path.join(src_dir, 'hypotheses.txt')
+    with Evaluator(K_LIST, workers=workers, chunk_size=2, metrics_file=metrics_file) as evaluator:
+        for _ in range(2):
+            metrics = evaluator.evaluate_src_dir(src_dir, hyp_file)
+            # the workers have terminated, their peak memory is counted
+            assert evaluator.pool is None
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    for record in records:
+        assert record['hyp_file'] == hyp_file and record['workers'] == workers
+        assert record['num_documents'] == len(documents)
+        assert record['metrics']['macro_avg_f1@5_present'] == metrics['macro_avg_f1@5_present']
+        assert set(record['stages']) == set(STAGES)
+        worker_seconds = sum(stage['worker_wall_seconds'] for stage in record['stages'].values())
+        assert (worker_seconds > 0) == (workers > 1)
+        if workers > 1:
+            assert record['peak_rss_mb']['children'] > 0
@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from multiprocessing import Pool
+import pytest
+from utils.pool_util import imap_bounded
+from finetuning_fairseq.fairseq_gpt2_decode import decode_lines
+from conftest import encode, make_encoder
+
+
+def square(x):
+    return x * x
+
+
+class CountingIterable(object):
+    """
+    Counts the items read from it
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.num_read = 0
+
+    def __iter__(self):
+        for item in self.items:
+            self.num_read += 1
+            yield item
+
+
+@pytest.mark.parametrize('max_pending', [1, 3])
+def test_imap_bounded(max_pending):
+    items = CountingIterable(range(20))
+    with Pool(2) as pool:
+        results = []
+        for result in imap_bounded(pool, square, items, max_pending):
+            # the items read are the ones consumed and at most max_pending ahead of them
+            assert items.num_read <= len(results) + max_pending
+            results.append(result)
+    assert results == [x * x for x in range(20)]
+    with Pool(2) as pool:
+        assert list(imap_bounded(pool, square, [], max_pending)) == []
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_decode_lines_reads_ahead_boundedly(tmp_path, workers):
+    encoder = make_encoder([' ;', ';', ' net', 'work'])
+    encoder_json = str(tmp_path / 'encoder.json')
+    with open(encoder_json, 'w', encoding='utf-8') as fw:
+        json.dump(encoder, fw)
+    texts = ['deep network{} ; graph ; é'.format(idx) for idx in range(50)]
+    lines = CountingIterable([encode(encoder, [text]) + '\n' for text in texts])
+    decoded = []
+    for decoded_string in decode_lines(lines, encoder_json, workers, chunk_size=3):
+        # at most two chunks per worker are read ahead of the decoded lines
+        assert lines.num_read <= len(decoded) + 3 * (2 * workers + 1)
+        decoded.append(decoded_string)
+    assert decoded == texts
@@ -0,0 +1,112 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import random
+import pytest
+
+spacy = pytest.importorskip('spacy')
+pytest.importorskip('transformers')
+from transformers import BertTokenizer
+from data import prep_util
+from data.prep_util import DIGIT, FastBertTokenizer, MultiprocessingTokenizer, SpacyTokenizer, \
+    separate_present_absent, stem_text
+
+# a small wordpiece vocabulary, the texts below also have words and CJK characters that are not in it
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '[unused0]', '[unused1]', 'deep', 'network', '##s', 'learn',
+         '##ing', 'graph', 'cafe', 'naive', 're', '##sume', '的', '学', '习', '[', ']', 'digit', ';', ',', '.', '(',
+         ')', '-', 'a', 'of']
+TEXTS = [
+    'Deep networks; learning graphs.',
+    # accents are stripped
+    'café naïve résumé',
+    # every CJK character is a token, [UNK] if it is not in the vocabulary
+    '深度学习的网络',
+    'unknownword xyz [UNK]',
+    'deep-learning (graph) of {} networks'.format(DIGIT),
+    '',
+    ' \t ',
+]
+EXAMPLES = [
+    {'id': idx, 'title': 'Deep networks {}'.format(text), 'abstract': text,
+     'present_keywords': ['deep networks', text], 'absent_keywords': [text, 'graph learning']}
+    for idx, text in enumerate(TEXTS)
+]
+
+
+@pytest.fixture
+def bert_dir(tmp_path):
+    with open(str(tmp_path / 'vocab.txt'), 'w', encoding='utf-8') as fw:
+        fw.write(''.join(token + '\n' for token in VOCAB))
+    return str(tmp_path)
+
+
+def get_multiprocessing_tokenizer(tokenizer_type, monkeypatch, tokenizer):
+    """
+    A MultiprocessingTokenizer of the type, with the given tokenizer instead of the one get_tokenizer() loads
+    """
+    monkeypatch.setitem(prep_util._tokenizers, tokenizer_type, tokenizer)
+    return MultiprocessingTokenizer({'tokenizer': tokenizer_type, 'kp_separator': None,
+                                     'replace_digit_tokenizer': None})
+
+
+def test_fast_bert_tokenizer_matches_bert_tokenizer(bert_dir, monkeypatch):
+    bert_tokenizer = BertTokenizer(os.path.join(bert_dir, 'vocab.txt'))
+    fast_bert_tokenizer = FastBertTokenizer(bert_dir)
+    assert fast_bert_tokenizer.vocab == bert_tokenizer.vocab
+    assert DIGIT not in fast_bert_tokenizer.vocab
+    assert fast_bert_tokenizer.tokenize('café 深度学习 [UNK]') == ['cafe', '[UNK]', '[UNK]', '学', '习', '[UNK]']
+    for text, tokens in zip(TEXTS, fast_bert_tokenizer.tokenize_batch(TEXTS)):
+        # DIGIT is one token, BertTokenizer splits it and process_batch() joins it back
+        assert ' '.join(tokens) == ' '.join(bert_tokenizer.tokenize(text)).replace('[ digit ]', DIGIT)
+
+    TOK = get_multiprocessing_tokenizer('BertTokenizer', monkeypatch, bert_tokenizer)
+    TOK_fast = get_multiprocessing_tokenizer('BertTokenizerFast', monkeypatch, fast_bert_tokenizer)
+    assert TOK_fast.process_batch(EXAMPLES) == TOK.process_batch(EXAMPLES)
+    assert TOK_fast.vocab == TOK.vocab
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_spacy_tokenizer_pipe(monkeypatch, batch_size):
+    # a blank English pipeline, its tokenizer is the one of the English models
+    spacy_tokenizer = SpacyTokenizer(model='blank:en', batch_size=batch_size)
+    nlp = spacy.blank('en')
+    texts = TEXTS + ["It's a 3.5% gain, isn't it? (U.S.A.) e-mail: a@b.com", 'graph-based learning'] * 3
+    # the texts piped in batches, in order
+    assert spacy_tokenizer.tokenize_batch(texts) == [[token.text for token in nlp(text)] for text in texts]
+    assert spacy_tokenizer.tokenize(texts[-1]) == ['graph', '-', 'based', 'learning']
+
+    TOK = get_multiprocessing_tokenizer('SpacyTokenizer', monkeypatch, spacy_tokenizer)
+    assert TOK.process_batch(EXAMPLES) == [TOK.process(example) for example in EXAMPLES]
+    assert TOK.tokenize_batch(texts) == [' '.join(token.text for token in nlp(text)) for text in texts]
+
+
+def test_separate_present_absent():
+    random.seed(0)
+    words = 'network net networks work works graph graphs a of learning learn deep'.split()
+    for _ in range(500):
+        source = ' '.join(random.choice(words) for _ in range(random.randint(0, 15)))
+        keyphrases = [' '.join(random.choice(words) for _ in range(random.randint(0, 3))) for _ in range(6)]
+        stemmed_source = stem_text(source)
+        # token aligned
+        present, absent = separate_present_absent(source, keyphrases)
+        assert present == [kp for kp in keyphrases
+                           if not stem_text(kp) or ' {} '.format(stem_text(kp)) in ' {} '.format(stemmed_source)]
+        assert absent == [kp for kp in keyphrases if kp not in present]
+        # the former substring test
+        present, absent = separate_present_absent(source, keyphrases, substring_match=True)
+        assert present == [kp for kp in keyphrases if stem_text(kp) in stemmed_source]
+        assert absent == [kp for kp in keyphrases if stem_text(kp) not in stemmed_source]
+
+
+@pytest.mark.parametrize('substring_match', [False, True])
+def test_prepare_separates_present_keyphrases(substring_match):
+    TOK = MultiprocessingTokenizer({'tokenizer': 'WhiteSpace', 'kp_separator': ';', 'replace_digit_tokenizer': None,
+                                    'substring_match': substring_match})
+    example = {'title': 'Deep Networks', 'abstract': 'learning of graph networks',
+               'keyword': 'net;graph network; ;Deep'}
+    _, _, present_keywords, absent_keywords = TOK.prepare(example)
+    # 'net' is only inside the word 'networks'
+    assert present_keywords == (['net', 'graph network', 'deep'] if substring_match else ['graph network', 'deep'])
+    assert absent_keywords == ([] if substring_match else ['net'])
@@ -0,0 +1,143 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import argparse
+from collections import Counter
+import pytest
+
+pytest.importorskip('spacy')
+pytest.importorskip('transformers')
+from data import prepare
+from data.prep_util import MultiprocessingTokenizer, get_vocab_items, update_vocab
+
+# KPTimes examples, keyphrases separated by ';'
+KPTIMES_EXAMPLES = [
+    {'id': 'a{}'.format(idx), 'title': 'Deep networks {} for graphs'.format(idx),
+     'abstract': 'We learn deep networks of {} graphs, in 2024 and 19{}.'.format(idx, idx),
+     'keyword': 'deep networks;graph learning;networks {}'.format(idx % 3)}
+    for idx in range(23)
+]
+
+
+def write_kptimes(data_dir, splits=('train', 'valid', 'test')):
+    for name, examples in [('train', KPTIMES_EXAMPLES[:15]), ('valid', KPTIMES_EXAMPLES[15:18]),
+                           ('test', KPTIMES_EXAMPLES[18:])]:
+        if name in splits:
+            with open(os.path.join(data_dir, 'KPTimes.{}.jsonl'.format(name)), 'w') as fw:
+                fw.write(''.join(json.dumps(ex) + '\n' for ex in examples))
+
+
+def write_kp20k(src_file, trg_file):
+    with open(src_file, 'w') as fs, open(trg_file, 'w') as ft:
+        for ex in KPTIMES_EXAMPLES:
+            # empty lines are skipped
+            fs.write('{} <eos> {}\n\n'.format(ex['title'], ex['abstract'].replace('2024', '<digit>')))
+            keyphrases = ex['keyword'].split(';')
+            ft.write('{} <peos> {}\n\n'.format(';'.join(keyphrases[:2]), keyphrases[2]))
+
+
+def get_datasets(data_dir, out_dir, names, tokenizer='WhiteSpace'):
+    opt = argparse.Namespace(data_dir=str(data_dir), out_dir=str(out_dir), tokenizer=tokenizer,
+                             spacy_batch_size=1000, substring_match=False)
+    datasets = []
+    for name in names:
+        config, options = prepare.get_dataset_config(opt, name)
+        os.makedirs(config.out_dir, exist_ok=True)
+        datasets.append((config, MultiprocessingTokenizer(options)))
+    return datasets
+
+
+def expected_outputs(config, TOK):
+    """
+    :return: {filename: content} of the out_dir of the dataset, with the examples processed one by one
+    """
+    outputs = {}
+    vocabulary = Counter()
+    for name, filename in [('train', config.train), ('valid', config.valid), ('test', config.test)]:
+        processed = [TOK.process(ex) for ex in prepare.iter_data(filename, config.dataset)]
+        if processed:
+            outputs['{}.json'.format(name)] = '\n'.join(json.dumps(ex) for ex in processed)
+        for ex in processed:
+            update_vocab(vocabulary, ex)
+    if config.form_vocab:
+        outputs['vocab.txt'] = '\n'.join('{} {}'.format(v, i) for i, v in enumerate(get_vocab_items(vocabulary)))
+    return outputs
+
+
+def read_outputs(out_dir):
+    outputs = {}
+    for filename in os.listdir(out_dir):
+        with open(os.path.join(out_dir, filename), encoding='utf-8') as f:
+            outputs[filename] = f.read()
+    return outputs
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 100])
+def test_streamed_outputs(tmp_path, chunk_size):
+    write_kptimes(str(tmp_path), splits=('train', 'test'))
+    (config, TOK), = datasets = get_datasets(tmp_path, tmp_path / 'out', ['KPTimes'])
+    prepare.main(datasets, 1, chunk_size)
+    # no file for the missing valid split, no newline after the last example
+    assert read_outputs(config.out_dir) == expected_outputs(config, TOK)
+    assert sorted(os.listdir(config.out_dir)) == ['test.json', 'train.json', 'vocab.txt']
+
+
+def test_examples_are_read_as_they_are_written(tmp_path, monkeypatch):
+    write_kptimes(str(tmp_path))
+    (config, TOK), = datasets = get_datasets(tmp_path, tmp_path / 'out', ['KPTimes'])
+    num_read, read_ahead = [0], []
+    iter_data = prepare.iter_data
+
+    def counting_iter_data(filename, dataset_name):
+        for ex in iter_data(filename, dataset_name):
+            num_read[0] += 1
+            yield ex
+
+    def counting_update_vocab(vocabulary, ex):
+        read_ahead.append(num_read[0] - len(read_ahead))
+        update_vocab(vocabulary, ex)
+
+    monkeypatch.setattr(prepare, 'iter_data', counting_iter_data)
+    monkeypatch.setattr(prepare, 'update_vocab', counting_update_vocab)
+    workers, chunk_size = 2, 2
+    prepare.main(datasets, workers, chunk_size)
+    assert len(read_ahead) == len(KPTIMES_EXAMPLES)
+    # at most two chunks per worker are read ahead of the written examples
+    assert max(read_ahead) <= chunk_size * (2 * workers + 1)
+    monkeypatch.setattr(prepare, 'iter_data', iter_data)
+    assert read_outputs(config.out_dir) == expected_outputs(config, TOK)
+
+
+def test_kp20k_format(tmp_path):
+    write_kp20k(str(tmp_path / 'train_src.txt'), str(tmp_path / 'train_trg.txt'))
+    (config, TOK), = datasets = get_datasets(tmp_path, tmp_path / 'out', ['KP20k'])
+    prepare.main(datasets, 2, 4)
+    outputs = read_outputs(config.out_dir)
+    assert outputs == expected_outputs(config, TOK)
+    examples = [json.loads(line) for line in outputs['train.json'].split('\n')]
+    assert [ex['id'] for ex in examples] == list(range(len(KPTIMES_EXAMPLES)))
+    assert examples[0]['present_kps']['text'] == ['deep networks', 'graph learning']
+    assert '[digit]' in examples[0]['abstract']['tokenized'].split()
+
+
+def test_datasets_in_one_pool(tmp_path):
+    write_kptimes(str(tmp_path))
+    write_kp20k(str(tmp_path / 'train_src.txt'), str(tmp_path / 'train_trg.txt'))
+    write_kp20k(str(tmp_path / 'test_src.txt'), str(tmp_path / 'test_trg.txt'))
+    # a test set only, without vocab.txt
+    write_kp20k(str(tmp_path / 'word_inspec_testing_context.txt'),
+                str(tmp_path / 'word_inspec_testing_allkeywords.txt'))
+    names = ['KPTimes', 'KP20k', 'inspec']
+    outputs = []
+    for workers in [1, 2]:
+        datasets = get_datasets(tmp_path, tmp_path / 'out{}'.format(workers) / '{dataset}', names)
+        prepare.main(datasets, workers, 3)
+        outputs.append([read_outputs(config.out_dir) for config, _ in datasets])
+        # every dataset has its own vocabulary
+        assert outputs[-1] == [expected_outputs(config, TOK) for config, TOK in datasets]
+    assert outputs[0] == outputs[1]
+    assert sorted(outputs[0][1]) == ['test.json', 'train.json', 'vocab.txt']
+    assert sorted(outputs[0][2]) == ['test.json']
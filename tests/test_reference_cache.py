@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from utils import reference_cache
+from utils.evaluate import Evaluator, load_references
+from utils.reference_cache import CachedReferences, get_cache_path, get_references
+
+
+def test_cached_references_match_load_references(tmp_path, src_dir):
+    references = load_references(src_dir)
+    cached_references = get_references(src_dir, str(tmp_path / 'cache'))
+    assert isinstance(cached_references, CachedReferences)
+    assert len(cached_references) == len(references)
+    for reference, cached_reference in zip(references, cached_references):
+        assert cached_reference.stemmed_src_token_list == reference.stemmed_src_token_list
+        assert cached_reference.unique_stemmed_trg_token_2dlist == reference.unique_stemmed_trg_token_2dlist
+        assert cached_reference.is_present_trg_mask.tolist() == reference.is_present_trg_mask.tolist()
+        assert cached_reference.unique_trg_ids.tolist() == reference.unique_trg_ids.tolist()
+
+    hyp_file = os.path.join(src_dir, 'hypotheses.txt')
+    with Evaluator([5, 10, 'M']) as evaluator:
+        assert evaluator.evaluate_references(cached_references, hyp_file) == \
+            evaluator.evaluate_references(references, hyp_file)
+
+
+def test_documents_are_decoded_once(tmp_path, src_dir, monkeypatch):
+    cached_references = get_references(src_dir, str(tmp_path / 'cache'))
+    first_pass = list(cached_references)
+    monkeypatch.setattr(CachedReferences, 'decode', lambda self, idx: None)
+    assert all(a is b for a, b in zip(cached_references, first_pass))
+    assert cached_references[2] is first_pass[2]
+
+
+def test_cache_is_rebuilt_when_the_data_changes(tmp_path, src_dir):
+    cache_dir = str(tmp_path / 'cache')
+    cache_path = get_cache_path(src_dir, cache_dir)
+    get_references(src_dir, cache_dir)
+    assert os.path.isdir(cache_path)
+
+    with open(os.path.join(src_dir, 'test.target'), 'a') as fw:
+        fw.write('new target\n')
+    with open(os.path.join(src_dir, 'test.source'), 'a') as fw:
+        fw.write('a new target [sep] of a new document\n')
+    new_cache_path = get_cache_path(src_dir, cache_dir)
+    assert new_cache_path != cache_path
+    references = get_references(src_dir, cache_dir)
+    assert os.path.isdir(new_cache_path)
+    assert references[-1].unique_stemmed_trg_token_2dlist == [['new', 'target']]
+    assert references[-1].is_present_trg_mask.tolist() == [True]
+
+
+def test_content_hash_is_computed_when_the_stamp_changes(tmp_path, src_dir, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    num_hashes = []
+    compute_content_hash = reference_cache.compute_content_hash
+    monkeypatch.setattr(reference_cache, 'compute_content_hash',
+                        lambda src_dir: num_hashes.append(src_dir) or compute_content_hash(src_dir))
+    cache_path = get_cache_path(src_dir, cache_dir)
+    assert get_cache_path(src_dir, cache_dir) == cache_path
+    get_references(src_dir, cache_dir)
+    assert len(num_hashes) == 1
+
+    # a new modification time with the same content: hashed again, the same cache
+    target_file = os.path.join(src_dir, 'test.target')
+    stat = os.stat(target_file)
+    os.utime(target_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert get_cache_path(src_dir, cache_dir) == cache_path
+    assert get_cache_path(src_dir, cache_dir) == cache_path
+    assert len(num_hashes) == 2
+
+
+def test_presence_index_is_optional(tmp_path, src_dir):
+    cached_references = get_references(src_dir, str(tmp_path / 'cache'), build_presence_index=False)
+    assert all(reference.presence_index is None for reference in cached_references)
+    assert isinstance(cached_references[0].is_present_trg_mask, np.ndarray)
@@ -0,0 +1,140 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import subprocess
+import pytest
+from utils.evaluate import Evaluator
+from conftest import DOCUMENTS, encode, make_encoder, write_documents
+
+RUN_TEST = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'finetuning_fairseq',
+                        'run_test.py')
+K_LIST = [5, 10, 'M']
+DATASETS = {'inspec': DOCUMENTS, 'nus': DOCUMENTS[::-1]}
+# prints the BPE id hypotheses next to the binary data in a shuffled order, as fairseq-generate prints its batches
+FAIRSEQ_GENERATE = '''#!{}
+import os, random, sys
+data_dir = sys.argv[1]
+with open(os.path.join(data_dir, 'calls.log'), 'a') as fw:
+    fw.write(data_dir + '\\n')
+with open(os.path.join(data_dir, 'ids.txt')) as f:
+    lines = f.read().splitlines()
+order = list(range(len(lines)))
+random.Random(0).shuffle(order)
+print('2024-01-01 | INFO | fairseq_cli.generate | loading model')
+for idx in order:
+    print('S-{{}}\\tsource'.format(idx))
+    print('H-{{}}\\t-0.25\\t{{}}'.format(idx, lines[idx]))
+'''
+
+
+@pytest.fixture
+def test_env(tmp_path):
+    """
+    A save_dir with a checkpoint, the data of DATASETS, a GPT-2 style encoder.json and a fake fairseq-generate
+    on the PATH
+    """
+    encoder = make_encoder([' ;', ';'])
+    encoder_json = str(tmp_path / 'encoder.json')
+    with open(encoder_json, 'w', encoding='utf-8') as fw:
+        json.dump(encoder, fw)
+    data_root = tmp_path / 'data'
+    for dataset, documents in DATASETS.items():
+        src_dir = data_root / 'scikp' / dataset / 'fairseq'
+        data_dir = src_dir / 'gpt2_bpe' / 'binary'
+        data_dir.mkdir(parents=True)
+        write_documents(str(src_dir), documents, str(src_dir / 'hypotheses.txt'))
+        for filename in ['test.source-target.source.bin', 'dict.source.txt']:
+            (data_dir / filename).write_text(dataset)
+        with open(str(data_dir / 'ids.txt'), 'w') as fw:
+            fw.write(''.join(encode(encoder, [pred_l]) + '\n' for _, _, pred_l in documents))
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'fairseq-generate').write_text(FAIRSEQ_GENERATE.format(sys.executable))
+    (bin_dir / 'fairseq-generate').chmod(0o755)
+    save_dir = tmp_path / 'save'
+    save_dir.mkdir()
+    (save_dir / 'checkpoint_best.pt').write_bytes(b'checkpoint')
+    env = dict(os.environ, PATH='{}{}{}'.format(bin_dir, os.pathsep, os.environ['PATH']))
+    return str(data_root), str(save_dir), encoder_json, env
+
+
+def run_test(test_env, *options, check=True):
+    data_root, save_dir, encoder_json, env = test_env
+    process = subprocess.run([sys.executable, RUN_TEST, '--dataset', 'kp20k', '--datasets'] + list(DATASETS) +
+                             ['--save_dir', save_dir, '--data_root', data_root, '--bpe_encoder_json', encoder_json,
+                              '--workers', '2'] + list(options),
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if check:
+        assert process.returncode == 0, process.stderr
+    return process
+
+
+def get_stages(output, status):
+    return sorted(line.split(']')[0][1:] for line in output.splitlines() if line.endswith('] ' + status))
+
+
+def get_calls(data_root):
+    calls = []
+    for dataset in DATASETS:
+        calls_log = os.path.join(data_root, 'scikp', dataset, 'fairseq', 'gpt2_bpe', 'binary', 'calls.log')
+        if os.path.exists(calls_log):
+            with open(calls_log) as f:
+                calls += [dataset] * len(f.readlines())
+    return sorted(calls)
+
+
+def test_stages_are_skipped(test_env):
+    data_root, save_dir, _, _ = test_env
+    all_stages = sorted('{}/{}'.format(dataset, stage) for dataset in DATASETS
+                        for stage in ['generate', 'text_decode'])
+    output = run_test(test_env, '--k_list', '5', '10', 'M').stdout
+    assert get_stages(output, 'running') == all_stages
+    assert get_calls(data_root) == sorted(DATASETS)
+    for dataset, documents in DATASETS.items():
+        src_dir = os.path.join(data_root, 'scikp', dataset, 'fairseq')
+        results_file = os.path.join(save_dir, 'results_log_{}.txt'.format(dataset))
+        with Evaluator(K_LIST) as evaluator:
+            evaluator.evaluate_src_dir(src_dir, os.path.join(src_dir, 'hypotheses.txt'), results_file + '.expected')
+        with open(results_file) as f1, open(results_file + '.expected') as f2:
+            assert f1.read() == f2.read()
+        with open(os.path.join(save_dir, '{}_hypotheses.txt'.format(dataset))) as f:
+            assert f.read() == ''.join(pred_l + '\n' for _, _, pred_l in documents)
+    assert os.path.exists(os.path.join(save_dir, 'results_kp20k.tsv'))
+
+    # everything is up to date
+    output = run_test(test_env, '--k_list', '5', '10', 'M').stdout
+    assert get_stages(output, 'running') == []
+    assert get_calls(data_root) == sorted(DATASETS)
+
+    # other k values, only the saved hypotheses are scored again
+    output = run_test(test_env, '--k_list', '5').stdout
+    assert get_stages(output, 'running') == ['{}/evaluate'.format(dataset) for dataset in sorted(DATASETS)]
+    assert get_calls(data_root) == sorted(DATASETS)
+    with open(os.path.join(save_dir, 'inspec_metrics.json')) as f:
+        assert not any('@10' in field for field in json.load(f))
+
+    # a deleted output is computed again
+    os.remove(os.path.join(save_dir, 'nus_hypotheses.txt'))
+    assert get_stages(run_test(test_env, '--k_list', '5').stdout, 'running') == ['nus/text_decode']
+
+    # a new checkpoint, everything is generated again, the same hypotheses are not decoded again
+    with open(os.path.join(save_dir, 'checkpoint_best.pt'), 'ab') as fw:
+        fw.write(b'new')
+    assert get_stages(run_test(test_env, '--k_list', '5').stdout, 'running') == \
+        ['{}/generate'.format(dataset) for dataset in sorted(DATASETS)]
+    assert get_calls(data_root) == sorted(list(DATASETS) * 2)
+
+    # --force reruns the stages that are up to date
+    assert get_stages(run_test(test_env, '--k_list', '5', '--force').stdout, 'running') == all_stages
+
+
+def test_missing_encoder_json(test_env):
+    data_root = test_env[0]
+    missing_encoder_json = os.path.join(os.path.dirname(data_root), 'missing', 'encoder.json')
+    process = run_test(test_env[:2] + (missing_encoder_json,) + test_env[3:], check=False)
+    assert process.returncode == 2
+    assert '--bpe_encoder_json {} does not exist'.format(missing_encoder_json) in process.stderr
+    assert get_calls(data_root) == []
@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+from utils.score_table import ScoreTable, TAGS, load_score_table, load_match_vectors
+
+K_LIST = [5, 10, 'M']
+NUM_DOCUMENTS = 37
+
+
+@pytest.fixture
+def document_scores():
+    """
+    :return: random scores [doc, tag, k, SCORE_FIELDS] and counts [doc, tag, k, COUNT_FIELDS] of the documents
+    """
+    rng = np.random.default_rng(0)
+    return (rng.random((NUM_DOCUMENTS, len(TAGS), len(K_LIST), 3)),
+            rng.integers(0, 10, size=(NUM_DOCUMENTS, len(TAGS), len(K_LIST), 3)))
+
+
+def add_documents(table, document_scores, documents):
+    scores, counts = document_scores
+    for doc in documents:
+        row = table.add_row()
+        for tag_idx, tag in enumerate(TAGS):
+            table.set_scores(row, tag, scores[doc, tag_idx, :, 0], scores[doc, tag_idx, :, 1],
+                             scores[doc, tag_idx, :, 2], counts[doc, tag_idx, :, 0], counts[doc, tag_idx, :, 1],
+                             counts[doc, tag_idx, 0, 2], doc)
+    return table
+
+
+@pytest.mark.parametrize('keep_rows', [True, False])
+def test_totals_match_sum(document_scores, keep_rows):
+    scores, counts = document_scores
+    # a small capacity, the buffer grows (keep_rows) or is folded several times
+    table = add_documents(ScoreTable(K_LIST, capacity=4, keep_rows=keep_rows), document_scores, range(NUM_DOCUMENTS))
+    assert table.num_documents == NUM_DOCUMENTS
+    score_totals, count_totals = table.totals()
+    for tag_idx in range(len(TAGS)):
+        for k_idx in range(len(K_LIST)):
+            for field in range(3):
+                # bit-identical to the sum() over the lists of the former score_dict
+                assert score_totals[tag_idx, k_idx, field] == sum(scores[:, tag_idx, k_idx, field].tolist())
+    assert count_totals[:, :, :2].tolist() == counts.sum(axis=0)[:, :, :2].tolist()
+    num_targets, num_predictions = table.get_num_keyphrases('present')
+    assert num_targets.tolist() == counts[:, TAGS.index('present'), 0, 2].tolist()
+    assert num_predictions.tolist() == list(range(NUM_DOCUMENTS))
+
+
+@pytest.mark.parametrize('keep_rows', [True, False])
+def test_merge_of_chunks_matches_one_table(document_scores, keep_rows):
+    expected = add_documents(ScoreTable(K_LIST), document_scores, range(NUM_DOCUMENTS))
+    table = ScoreTable(K_LIST, capacity=4, keep_rows=keep_rows)
+    for start in range(0, NUM_DOCUMENTS, 10):
+        chunk_documents = range(start, min(start + 10, NUM_DOCUMENTS))
+        table.merge(add_documents(ScoreTable(K_LIST, capacity=len(chunk_documents)), document_scores,
+                                  chunk_documents))
+    assert all(np.array_equal(a, b) for a, b in zip(table.totals(), expected.totals()))
+    assert np.array_equal(table.num_matches[:NUM_DOCUMENTS], expected.num_matches[:NUM_DOCUMENTS])
+    assert np.array_equal(table.f1_scores[:NUM_DOCUMENTS], expected.f1_scores[:NUM_DOCUMENTS])
+
+
+def test_reorder(document_scores):
+    expected = add_documents(ScoreTable(K_LIST), document_scores, range(NUM_DOCUMENTS))
+    # documents scored out of order, e.g. in the order they were generated
+    order = np.random.default_rng(1).permutation(NUM_DOCUMENTS)
+    table = add_documents(ScoreTable(K_LIST, capacity=4), document_scores, order)
+    table.reorder(np.argsort(order))
+    for name in ('scores', 'counts', 'num_keyphrases', 'num_matches', 'f1_scores'):
+        assert np.array_equal(getattr(table, name)[:NUM_DOCUMENTS], getattr(expected, name)[:NUM_DOCUMENTS])
+
+
+def test_save_and_load(tmp_path, document_scores):
+    table = add_documents(ScoreTable(K_LIST, capacity=4), document_scores, range(NUM_DOCUMENTS))
+    table.save(str(tmp_path / 'scores.npz'))
+    loaded = load_score_table(str(tmp_path / 'scores.npz'))
+    assert loaded.k_list == K_LIST
+    assert all(np.array_equal(a, b) for a, b in zip(loaded.totals(), table.totals()))
+    assert np.array_equal(loaded.num_matches, table.num_matches[:NUM_DOCUMENTS])
+
+    table.save_match_vectors(str(tmp_path / 'matches.npy'))
+    match_vectors = load_match_vectors(str(tmp_path / 'matches.npy'))
+    assert len(match_vectors) == NUM_DOCUMENTS
+    assert match_vectors['hits@M_absent'].tolist() == \
+        table.num_matches[:NUM_DOCUMENTS, TAGS.index('absent'), K_LIST.index('M')].tolist()
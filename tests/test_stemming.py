@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from nltk.stem.porter import PorterStemmer
+from utils.stemming import CachedStemmer
+
+WORDS = ['Networks', 'networks ', 'running', 'RAN', '[digit]', '[unk]', 'graph_networks', '', 'é', 'learning']
+
+
+def test_cached_stemmer_matches_porter_stemmer():
+    porter = PorterStemmer()
+    expected = [porter.stem(w.strip().lower()) for w in WORDS]
+    stemmer = CachedStemmer(max_size=3)
+    # the cache is smaller than the vocabulary, entries are evicted and stemmed again
+    for _ in range(2):
+        assert [stemmer.stem(w) for w in WORDS] == expected
+        assert stemmer.stem_tokens(WORDS) == expected
+    assert len(stemmer.cache) == 3
+
+
+def test_stem_tokens_counts_every_token():
+    stemmer = CachedStemmer()
+    stemmer.stem_tokens(['networks', 'networks', 'graphs'])
+    assert (stemmer.hits, stemmer.misses) == (1, 2)
+
+
+def test_stem_table_round_trip(tmp_path):
+    path = str(tmp_path / 'stems.json')
+    stemmer = CachedStemmer()
+    stemmer.stem_tokens(WORDS)
+    stemmer.save(path)
+    loaded = CachedStemmer()
+    assert loaded.load(path) == len(stemmer.cache)
+    assert loaded.cache == stemmer.cache
+    assert CachedStemmer().load(str(tmp_path / 'missing.json')) == 0
+
+
+def test_stem_table_load_counts_inserted_entries(tmp_path):
+    path = str(tmp_path / 'stems.json')
+    with open(path, 'w', encoding='utf-8') as fw:
+        json.dump({'networks': 'network', 'running': 'run', 'graphs': 'graph'}, fw)
+    stemmer = CachedStemmer(max_size=2)
+    stemmer.stem('running')
+    assert stemmer.load(path) == 1
+    assert len(stemmer.cache) == 2
+    assert stemmer.stem('networks') == 'network'
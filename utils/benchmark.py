@@ -0,0 +1,199 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gc
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from utils.evaluate import (stem_str_list, filter_prediction, separate_present_absent_by_source, compute_match_result,
+                            compute_classification_metrics_at_ks, check_present_keyphrases, main,
+                            INVALIDATE_UNK, DISABLE_EXTRA_ONE_WORD_FILTER)
+from utils.constants import TITLE_SEP
+from utils.metrics_sink import get_peak_rss_mb
+from utils.stemming import clear_cache
+from utils.synthetic_corpus import SyntheticCorpus
+
+
+def tokenize_corpus(corpus):
+    """
+    Split the synthetic documents the way evaluate.py does before stemming
+    :return: per document (source tokens, target token 2dlist, prediction token 2dlist), and the raw
+             (hypotheses, references, sources) lists taken by evaluate.main()
+    """
+    documents = []
+    hypotheses, references, sources = [], [], []
+    for source, target_line, hypothesis_line in corpus:
+        src_token_list = source.replace(TITLE_SEP, ' ').split()
+        trg_str_list = [kp.strip() for kp in target_line.split(';')]
+        pred_str_list = [kp.strip() for kp in hypothesis_line.split(';')]
+        documents.append((src_token_list, [kp.split(' ') for kp in trg_str_list],
+                          [kp.split(' ') for kp in pred_str_list]))
+        hypotheses.append(pred_str_list)
+        references.append(trg_str_list)
+        sources.append(source)
+    return documents, (hypotheses, references, sources)
+
+
+def prepare_stage_inputs(documents):
+    """
+    Run the stages once so that every benchmark gets the input the evaluator would give it
+    """
+    stage_inputs = []
+    for src_token_list, trg_token_2dlist, pred_token_2dlist in documents:
+        stemmed_src = stem_str_list([src_token_list])[0]
+        stemmed_trgs = stem_str_list(trg_token_2dlist)
+        stemmed_preds = stem_str_list(pred_token_2dlist)
+        filtered_preds, _, _ = filter_prediction(INVALIDATE_UNK, DISABLE_EXTRA_ONE_WORD_FILTER, stemmed_preds)
+        is_match = compute_match_result(stemmed_trgs, filtered_preds, type='exact', dimension=1)
+        stage_inputs.append((stemmed_src, stemmed_trgs, stemmed_preds, filtered_preds, is_match))
+    return stage_inputs
+
+
+def get_benchmarks(documents, stage_inputs, predictions, k_list):
+    """
+    :return: list of (name, function running the stage over all the documents)
+    """
+
+    def run_stem_str_list():
+        # cold cache, every document stems its predictions as in a fresh evaluation
+        clear_cache()
+        for _, _, pred_token_2dlist in documents:
+            stem_str_list(pred_token_2dlist)
+
+    def run_filter_prediction():
+        for _, _, stemmed_preds, _, _ in stage_inputs:
+            filter_prediction(INVALIDATE_UNK, DISABLE_EXTRA_ONE_WORD_FILTER, stemmed_preds)
+
+    def run_separate_present_absent_by_source():
+        for stemmed_src, _, _, filtered_preds, _ in stage_inputs:
+            is_present_mask = check_present_keyphrases(stemmed_src, filtered_preds, False)
+            separate_present_absent_by_source(stemmed_src, filtered_preds, False, is_present_mask)
+
+    def run_compute_match_result():
+        for _, stemmed_trgs, _, filtered_preds, _ in stage_inputs:
+            compute_match_result(stemmed_trgs, filtered_preds, type='exact', dimension=1)
+
+    def run_compute_classification_metrics_at_ks():
+        for _, stemmed_trgs, _, filtered_preds, is_match in stage_inputs:
+            compute_classification_metrics_at_ks(is_match, len(filtered_preds), len(stemmed_trgs), k_list=k_list)
+
+    def run_main():
+        clear_cache()
+        out_dir = tempfile.mkdtemp(prefix='kp_benchmark_')
+        try:
+            main(predictions, out_dir, 'benchmark', k_list,
+                 prediction_file=os.path.join(out_dir, 'benchmark_predictions.txt'))
+        finally:
+            shutil.rmtree(out_dir)
+
+    return [
+        ('stem_str_list', run_stem_str_list),
+        ('filter_prediction', run_filter_prediction),
+        ('separate_present_absent_by_source', run_separate_present_absent_by_source),
+        ('compute_match_result', run_compute_match_result),
+        ('compute_classification_metrics_at_ks', run_compute_classification_metrics_at_ks),
+        ('main', run_main),
+    ]
+
+
+def time_benchmark(function, num_documents, repeat):
+    """
+    Best wall-clock time of repeat runs, then one more run under tracemalloc for the peak memory
+    (tracemalloc slows the run down, so it is not timed)
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = min(timings)
+    return {'seconds': seconds, 'docs_per_sec': num_documents / seconds, 'peak_memory_mb': peak_bytes / (1 << 20)}
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    :return: the comparison table and the names of the benchmarks that got slower by more than tolerance
+    """
+    output_str = "{:<40}{:>14}{:>14}{:>10}\n".format('benchmark', 'docs/sec', 'baseline', 'speedup')
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            output_str += "{:<40}{:>14.1f}{:>14}{:>10}\n".format(name, result['docs_per_sec'], '-', '-')
+            continue
+        speedup = result['docs_per_sec'] / baseline_result['docs_per_sec']
+        if speedup < 1 - tolerance:
+            regressions.append(name)
+        output_str += "{:<40}{:>14.1f}{:>14.1f}{:>9.2f}x{}\n".format(
+            name, result['docs_per_sec'], baseline_result['docs_per_sec'], speedup,
+            '  REGRESSION' if speedup < 1 - tolerance else '')
+    return output_str, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the evaluator on a deterministic synthetic corpus')
+    parser.add_argument('--num_documents', type=int, default=2000, help="Number of synthetic documents")
+    parser.add_argument('--num_predictions', type=int, default=200, help="Number of predictions per document")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values for evaluation')
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs, the best one is reported")
+    parser.add_argument('--benchmarks', nargs='+', default=None, help="Run only these benchmarks")
+    parser.add_argument('--baseline_file', type=str, default=None,
+                        help="json file of an earlier run to compare against")
+    parser.add_argument('--save_baseline', action='store_true', help="Write the results to --baseline_file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Slowdown relative to the baseline that is reported as a regression")
+    parser.add_argument('--out_file', type=str, default=None, help="Path of a json file to write the results to")
+    args = parser.parse_args()
+    k_list = [topk if topk in ['M', 'G'] else int(topk) for topk in args.k_list]
+
+    corpus = SyntheticCorpus(args.num_documents, args.num_predictions, args.seed)
+    documents, predictions = tokenize_corpus(corpus)
+    stage_inputs = prepare_stage_inputs(documents)
+
+    results = {
+        'config': {'num_documents': args.num_documents, 'num_predictions': args.num_predictions,
+                   'seed': args.seed, 'k_list': [str(topk) for topk in k_list]},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'machine': platform.machine(), 'processor': platform.processor()},
+        'benchmarks': {}
+    }
+    for name, function in get_benchmarks(documents, stage_inputs, predictions, k_list):
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        results['benchmarks'][name] = time_benchmark(function, args.num_documents, args.repeat)
+        print("{:<40}{:>10.3f}s{:>14.1f} docs/sec{:>10.1f} MB".format(
+            name, results['benchmarks'][name]['seconds'], results['benchmarks'][name]['docs_per_sec'],
+            results['benchmarks'][name]['peak_memory_mb']))
+    results['peak_rss_mb'] = get_peak_rss_mb()['self']
+
+    if args.out_file:
+        with open(args.out_file, 'w') as fw:
+            json.dump(results, fw, indent=2)
+
+    if args.baseline_file and args.save_baseline:
+        with open(args.baseline_file, 'w') as fw:
+            json.dump(results, fw, indent=2)
+        print('Baseline saved to {}'.format(args.baseline_file))
+    elif args.baseline_file:
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['config'] != results['config']:
+            print('Warning: the baseline was run with {}'.format(baseline['config']))
+        comparison_str, regressions = compare_to_baseline(results, baseline, args.tolerance)
+        print(comparison_str, end='')
+        if regressions:
+            sys.exit('Regressions: {}'.format(', '.join(regressions)))
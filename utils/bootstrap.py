@@ -0,0 +1,133 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import numpy as np
+from utils.score_table import TAGS, load_score_table
+
+# number of (resample, document) entries drawn at once, bounds the memory of a block of resamples
+BLOCK_ENTRIES = 1 << 22
+
+
+def bootstrap_means(values, num_resamples=10000, seed=0):
+    """
+    Column means of num_resamples bootstrap resamples of the documents (rows) of values.
+    Every block of resamples is one [block, num_documents] index matrix, turned into a matrix of
+    how often each document was drawn, the means of the whole block are then a single matrix product.
+    :param values: a np float array with size [num_documents, num_columns]
+    :return: a np float array with size [num_resamples, num_columns]
+    """
+    rng = np.random.default_rng(seed)
+    num_documents = values.shape[0]
+    block_size = max(1, min(num_resamples, BLOCK_ENTRIES // num_documents))
+    means = np.empty((num_resamples, values.shape[1]))
+    for start in range(0, num_resamples, block_size):
+        num_block_resamples = min(block_size, num_resamples - start)
+        indices = rng.integers(0, num_documents, size=(num_block_resamples, num_documents))
+        indices += np.arange(num_block_resamples)[:, None] * num_documents
+        draw_counts = np.bincount(indices.ravel(), minlength=num_block_resamples * num_documents)
+        draw_counts = draw_counts.reshape(num_block_resamples, num_documents).astype(np.float64)
+        means[start:start + num_block_resamples] = draw_counts @ values / num_documents
+    return means
+
+
+def compute_macro_f1(macro_precision, macro_recall):
+    """
+    F1 of the macro averaged precision and recall, as reported by evaluate.py
+    """
+    denominator = macro_precision + macro_recall
+    return np.divide(2 * macro_precision * macro_recall, denominator,
+                     out=np.zeros_like(denominator, dtype=np.float64), where=denominator > 0)
+
+
+def get_precision_recall_columns(score_table, topk_list, tags):
+    """
+    :return: a np float array with size [num_documents, 2 * len(tags) * len(topk_list)],
+             the per-document precision and recall of every (tag, topk)
+    """
+    assert score_table.num_rows == score_table.num_documents, \
+        "the per-document scores are needed, evaluate without --streaming"
+    scores = score_table.scores[:score_table.num_rows]
+    columns = []
+    for tag in tags:
+        for topk in topk_list:
+            tag_scores = scores[:, TAGS.index(tag), score_table.k_list.index(topk)]
+            columns += [tag_scores[:, 0], tag_scores[:, 1]]
+    return np.stack(columns, axis=1)
+
+
+def compare_score_tables(score_table_a, score_table_b, topk_list=[5, 'M'], tags=('present', 'absent'),
+                         num_resamples=10000, confidence=0.95, seed=0):
+    """
+    Bootstrap confidence intervals of the macro F1@k of two systems, and paired bootstrap tests of their
+    difference. Both systems are scored on the same resamples of the documents.
+    The p-value is the fraction of resamples whose difference, shifted to the null hypothesis,
+    is at least as extreme as the observed difference (two-sided).
+    :return: a list of dict, one per (tag, topk)
+    """
+    assert score_table_a.num_documents == score_table_b.num_documents, \
+        "both systems should be evaluated on the same documents"
+    values = np.concatenate([get_precision_recall_columns(score_table_a, topk_list, tags),
+                             get_precision_recall_columns(score_table_b, topk_list, tags)], axis=1)
+    num_documents = values.shape[0]
+    # rows are added one after another, the same as the totals of the score table
+    observed_means = np.cumsum(values, axis=0)[-1] / num_documents
+    resampled_means = bootstrap_means(values, num_resamples, seed)
+    offset_b = values.shape[1] // 2
+    percentiles = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+
+    rows = []
+    column = 0
+    for tag in tags:
+        for topk in topk_list:
+            f1_a = compute_macro_f1(resampled_means[:, column], resampled_means[:, column + 1])
+            f1_b = compute_macro_f1(resampled_means[:, offset_b + column], resampled_means[:, offset_b + column + 1])
+            observed_f1_a = float(compute_macro_f1(observed_means[column], observed_means[column + 1]))
+            observed_f1_b = float(compute_macro_f1(observed_means[offset_b + column],
+                                                   observed_means[offset_b + column + 1]))
+            observed_delta = observed_f1_a - observed_f1_b
+            delta = f1_a - f1_b
+            num_extreme = np.count_nonzero(np.abs(delta - observed_delta) >= abs(observed_delta))
+            rows.append({
+                'metric': 'F1@{}_{}'.format(topk, tag),
+                'f1_a': observed_f1_a,
+                'ci_a': np.percentile(f1_a, percentiles).tolist(),
+                'f1_b': observed_f1_b,
+                'ci_b': np.percentile(f1_b, percentiles).tolist(),
+                'delta': observed_delta,
+                'ci_delta': np.percentile(delta, percentiles).tolist(),
+                'p_value': float(num_extreme + 1) / (num_resamples + 1)
+            })
+            column += 2
+    return rows
+
+
+def report_comparison(rows, name_a, name_b, confidence=0.95):
+    output_str = "Paired bootstrap: {} (a) vs {} (b), {:.0%} confidence intervals\n".format(name_a, name_b, confidence)
+    for row in rows:
+        output_str += ("{}:\ta={:.5} [{:.5}, {:.5}]\tb={:.5} [{:.5}, {:.5}]\t"
+                       "a-b={:.5} [{:.5}, {:.5}]\tp={:.4}\n").format(
+            row['metric'], row['f1_a'], *row['ci_a'], row['f1_b'], *row['ci_b'],
+            row['delta'], *row['ci_delta'], row['p_value'])
+    return output_str
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals and paired tests of two systems')
+    parser.add_argument('--score_files', nargs=2, required=True,
+                        help="Per-document score tables of the two systems (evaluate.py --score_file)")
+    parser.add_argument('--names', nargs=2, default=None, help="Names of the two systems")
+    parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values to compare')
+    parser.add_argument('--num_resamples', type=int, default=10000, help="Number of bootstrap resamples")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level of the intervals")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the resampling")
+    args = parser.parse_args()
+
+    names = args.names if args.names else args.score_files
+    k_list = [topk if topk in ['M', 'G'] else int(topk) for topk in args.k_list]
+    rows = compare_score_tables(load_score_table(args.score_files[0]), load_score_table(args.score_files[1]),
+                                k_list, num_resamples=args.num_resamples, confidence=args.confidence,
+                                seed=args.seed)
+    print(report_comparison(rows, names[0], names[1], args.confidence), end='')
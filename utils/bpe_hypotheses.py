@@ -0,0 +1,117 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from utils.constants import KP_SEP
+from utils.evaluate import clean_keyphrases, stem_word_list
+
+# number of keyphrases scored per document, as in score_prediction()
+MAX_NUM_PREDICTIONS = 200
+DEFAULT_CACHE_SIZE = 1 << 20
+
+
+def bytes_to_unicode():
+    """
+    The byte to unicode character table of the GPT-2 BPE vocabulary (encoder.json), the same as
+    fairseq.data.encoders.gpt2_bpe_utils.bytes_to_unicode
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + \
+        list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(n) for n in cs]))
+
+
+def build_token_bytes(encoder):
+    """
+    :param encoder: dict from the GPT-2 BPE token to its id, the content of encoder.json
+    :return: dict from the BPE id, as written by fairseq-generate, to the bytes it decodes to
+    """
+    byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+    return {str(bpe_id): bytes(byte_decoder[c] for c in token) for token, bpe_id in encoder.items()}
+
+
+def load_token_bytes(encoder_json):
+    """
+    :param encoder_json: path of the GPT-2 encoder.json (models/gpt2_bpe/encoder.json, see preprocess.sh)
+    """
+    with open(encoder_json, encoding='utf-8') as f:
+        return build_token_bytes(json.load(f))
+
+
+def decode_bpe_ids(token_bytes, bpe_ids):
+    """
+    The same text as GPT2BPE.decode, one lookup per id instead of one per character
+    :param token_bytes: see build_token_bytes()
+    :param bpe_ids: list of BPE ids as strings, symbols of the fairseq dictionary (e.g. <unk>) are kept as they are
+    """
+    return b''.join(token_bytes[bpe_id] if bpe_id in token_bytes else bpe_id.encode('utf-8')
+                    for bpe_id in bpe_ids).decode('utf-8', errors='replace')
+
+
+class BPEHypothesisParser(object):
+    """
+    Reads the hypotheses written by fairseq-generate, GPT-2 BPE ids, directly into stemmed keyphrases.
+    The id sequence is split into keyphrases on the ids of KP_SEP, and every keyphrase is decoded, tokenized
+    and stemmed once, later occurrences of the same id sequence are a lookup. The keyphrases are the same
+    as those of the decoded text (fairseq_gpt2_decode.py) read by evaluate.py.
+    """
+
+    def __init__(self, encoder_json, max_cache_size=DEFAULT_CACHE_SIZE):
+        self.token_bytes = load_token_bytes(encoder_json)
+        # ids decoding to KP_SEP with whitespace, e.g. ' ;'
+        self.sep_ids = {bpe_id for bpe_id, token in self.token_bytes.items()
+                        if token.strip() == KP_SEP.encode('utf-8')}
+        # other ids holding a KP_SEP, e.g. ';)', the keyphrase split of such lines is done on the decoded text
+        self.merged_sep_ids = {bpe_id for bpe_id, token in self.token_bytes.items()
+                               if KP_SEP.encode('utf-8') in token and bpe_id not in self.sep_ids}
+        self.max_cache_size = max_cache_size
+        self.cache = {}
+
+    def decode(self, bpe_ids):
+        return decode_bpe_ids(self.token_bytes, bpe_ids)
+
+    def split_keyphrases(self, bpe_ids):
+        """
+        :return: the id tuples of the keyphrases, at most MAX_NUM_PREDICTIONS
+        """
+        keyphrases = []
+        start_idx = 0
+        for idx, bpe_id in enumerate(bpe_ids):
+            if bpe_id in self.sep_ids:
+                keyphrases.append(tuple(bpe_ids[start_idx:idx]))
+                if len(keyphrases) == MAX_NUM_PREDICTIONS:
+                    return keyphrases
+                start_idx = idx + 1
+        keyphrases.append(tuple(bpe_ids[start_idx:]))
+        return keyphrases
+
+    def parse_keyphrase(self, keyphrase_ids):
+        parsed = self.cache.get(keyphrase_ids)
+        if parsed is None:
+            pred_token_list = clean_keyphrases(self.decode(keyphrase_ids))[0].strip().split(' ')
+            parsed = (pred_token_list, stem_word_list(pred_token_list))
+            if len(self.cache) >= self.max_cache_size:
+                del self.cache[next(iter(self.cache))]
+            self.cache[keyphrase_ids] = parsed
+        return parsed
+
+    def __call__(self, line):
+        """
+        :param line: BPE ids separated by spaces, one line of the fairseq-generate hypotheses
+        :return: the keyphrase token 2dlist and the stemmed one, as score_tokenized_prediction() takes them
+        """
+        bpe_ids = line.split()
+        if not self.merged_sep_ids.isdisjoint(bpe_ids):
+            pred_token_2dlist = [kp.strip().split(' ')
+                                 for kp in clean_keyphrases(self.decode(bpe_ids))[:MAX_NUM_PREDICTIONS]]
+            return pred_token_2dlist, [stem_word_list(token_list) for token_list in pred_token_2dlist]
+        parsed_keyphrases = [self.parse_keyphrase(keyphrase_ids) for keyphrase_ids in self.split_keyphrases(bpe_ids)]
+        return [parsed[0] for parsed in parsed_keyphrases], [parsed[1] for parsed in parsed_keyphrases]
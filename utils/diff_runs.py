@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import numpy as np
+from utils.score_table import load_match_vectors
+
+
+def diff_match_vectors(match_vectors_a, match_vectors_b, topk=5, tag='present'):
+    """
+    Per-document change of F1@k and of the number of hits@k from run a to run b.
+    Only the two columns that are compared are read from the memory-mapped files.
+    :return: document indices sorted by decreasing F1 change, and the f1/hits arrays of both runs
+    """
+    assert len(match_vectors_a) == len(match_vectors_b), "both runs should be evaluated on the same documents"
+    f1_field, hits_field = 'f1@{}_{}'.format(topk, tag), 'hits@{}_{}'.format(topk, tag)
+    assert f1_field in match_vectors_a.dtype.names and f1_field in match_vectors_b.dtype.names, \
+        "{} is not in the match vectors, evaluate with --k_list including {}".format(f1_field, topk)
+    f1_a, f1_b = np.asarray(match_vectors_a[f1_field]), np.asarray(match_vectors_b[f1_field])
+    hits_a, hits_b = np.asarray(match_vectors_a[hits_field]), np.asarray(match_vectors_b[hits_field])
+    delta = f1_b.astype(np.float64) - f1_a
+    # stable sort, documents with the same change stay in document order
+    order = np.argsort(-delta, kind='stable')
+    return order, delta, (f1_a, f1_b), (hits_a, hits_b)
+
+
+def report_diff(match_vectors_a, match_vectors_b, topk=5, tag='present', top=20):
+    order, delta, (f1_a, f1_b), (hits_a, hits_b) = diff_match_vectors(match_vectors_a, match_vectors_b, topk, tag)
+    num_targets = np.asarray(match_vectors_b['num_targets_{}'.format(tag)])
+    num_gained, num_lost = int(np.count_nonzero(delta > 0)), int(np.count_nonzero(delta < 0))
+    output_str = "F1@{}_{}: {} documents gained, {} lost, {} unchanged (mean change {:.5})\n".format(
+        topk, tag, num_gained, num_lost, len(delta) - num_gained - num_lost, float(delta.mean()) if len(delta) else 0.0)
+    header = "doc\tf1_a\tf1_b\tdelta\thits_a\thits_b\tnum_targets\n"
+
+    def rows(indices):
+        return ''.join("{}\t{:.4f}\t{:.4f}\t{:+.4f}\t{}\t{}\t{}\n".format(
+            idx, f1_a[idx], f1_b[idx], delta[idx], hits_a[idx], hits_b[idx], num_targets[idx]) for idx in indices)
+
+    output_str += "Top gains\n" + header + rows(order[:min(top, num_gained)])
+    losses = np.argsort(delta, kind='stable')
+    output_str += "Top losses\n" + header + rows(losses[:min(top, num_lost)])
+    return output_str
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the documents whose scores changed between two runs')
+    parser.add_argument('--match_files', nargs=2, required=True,
+                        help="Match vectors of the old and the new run (evaluate.py --match_file)")
+    parser.add_argument('--k', type=str, default='5', help="K of the compared F1@k")
+    parser.add_argument('--tag', type=str, default='present', choices=['all', 'present', 'absent'])
+    parser.add_argument('--top', type=int, default=20, help="Number of gained and lost documents to list")
+    parser.add_argument('--out_file', type=str, default=None,
+                        help="If given, the change of every document is written to this tsv file, sorted")
+    args = parser.parse_args()
+
+    match_vectors_a, match_vectors_b = load_match_vectors(args.match_files[0]), load_match_vectors(args.match_files[1])
+    print(report_diff(match_vectors_a, match_vectors_b, args.k, args.tag, args.top), end='')
+    if args.out_file:
+        order, delta, (f1_a, f1_b), (hits_a, hits_b) = diff_match_vectors(match_vectors_a, match_vectors_b,
+                                                                           args.k, args.tag)
+        np.savetxt(args.out_file, np.stack([order, f1_a[order], f1_b[order], delta[order], hits_a[order],
+                                            hits_b[order]], axis=1),
+                   fmt=['%d', '%.4f', '%.4f', '%+.4f', '%d', '%d'], delimiter='\t',
+                   header='doc\tf1_a\tf1_b\tdelta\thits_a\thits_b', comments='')
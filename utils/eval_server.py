@@ -0,0 +1,248 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import time
+import socket
+import logging
+import argparse
+import http.client
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from utils.evaluate import Evaluator, load_references, process_input_ks
+from utils.stemming import cache_info
+
+logger = logging.getLogger()
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+class EvaluationService(object):
+    """
+    Reference sets stay in memory once loaded, as prepared ReferenceDocuments with their presence index,
+    the stem cache is the process-wide one of utils.stemming
+    """
+
+    def __init__(self, k_list=[5, 'M'], cache_dir=None, stem_table=None):
+        """
+        :param cache_dir: if given, references are read from reference caches (see reference_cache.py)
+        :param stem_table: path of an on-disk stem table, loaded now and updated by close()
+        """
+        self.k_list = process_input_ks(k_list)
+        self.cache_dir = cache_dir
+        self.references = {}
+        self.evaluators = {}
+        self.default_evaluator = self.get_evaluator(self.k_list, stem_table=stem_table)
+
+    def get_evaluator(self, k_list, stem_table=None):
+        k_list = process_input_ks(k_list)
+        key = tuple(str(topk) for topk in k_list)
+        if key not in self.evaluators:
+            self.evaluators[key] = Evaluator(k_list, stem_table=stem_table)
+        return self.evaluators[key]
+
+    def get_references(self, src_dir):
+        src_dir = os.path.abspath(src_dir)
+        if src_dir not in self.references:
+            start_time = time.time()
+            # every document of a reference cache is decoded now, not at each request
+            references = list(load_references(src_dir, cache_dir=self.cache_dir))
+            self.references[src_dir] = references
+            logger.info('Loaded {} references of {} in {:.1f}s'.format(len(references), src_dir,
+                                                                       time.time() - start_time))
+        return self.references[src_dir]
+
+    def evaluate(self, request):
+        """
+        :param request: dict with
+            src_dir:        directory with test.source and test.target
+            hypotheses:     list of hypothesis lines (or hyp_file: path of a _hypotheses.txt file)
+            ids:            optional, indices of the documents the hypotheses belong to, default all in order
+            k_list:         optional, K values for evaluation
+            results_file, prediction_file: optional output paths
+        :return: dict from the reported fields to their values
+        """
+        references = self.get_references(request['src_dir'])
+        if request.get('ids') is not None:
+            references = [references[idx] for idx in request['ids']]
+        if request.get('hypotheses') is not None:
+            hypotheses = request['hypotheses']
+        else:
+            with open(request['hyp_file']) as f:
+                hypotheses = f.readlines()
+        assert len(hypotheses) == len(references), \
+            "expected {} hypotheses, got {}".format(len(references), len(hypotheses))
+        evaluator = self.get_evaluator(request['k_list']) if request.get('k_list') else self.default_evaluator
+        return evaluator.evaluate_hypotheses(references, hypotheses, request.get('results_file'),
+                                             request.get('prediction_file'), disable_progress_bar=True)
+
+    def status(self):
+        return {
+            'reference_sets': {src_dir: len(references) for src_dir, references in self.references.items()},
+            'stem_cache': cache_info()
+        }
+
+    def close(self):
+        for evaluator in self.evaluators.values():
+            evaluator.close()
+
+
+class EvaluationRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /evaluate  json request of EvaluationService.evaluate(), returns the metrics as json
+    POST /load      {"src_dir": ...}, loads a reference set ahead of the first evaluation
+    GET /status     loaded reference sets and stem cache statistics
+    """
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            start_time = time.time()
+            if self.path == '/evaluate':
+                response = self.server.service.evaluate(request)
+            elif self.path == '/load':
+                response = {'num_documents': len(self.server.service.get_references(request['src_dir']))}
+            else:
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            response['elapsed_seconds'] = time.time() - start_time
+            self.send_json(200, response)
+        except Exception as e:
+            logger.exception('Request failed')
+            self.send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def is_unix_address(address):
+    """
+    host:port is served over localhost TCP, anything else is the path of a Unix socket
+    """
+    return ':' not in address
+
+
+def create_server(service, address=DEFAULT_ADDRESS):
+    if is_unix_address(address):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, EvaluationRequestHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = HTTPServer((host, int(port)), EvaluationRequestHandler)
+    server.service = service
+    return server
+
+
+def request_server(path, payload=None, address=DEFAULT_ADDRESS, timeout=None):
+    if is_unix_address(address):
+        connection = UnixHTTPConnection(address, timeout=timeout)
+    else:
+        host, port = address.rsplit(':', 1)
+        connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    try:
+        if payload is None:
+            connection.request('GET', path)
+        else:
+            connection.request('POST', path, body=json.dumps(payload).encode('utf-8'),
+                               headers={'Content-Type': 'application/json'})
+        response = json.loads(connection.getresponse().read().decode('utf-8'))
+    finally:
+        connection.close()
+    if 'error' in response:
+        raise RuntimeError('Evaluation server: {}'.format(response['error']))
+    return response
+
+
+def evaluate_remote(src_dir, hypotheses=None, hyp_file=None, ids=None, k_list=None, address=DEFAULT_ADDRESS,
+                    results_file=None, prediction_file=None, timeout=None):
+    """
+    Score hypotheses on a running evaluation server
+    :param hypotheses: list of hypothesis lines, keyphrases separated by KP_SEP (or hyp_file, read by the server)
+    :param ids: indices of the documents of the hypotheses, default all the documents of src_dir in order
+    :return: dict from the reported fields (e.g. macro_avg_f1@5_present) to their values
+    """
+    assert (hypotheses is None) != (hyp_file is None), "give either hypotheses or hyp_file"
+    payload = {'src_dir': os.path.abspath(src_dir), 'hypotheses': hypotheses,
+               'hyp_file': os.path.abspath(hyp_file) if hyp_file else None, 'ids': ids, 'k_list': k_list,
+               'results_file': results_file, 'prediction_file': prediction_file}
+    return request_server('/evaluate', payload, address=address, timeout=timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local evaluation server with resident references and stem cache')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='Run the server')
+    serve_parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS,
+                              help="host:port on localhost, or the path of a Unix socket")
+    serve_parser.add_argument('--src_dirs', nargs='*', default=[], help="Reference sets to load at startup")
+    serve_parser.add_argument('--cache_dir', type=str, default=None,
+                              help="Directory of the precomputed reference caches (see reference_cache.py)")
+    serve_parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='Default K values for evaluation')
+    serve_parser.add_argument('--stem_table', type=str, default=None,
+                              help="Path of an on-disk stem table, loaded at startup and updated at shutdown")
+    client_parser = subparsers.add_parser('evaluate', help='Score a hypothesis file on a running server')
+    client_parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS,
+                               help="host:port on localhost, or the path of a Unix socket")
+    client_parser.add_argument('--src_dir', type=str, required=True, help="Directory with test.source and test.target")
+    client_parser.add_argument('--hyp_file', type=str, required=True, help="Path of the hypothesis file")
+    client_parser.add_argument('--k_list', nargs='+', default=None, help='K values for evaluation')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+        service = EvaluationService(args.k_list, cache_dir=args.cache_dir, stem_table=args.stem_table)
+        for src_dir in args.src_dirs:
+            service.get_references(src_dir)
+        server = create_server(service, args.address)
+        logger.info('Serving on {}'.format(args.address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.close()
+    elif args.command == 'evaluate':
+        metrics = evaluate_remote(args.src_dir, hyp_file=args.hyp_file, k_list=args.k_list, address=args.address)
+        for field, value in metrics.items():
+            print('{}\t{}'.format(field, value))
+    else:
+        parser.print_help()
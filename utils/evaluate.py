@@ -1,58 +1,60 @@
 # adapted from https://github.com/kenchan0226/keyphrase-generation-rl/blob/master/evaluate_prediction.py
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import json
+import time
 import logging
+import itertools
 import argparse
 import numpy as np
 from tqdm import tqdm
-from collections import defaultdict
-from nltk.stem.porter import *
+from multiprocessing import Pool
+from collections import Counter, defaultdict
+from utils.stemming import stem_tokens, cache_info, load_stem_table, save_stem_table
+from utils.score_table import ScoreTable, TAGS, K_SENTINELS
+from utils.metrics_sink import StageTimer, NULL_TIMER, get_peak_rss_mb, write_metrics
+from utils.pool_util import imap_bounded
 
 KP_SEP = ';'
 TITLE_SEP = '[sep]'
 UNK_WORD = '[unk]'
 
-stemmer = PorterStemmer()
-
 INVALIDATE_UNK = True
 DISABLE_EXTRA_ONE_WORD_FILTER = True
 
 logger = logging.getLogger()
 
 
-def update_score_dict(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed, k_list, score_dict, tag):
+def update_score_table(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed, score_table, row, tag,
+                       trg_ids=None, pred_ids=None, is_match_substring_2d=None):
     num_targets = len(trg_token_2dlist_stemmed)
     num_predictions = len(pred_token_2dlist_stemmed)
 
-    is_match = compute_match_result(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed,
-                                    type='exact', dimension=1)
+    if trg_ids is not None and pred_ids is not None:
+        is_match = compute_match_result_by_ids(trg_ids, pred_ids, dimension=1)
+    else:
+        is_match = compute_match_result(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed,
+                                        type='exact', dimension=1)
     # Classification metrics
     precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks = \
-        compute_classification_metrics_at_ks(is_match, num_predictions, num_targets, k_list=k_list,
+        compute_classification_metrics_at_ks(is_match, num_predictions, num_targets, k_list=score_table.k_list,
                                              meng_rui_precision=False)
-
-    for topk, precision_k, recall_k, f1_k, num_matches_k, num_predictions_k in \
-            zip(k_list, precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks):
-        score_dict['precision@{}_{}'.format(topk, tag)].append(precision_k)
-        score_dict['recall@{}_{}'.format(topk, tag)].append(recall_k)
-        score_dict['f1_score@{}_{}'.format(topk, tag)].append(f1_k)
-        score_dict['num_matches@{}_{}'.format(topk, tag)].append(num_matches_k)
-        score_dict['num_predictions@{}_{}'.format(topk, tag)].append(num_predictions_k)
-        score_dict['num_targets@{}_{}'.format(topk, tag)].append(num_targets)
-
-    score_dict['num_targets_{}'.format(tag)].append(num_targets)
-    score_dict['num_predictions_{}'.format(tag)].append(num_predictions)
-    return score_dict
-
-
-def stem_str_2d_list(str_2dlist):
-    # stem every word in a list of word list
-    # str_list is a list of word list
-    stemmed_str_2dlist = []
-    for str_list in str_2dlist:
-        stemmed_str_list = [stem_word_list(word_list) for word_list in str_list]
-        stemmed_str_2dlist.append(stemmed_str_list)
-    return stemmed_str_2dlist
+    score_table.set_scores(row, tag, precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks,
+                           num_targets, num_predictions)
+
+    # Ranking metrics
+    if score_table.ranking:
+        if is_match_substring_2d is None:
+            is_match_substring_2d = compute_match_result(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed,
+                                                         type='sub', dimension=2)
+        ap_ks, ndcg_ks, alpha_ndcg_ks = compute_ranking_metrics_at_ks(
+            is_match, is_match_substring_2d, num_predictions, num_targets, score_table.k_array
+        )
+        score_table.set_ranking_scores(row, tag, ap_ks, ndcg_ks, alpha_ndcg_ks)
+    return score_table
 
 
 def stem_str_list(str_list):
@@ -66,7 +68,7 @@ def stem_str_list(str_list):
 
 
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return stem_tokens(word_list)
 
 
 def check_valid_keyphrases(str_list, invalidate_unk=True):
@@ -130,67 +132,109 @@ def check_present_keyphrases(src_str, keyphrase_str_list, match_by_str=False):
     num_keyphrases = len(keyphrase_str_list)
     is_present = np.zeros(num_keyphrases, dtype=bool)
 
+    if match_by_str:
+        joined_src_str = ' '.join(src_str)
+        for i, keyphrase_word_list in enumerate(keyphrase_str_list):
+            joined_keyphrase_str = ' '.join(keyphrase_word_list)
+            # an empty keyphrase is never present
+            if joined_keyphrase_str.strip() != "" and joined_keyphrase_str in joined_src_str:
+                is_present[i] = True
+        return is_present
+
+    # match by word: collect all keyphrases as token tuples, then find them in one pass over the source
+    keyphrase_tuples = [tuple(keyphrase_word_list) for keyphrase_word_list in keyphrase_str_list]
+    patterns = set(keyphrase_tuple for keyphrase_tuple in keyphrase_tuples
+                   if ' '.join(keyphrase_tuple).strip() != "")
+    found = find_ngrams_in_source(src_str, patterns)
+    for i, keyphrase_tuple in enumerate(keyphrase_tuples):
+        if keyphrase_tuple in found:
+            is_present[i] = True
+    return is_present
+
+
+def find_ngrams_in_source(src_str, patterns):
+    """
+    Single pass over the source that collects the patterns occurring as contiguous token spans
+    :param src_str: stemmed word list of source text
+    :param patterns: a set of token tuples
+    :return: the subset of patterns found in the source
+    """
+    found = set()
+    if not patterns:
+        return found
+    lengths = sorted(set(len(pattern) for pattern in patterns))
+    num_src_tokens = len(src_str)
+    for src_start_idx in range(num_src_tokens):
+        for length in lengths:
+            src_end_idx = src_start_idx + length
+            if src_end_idx > num_src_tokens:
+                break
+            ngram = tuple(src_str[src_start_idx:src_end_idx])
+            if ngram in patterns:
+                found.add(ngram)
+        if len(found) == len(patterns):
+            break
+    return found
+
+
+def intern_keyphrases(keyphrase_str_list, phrase2id):
+    """
+    Map every keyphrase to an integer id, new phrases get the next free id
+    :param keyphrase_str_list: stemmed list of word list
+    :param phrase2id: dict from joined keyphrase string to id, updated in place
+    :return: a np int array with size [num_keyphrases]
+    """
+    phrase_ids = np.empty(len(keyphrase_str_list), dtype=np.int64)
     for i, keyphrase_word_list in enumerate(keyphrase_str_list):
         joined_keyphrase_str = ' '.join(keyphrase_word_list)
+        phrase_id = phrase2id.get(joined_keyphrase_str)
+        if phrase_id is None:
+            phrase_id = len(phrase2id)
+            phrase2id[joined_keyphrase_str] = phrase_id
+        phrase_ids[i] = phrase_id
+    return phrase_ids
 
-        if joined_keyphrase_str.strip() == "":  # if the keyphrase is an empty string
-            is_present[i] = False
-        else:
-            if not match_by_str:  # match by word
-                # check if it appears in source text
-                match = False
-                for src_start_idx in range(len(src_str) - len(keyphrase_word_list) + 1):
-                    match = True
-                    for keyphrase_i, keyphrase_w in enumerate(keyphrase_word_list):
-                        src_w = src_str[src_start_idx + keyphrase_i]
-                        if src_w != keyphrase_w:
-                            match = False
-                            break
-                    if match:
-                        break
-                if match:
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
-            else:  # match by str
-                if joined_keyphrase_str in ' '.join(src_str):
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
-    return is_present
+
+def compute_match_result_by_ids(trg_ids, pred_ids, dimension=1):
+    """
+    Exact matching between keyphrases that were interned with the same phrase2id
+    :param trg_ids: a np int array with size [num_targets]
+    :param pred_ids: a np int array with size [num_predictions]
+    :return: a boolean np array with size [num_predictions] (dimension=1) or [num_targets, num_predictions]
+    """
+    assert dimension in [1, 2], "only support 1 or 2"
+    if dimension == 1:
+        return np.isin(pred_ids, trg_ids)
+    return trg_ids[:, None] == pred_ids[None, :]
 
 
 def compute_match_result(trg_str_list, pred_str_list, type='exact', dimension=1):
     assert type in ['exact', 'sub'], "Right now only support exact matching and substring matching"
     assert dimension in [1, 2], "only support 1 or 2"
-    num_pred_str = len(pred_str_list)
-    num_trg_str = len(trg_str_list)
+    # intern every phrase once, identical strings share an id
+    phrase2id = {}
+    trg_ids = intern_keyphrases(trg_str_list, phrase2id)
+    pred_ids = intern_keyphrases(pred_str_list, phrase2id)
+    if type == 'sub':
+        return compute_substring_match_result_by_ids(trg_ids, pred_ids, list(phrase2id), dimension=dimension)
+    return compute_match_result_by_ids(trg_ids, pred_ids, dimension=dimension)
+
+
+def compute_substring_match_result_by_ids(trg_ids, pred_ids, id2phrase, dimension=1):
+    """
+    Substring matching (the prediction is a substring of the target) between interned keyphrases
+    :param id2phrase: list of the joined keyphrase strings in id order
+    """
+    # an exact match is also a substring match, only the remaining pairs need a string search
+    is_match = compute_match_result_by_ids(trg_ids, pred_ids, dimension=dimension)
+    joined_trg_strs = [id2phrase[trg_id] for trg_id in trg_ids]
     if dimension == 1:
-        is_match = np.zeros(num_pred_str, dtype=bool)
-        for pred_idx, pred_word_list in enumerate(pred_str_list):
-            joined_pred_word_list = ' '.join(pred_word_list)
-            for trg_idx, trg_word_list in enumerate(trg_str_list):
-                joined_trg_word_list = ' '.join(trg_word_list)
-                if type == 'exact':
-                    if joined_pred_word_list == joined_trg_word_list:
-                        is_match[pred_idx] = True
-                        break
-                elif type == 'sub':
-                    if joined_pred_word_list in joined_trg_word_list:
-                        is_match[pred_idx] = True
-                        break
+        for pred_idx in np.flatnonzero(~is_match):
+            joined_pred_str = id2phrase[pred_ids[pred_idx]]
+            is_match[pred_idx] = any(joined_pred_str in joined_trg_str for joined_trg_str in joined_trg_strs)
     else:
-        is_match = np.zeros((num_trg_str, num_pred_str), dtype=bool)
-        for trg_idx, trg_word_list in enumerate(trg_str_list):
-            joined_trg_word_list = ' '.join(trg_word_list)
-            for pred_idx, pred_word_list in enumerate(pred_str_list):
-                joined_pred_word_list = ' '.join(pred_word_list)
-                if type == 'exact':
-                    if joined_pred_word_list == joined_trg_word_list:
-                        is_match[trg_idx][pred_idx] = True
-                elif type == 'sub':
-                    if joined_pred_word_list in joined_trg_word_list:
-                        is_match[trg_idx][pred_idx] = True
+        for trg_idx, pred_idx in zip(*np.nonzero(~is_match)):
+            is_match[trg_idx, pred_idx] = id2phrase[pred_ids[pred_idx]] in joined_trg_strs[trg_idx]
     return is_match
 
 
@@ -273,19 +317,93 @@ def compute_f1(precision, recall):
     return float(2 * (precision * recall)) / (precision + recall) if precision + recall > 0 else 0.0
 
 
-def update_f1_dict(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed, k_list, f1_dict, tag):
-    num_targets = len(trg_token_2dlist_stemmed)
-    num_predictions = len(pred_token_2dlist_stemmed)
-    is_match = compute_match_result(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed,
-                                    type='exact', dimension=1)
-    # Classification metrics
-    precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks = \
-        compute_classification_metrics_at_ks(is_match, num_predictions, num_targets, k_list=k_list,
-                                             meng_rui_precision=False)
-    for topk, precision_k, recall_k in zip(k_list, precision_ks, recall_ks):
-        f1_dict['precision_sum@{}_{}'.format(topk, tag)] += precision_k
-        f1_dict['recall_sum@{}_{}'.format(topk, tag)] += recall_k
-    return f1_dict
+# log2(rank + 1) of the ranks 1, 2, ..., shared by all documents and grown on demand
+_log_discounts = np.log2(np.arange(2, 2 + 256))
+
+
+def get_log_discounts(num_ranks):
+    global _log_discounts
+    if num_ranks > _log_discounts.shape[0]:
+        _log_discounts = np.log2(np.arange(2, 2 + max(num_ranks, 2 * _log_discounts.shape[0])))
+    return _log_discounts[:num_ranks]
+
+
+def resolve_ks(k_array, num_predictions, num_trgs):
+    """
+    :param k_array: a np int array of the k values, 'M' and 'G' encoded with K_SENTINELS
+    :return: a np int array of the k values of one document
+    """
+    return np.where(k_array == K_SENTINELS['M'], num_predictions,
+                    np.where(k_array == K_SENTINELS['G'], max(num_predictions, num_trgs), k_array))
+
+
+def safe_divide(a, b):
+    return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+
+def compute_ideal_alpha_gains(is_match_2d, depth, alpha=0.5):
+    """
+    Gains of the greedy ideal ranking of alpha-nDCG, which picks the prediction with the highest novelty-discounted
+    gain at every rank. Predictions without any relevant target have no gain, only the others are ranked.
+    :param is_match_2d: a boolean np array with size [num_trgs, num_predictions]
+    :return: a np float array with size [depth]
+    """
+    ideal_gains = np.zeros(depth)
+    num_matches_per_trg = is_match_2d.sum(axis=1)
+    if num_matches_per_trg.max(initial=0) <= 1:
+        # no target is matched twice, so there is no novelty discount and the greedy ranking is a sort
+        gains = np.sort(is_match_2d.sum(axis=0))[::-1][:depth]
+        ideal_gains[:gains.shape[0]] = gains
+        return ideal_gains
+    relevance = is_match_2d[:, is_match_2d.any(axis=0)].astype(np.float64)
+    novelty = np.ones(relevance.shape[0])
+    is_available = np.ones(relevance.shape[1], dtype=bool)
+    for rank in range(min(depth, relevance.shape[1])):
+        gains = np.where(is_available, novelty @ relevance, -1.0)
+        best_idx = np.argmax(gains)
+        ideal_gains[rank] = gains[best_idx]
+        is_available[best_idx] = False
+        novelty = novelty * (1 - alpha) ** relevance[:, best_idx]
+    return ideal_gains
+
+
+def compute_ranking_metrics_at_ks(is_match, is_match_substring_2d, num_predictions, num_trgs, k_array, alpha=0.5):
+    """
+    AP@k, nDCG@k and alpha-nDCG@k of all the k values at once, from cumulative sums over the ranked predictions
+    :param is_match: a boolean np array with size [num_predictions]
+    :param is_match_substring_2d: a boolean np array with size [num_trgs, num_predictions]
+    :param k_array: a np int array of the k values, 'M' and 'G' encoded with K_SENTINELS
+    :return: three np float arrays with size [len(k_array)]
+    """
+    assert is_match.shape[0] == num_predictions
+    if num_predictions == 0:
+        return np.zeros(len(k_array)), np.zeros(len(k_array)), np.zeros(len(k_array))
+    ks = resolve_ks(k_array, num_predictions, num_trgs)
+    depth = min(int(ks.max()), num_predictions)
+    return_indices = np.minimum(ks, depth) - 1
+    discounts = get_log_discounts(depth)
+    r = is_match[:depth].astype(np.float64)
+
+    # Average precision, normalized by the number of targets
+    if num_trgs > 0:
+        precision_at_ranks = np.cumsum(r) / np.arange(1, depth + 1) * r
+        ap_ks = (np.cumsum(precision_at_ranks) / num_trgs)[return_indices]
+    else:
+        ap_ks = np.zeros(len(k_array))
+
+    # gains of the ranked predictions and of the ideal rankings, discounted and summed all at once
+    gains = np.empty((4, depth))
+    # nDCG, the ideal ranking puts all the matched predictions first
+    gains[0] = r
+    gains[1] = np.arange(depth) < np.count_nonzero(is_match)
+    # alpha-nDCG, a target already covered by j higher ranked predictions only adds (1 - alpha)^j
+    r_2d = is_match_substring_2d[:, :depth]
+    num_previous_matches = np.cumsum(r_2d, axis=1) - r_2d
+    gains[2] = (r_2d * (1 - alpha) ** num_previous_matches).sum(axis=0)
+    gains[3] = compute_ideal_alpha_gains(is_match_substring_2d, depth, alpha)
+    dcg = np.cumsum(gains / discounts, axis=1)[:, return_indices]
+    ndcg_ks, alpha_ndcg_ks = safe_divide(dcg[0::2], dcg[1::2])
+    return ap_ks, ndcg_ks, alpha_ndcg_ks
 
 
 def filter_prediction(disable_valid_filter, disable_extra_one_word_filter, pred_token_2dlist_stemmed):
@@ -297,20 +415,65 @@ def filter_prediction(disable_valid_filter, disable_extra_one_word_filter, pred_
     :param pred_token_2d_list:
     :return:
     """
+    filtered_stemmed_pred_str_list, _, num_duplicated_predictions, is_unique_mask = filter_and_intern_prediction(
+        disable_valid_filter, disable_extra_one_word_filter, pred_token_2dlist_stemmed)
+    return filtered_stemmed_pred_str_list, num_duplicated_predictions, is_unique_mask
+
+
+def get_duplicate_key(joined_keyphrase_str):
+    """
+    check_duplicate_keyphrases compares keyphrases joined by '_', so a keyphrase containing '_' is a duplicate of
+    the same keyphrase with the '_' split into words. Mapping '_' to ' ' gives the same equality on the ' ' joined
+    string used for interning.
+    """
+    if '_' in joined_keyphrase_str:
+        return joined_keyphrase_str.replace('_', ' ')
+    return joined_keyphrase_str
+
+
+def filter_and_intern_prediction(disable_valid_filter, disable_extra_one_word_filter, pred_token_2dlist_stemmed,
+                                 phrase2id=None):
+    """
+    filter_prediction in a single pass: the duplicate, valid and extra one word flags of a keyphrase are computed
+    together, the same as check_duplicate_keyphrases, check_valid_keyphrases and compute_extra_one_word_seqs_mask,
+    and the kept keyphrases are interned on the way
+    :param phrase2id: dict from joined keyphrase string to id (see intern_keyphrases), updated in place
+    :return: the kept keyphrases, their ids (None without phrase2id), the number of duplicates and the boolean
+             np array of unique keyphrases
+    """
     num_predictions = len(pred_token_2dlist_stemmed)
-    is_unique_mask = check_duplicate_keyphrases(pred_token_2dlist_stemmed)  # boolean array, 1=unqiue, 0=duplicate
-    pred_filter = is_unique_mask
-    if not disable_valid_filter:
-        is_valid_mask = check_valid_keyphrases(pred_token_2dlist_stemmed)
-        pred_filter = pred_filter * is_valid_mask
-    if not disable_extra_one_word_filter:
-        extra_one_word_seqs_mask, num_one_word_seqs = compute_extra_one_word_seqs_mask(pred_token_2dlist_stemmed)
-        pred_filter = pred_filter * extra_one_word_seqs_mask
-    filtered_stemmed_pred_str_list = [word_list for word_list, is_keep in
-                                      zip(pred_token_2dlist_stemmed, pred_filter) if
-                                      is_keep]
+    is_unique_mask = np.empty(num_predictions, dtype=bool)
+    invalid_words = {UNK_WORD, ',', '.'}
+    seen_keys = set()
+    num_one_word_seqs = 0
+    filtered_stemmed_pred_str_list = []
+    filtered_pred_ids = []
+    for i, keyphrase_word_list in enumerate(pred_token_2dlist_stemmed):
+        joined_keyphrase_str = ' '.join(keyphrase_word_list)
+        duplicate_key = get_duplicate_key(joined_keyphrase_str)
+        is_unique = duplicate_key not in seen_keys
+        if is_unique:
+            seen_keys.add(duplicate_key)
+        is_unique_mask[i] = is_unique
+        is_keep = is_unique
+        if not disable_valid_filter:
+            is_keep = is_keep and len(keyphrase_word_list) > 0 and invalid_words.isdisjoint(keyphrase_word_list)
+        if not disable_extra_one_word_filter and len(keyphrase_word_list) == 1:
+            # every one word keyphrase is counted, also the duplicate and invalid ones
+            num_one_word_seqs += 1
+            is_keep = is_keep and num_one_word_seqs == 1
+        if not is_keep:
+            continue
+        filtered_stemmed_pred_str_list.append(keyphrase_word_list)
+        if phrase2id is not None:
+            phrase_id = phrase2id.get(joined_keyphrase_str)
+            if phrase_id is None:
+                phrase_id = len(phrase2id)
+                phrase2id[joined_keyphrase_str] = phrase_id
+            filtered_pred_ids.append(phrase_id)
+    filtered_pred_ids = np.array(filtered_pred_ids, dtype=np.int64) if phrase2id is not None else None
     num_duplicated_predictions = num_predictions - np.sum(is_unique_mask)
-    return filtered_stemmed_pred_str_list, num_duplicated_predictions, is_unique_mask
+    return filtered_stemmed_pred_str_list, filtered_pred_ids, num_duplicated_predictions, is_unique_mask
 
 
 def find_unique_target(trg_token_2dlist_stemmed):
@@ -320,17 +483,22 @@ def find_unique_target(trg_token_2dlist_stemmed):
     :return:
     """
     num_trg = len(trg_token_2dlist_stemmed)
-    is_unique_mask = check_duplicate_keyphrases(trg_token_2dlist_stemmed)  # boolean array, 1=unqiue, 0=duplicate
-    trg_filter = is_unique_mask
-    filtered_stemmed_trg_str_list = [word_list for word_list, is_keep in
-                                     zip(trg_token_2dlist_stemmed, trg_filter) if
-                                     is_keep]
-    num_duplicated_trg = num_trg - np.sum(is_unique_mask)
+    seen_keys = set()
+    filtered_stemmed_trg_str_list = []
+    for keyphrase_word_list in trg_token_2dlist_stemmed:
+        duplicate_key = get_duplicate_key(' '.join(keyphrase_word_list))
+        if duplicate_key not in seen_keys:
+            seen_keys.add(duplicate_key)
+            filtered_stemmed_trg_str_list.append(keyphrase_word_list)
+    num_duplicated_trg = num_trg - len(filtered_stemmed_trg_str_list)
     return filtered_stemmed_trg_str_list, num_duplicated_trg
 
 
-def separate_present_absent_by_source(src_token_list_stemmed, keyphrase_token_2dlist_stemmed, match_by_str):
-    is_present_mask = check_present_keyphrases(src_token_list_stemmed, keyphrase_token_2dlist_stemmed, match_by_str)
+def separate_present_absent_by_source(src_token_list_stemmed, keyphrase_token_2dlist_stemmed, match_by_str,
+                                      is_present_mask=None):
+    if is_present_mask is None:
+        is_present_mask = check_present_keyphrases(src_token_list_stemmed, keyphrase_token_2dlist_stemmed,
+                                                   match_by_str)
     present_keyphrase_token2dlist = []
     absent_keyphrase_token2dlist = []
     for keyphrase_token_list, is_present in zip(keyphrase_token_2dlist_stemmed, is_present_mask):
@@ -350,21 +518,18 @@ def process_input_ks(ks):
     return ks_list
 
 
-def report_ranking_scores(score_dict, topk_list, present_tag):
+def report_ranking_scores(score_table, topk_list, present_tag):
     output_str = ""
     result_list = []
     field_list = []
+    tag_idx = TAGS.index(present_tag)
+    score_totals, _ = score_table.totals()
+    num_documents = score_table.num_documents
     for topk in topk_list:
-        map_k = sum(score_dict['AP@{}_{}'.format(topk, present_tag)]) / len(
-            score_dict['AP@{}_{}'.format(topk, present_tag)])
-        # avg_dcg_k = sum(score_dict['DCG@{}_{}'.format(topk, present_tag)]) / len(
-        #    score_dict['DCG@{}_{}'.format(topk, present_tag)])
-        avg_ndcg_k = sum(score_dict['NDCG@{}_{}'.format(topk, present_tag)]) / len(
-            score_dict['NDCG@{}_{}'.format(topk, present_tag)])
-        # avg_alpha_dcg_k = sum(score_dict['AlphaDCG@{}_{}'.format(topk, present_tag)]) / len(
-        #    score_dict['AlphaDCG@{}_{}'.format(topk, present_tag)])
-        avg_alpha_ndcg_k = sum(score_dict['AlphaNDCG@{}_{}'.format(topk, present_tag)]) / len(
-            score_dict['AlphaNDCG@{}_{}'.format(topk, present_tag)])
+        k_idx = score_table.k_list.index(topk)
+        map_k = float(score_totals[tag_idx, k_idx, 3]) / num_documents
+        avg_ndcg_k = float(score_totals[tag_idx, k_idx, 4]) / num_documents
+        avg_alpha_ndcg_k = float(score_totals[tag_idx, k_idx, 5]) / num_documents
         output_str += (
             "Begin==================Ranking metrics {}@{}==================Begin\n".format(present_tag, topk))
         output_str += "\tMAP@{}={:.5}\tNDCG@{}={:.5}\tAlphaNDCG@{}={:.5}\n".format(topk, map_k, topk, avg_ndcg_k, topk,
@@ -376,120 +541,532 @@ def report_ranking_scores(score_dict, topk_list, present_tag):
     return output_str, field_list, result_list
 
 
-def main(predictions, exp_path, result_file_suffix, k_list=[5, 'M']):
-    source, target, preds = [], [], []
-    for hyp, ref, src in zip(predictions[0], predictions[1],
-                             predictions[2]):
-        source.append(src)
-        target.append(';'.join(ref))
-        preds.append(';'.join(hyp))
-
-    score_dict = defaultdict(list)
-    k_list = process_input_ks(k_list)
-    topk_dict = {'present': k_list, 'absent': k_list, 'all': k_list}
-
-    total_num_src = 0
-    total_num_src_with_present_keyphrases = 0
-    total_num_src_with_absent_keyphrases = 0
-    total_num_unique_predictions = 0
-    total_num_present_filtered_predictions = 0
-    total_num_present_unique_targets = 0
-    total_num_absent_filtered_predictions = 0
-    total_num_absent_unique_targets = 0
-    max_unique_targets = 0
-
-    sum_incorrect_fraction_for_identifying_present = 0
-    sum_incorrect_fraction_for_identifying_absent = 0
-
-    predicted_keyphrases = []
-    for data_idx, (src_l, trg_l, pred_l) in \
-            enumerate(tqdm(zip(source, target, preds),
-                           total=len(source), desc='Evaluating...')):
-        total_num_src += 1
-        # convert the str to token list
-        pred_str_list = pred_l.strip().split(';')
-        pred_str_list = pred_str_list[:200]
-        pred_token_2dlist = [pred_str.strip().split(' ') for pred_str in pred_str_list]
-        trg_str_list = trg_l.strip().split(';')
-        trg_token_2dlist = [trg_str.strip().split(' ') for trg_str in trg_str_list]
-
-        src_l = src_l.strip()
-        if TITLE_SEP in src_l:
-            [title, context] = src_l.strip().split(TITLE_SEP)
-        else:
-            title = ""
-            context = src_l
-        src_token_list = title.strip().split(' ') + context.strip().split(' ')
+class ScoreAccumulator(object):
+    """
+    Per-document scores (a ScoreTable) and corpus-level counters of the evaluated documents.
+    Accumulators of consecutive document chunks can be merged in order, which gives
+    exactly the state of scoring all the documents in a single pass.
+    With keep_document_scores=False only running sums of the scores are kept.
+    """
 
-        num_predictions = len(pred_str_list)
+    def __init__(self, k_list, keep_document_scores=True, capacity=1024, ranking=False, timing=False):
+        self.table = ScoreTable(k_list, capacity=capacity, keep_rows=keep_document_scores, ranking=ranking)
+        self.counters = Counter()
+        self.max_unique_targets = 0
+        # time spent in every stage, see metrics_sink.StageTimer
+        self.timer = StageTimer() if timing else NULL_TIMER
+        self.start_time = (time.perf_counter(), time.process_time())
 
-        # perform stemming
-        stemmed_src_token_list = stem_word_list(src_token_list)
+    def merge(self, other):
+        self.table.merge(other.table)
+        self.counters.update(other.counters)
+        self.max_unique_targets = max(self.max_unique_targets, other.max_unique_targets)
+        self.timer.merge(other.timer)
+        return self
 
-        stemmed_trg_token_2dlist = stem_str_list(trg_token_2dlist)
-        # TODO: test stemmed_trg_variation_token_3dlist
 
-        stemmed_pred_token_2dlist = stem_str_list(pred_token_2dlist)
+class SourcePresenceIndex(object):
+    """
+    Positions of every stemmed source token, built once and reused to check many keyphrases
+    against the same source. Gives the same result as check_present_keyphrases (match by word).
+    """
+
+    def __init__(self, src_str):
+        self.src_str = list(src_str)
+        self.positions = defaultdict(list)
+        for src_idx, src_w in enumerate(self.src_str):
+            self.positions[src_w].append(src_idx)
+
+    def contains(self, keyphrase_word_list):
+        keyphrase_word_list = list(keyphrase_word_list)
+        if ' '.join(keyphrase_word_list).strip() == "":
+            return False
+        src_start_indices = self.positions.get(keyphrase_word_list[0])
+        if not src_start_indices:
+            return False
+        keyphrase_len = len(keyphrase_word_list)
+        for src_start_idx in src_start_indices:
+            if self.src_str[src_start_idx:src_start_idx + keyphrase_len] == keyphrase_word_list:
+                return True
+        return False
+
+    def check_present_keyphrases(self, keyphrase_str_list):
+        is_present = np.zeros(len(keyphrase_str_list), dtype=bool)
+        for i, keyphrase_word_list in enumerate(keyphrase_str_list):
+            is_present[i] = self.contains(keyphrase_word_list)
+        return is_present
+
+
+class ReferenceDocument(object):
+    """
+    The source and targets of one document after stemming and target deduplication.
+    It only depends on test.source/test.target, so it can be shared by every prediction file
+    scored against the same dataset.
+    """
+
+    def __init__(self, stemmed_src_token_list, unique_stemmed_trg_token_2dlist, presence_index=None,
+                 is_present_trg_mask=None):
+        self.stemmed_src_token_list = stemmed_src_token_list
+        self.unique_stemmed_trg_token_2dlist = unique_stemmed_trg_token_2dlist
+        self.presence_index = presence_index
+        self.trg_phrase2id = {}
+        self.unique_trg_ids = intern_keyphrases(unique_stemmed_trg_token_2dlist, self.trg_phrase2id)
+        # filled at the first scoring unless it is given or the presence index is built
+        self.is_present_trg_mask = is_present_trg_mask
+        if is_present_trg_mask is None and presence_index is not None:
+            self.is_present_trg_mask = presence_index.check_present_keyphrases(unique_stemmed_trg_token_2dlist)
+
+
+def prepare_reference(src_l, trg_l, build_presence_index=False, timer=NULL_TIMER):
+    """
+    Stem the source and targets of one document and remove the duplicated targets
+    :param src_l: source string, optionally title and context separated by TITLE_SEP
+    :param trg_l: target keyphrases separated by ';'
+    :param build_presence_index: index the source for repeated presence checks (many prediction files)
+    :return: a ReferenceDocument
+    """
+    trg_str_list = trg_l.strip().split(';')
+    trg_token_2dlist = [trg_str.strip().split(' ') for trg_str in trg_str_list]
+
+    src_l = src_l.strip()
+    if TITLE_SEP in src_l:
+        [title, context] = src_l.strip().split(TITLE_SEP)
+    else:
+        title = ""
+        context = src_l
+    src_token_list = title.strip().split(' ') + context.strip().split(' ')
+
+    # perform stemming
+    stemmed_src_token_list = stem_word_list(src_token_list)
+
+    stemmed_trg_token_2dlist = stem_str_list(trg_token_2dlist)
+    timer.lap('stemming')
 
-        # Filter out duplicate, invalid, and extra one word predictions
-        filtered_stemmed_pred_token_2dlist, num_duplicated_predictions, is_unique_mask = filter_prediction(
-            INVALIDATE_UNK, DISABLE_EXTRA_ONE_WORD_FILTER, stemmed_pred_token_2dlist
+    # Remove duplicated targets
+    unique_stemmed_trg_token_2dlist, _ = find_unique_target(stemmed_trg_token_2dlist)
+    timer.lap('filtering')
+
+    presence_index = SourcePresenceIndex(stemmed_src_token_list) if build_presence_index else None
+    return ReferenceDocument(stemmed_src_token_list, unique_stemmed_trg_token_2dlist, presence_index)
+
+
+def evaluate_example(data_idx, src_l, trg_l, pred_l, accumulator):
+    """
+    Score one document and add its scores to the accumulator
+    :param src_l: source string, optionally title and context separated by TITLE_SEP
+    :param trg_l: target keyphrases separated by ';'
+    :param pred_l: predicted keyphrases separated by ';'
+    :return: the postprocessed predictions of the document, one row of the _predictions.txt file
+    """
+    accumulator.timer.lap('load')
+    return score_prediction(data_idx, prepare_reference(src_l, trg_l, timer=accumulator.timer), pred_l, accumulator)
+
+
+def score_prediction(data_idx, reference, pred_l, accumulator):
+    """
+    Score the predictions of one document against its prepared reference and add the scores to the accumulator
+    :param reference: the ReferenceDocument of the document
+    :param pred_l: predicted keyphrases separated by ';'
+    :return: the postprocessed predictions of the document, one row of the _predictions.txt file
+    """
+    # convert the str to token list
+    pred_str_list = pred_l.strip().split(';')
+    pred_str_list = pred_str_list[:200]
+    pred_token_2dlist = [pred_str.strip().split(' ') for pred_str in pred_str_list]
+    return score_tokenized_prediction(data_idx, reference, pred_token_2dlist, accumulator)
+
+
+def score_tokenized_prediction(data_idx, reference, pred_token_2dlist, accumulator, stemmed_pred_token_2dlist=None):
+    """
+    score_prediction on predictions that are already split into keyphrases and tokens
+    :param pred_token_2dlist: the predicted keyphrases (at most 200) as lists of tokens
+    :param stemmed_pred_token_2dlist: the stemmed pred_token_2dlist, stemmed here if not given
+    :return: the postprocessed predictions of the document, one row of the _predictions.txt file
+    """
+    counters = accumulator.counters
+    timer = accumulator.timer
+    counters['total_num_src'] += 1
+    num_predictions = len(pred_token_2dlist)
+
+    # perform stemming
+    stemmed_src_token_list = reference.stemmed_src_token_list
+    if stemmed_pred_token_2dlist is None:
+        stemmed_pred_token_2dlist = stem_str_list(pred_token_2dlist)
+    timer.lap('stemming')
+
+    # Filter out duplicate, invalid, and extra one word predictions, interning the kept ones
+    # so that the all/present/absent matching below only compares ids
+    phrase2id = dict(reference.trg_phrase2id)
+    filtered_stemmed_pred_token_2dlist, filtered_pred_ids, num_duplicated_predictions, is_unique_mask = \
+        filter_and_intern_prediction(INVALIDATE_UNK, DISABLE_EXTRA_ONE_WORD_FILTER, stemmed_pred_token_2dlist,
+                                     phrase2id)
+    counters['total_num_unique_predictions'] += (num_predictions - num_duplicated_predictions)
+    num_filtered_predictions = len(filtered_stemmed_pred_token_2dlist)
+
+    unique_stemmed_trg_token_2dlist = reference.unique_stemmed_trg_token_2dlist
+    num_unique_targets = len(unique_stemmed_trg_token_2dlist)
+
+    if num_unique_targets > accumulator.max_unique_targets:
+        accumulator.max_unique_targets = num_unique_targets
+    timer.lap('filtering')
+
+    # separate present and absent keyphrases
+    if reference.presence_index is not None:
+        is_present_mask = reference.presence_index.check_present_keyphrases(filtered_stemmed_pred_token_2dlist)
+    elif reference.is_present_trg_mask is not None:
+        is_present_mask = check_present_keyphrases(stemmed_src_token_list, filtered_stemmed_pred_token_2dlist, False)
+    else:
+        # predictions and targets are located in one pass over the source
+        is_present_all_mask = check_present_keyphrases(
+            stemmed_src_token_list, filtered_stemmed_pred_token_2dlist + unique_stemmed_trg_token_2dlist, False
         )
-        total_num_unique_predictions += (num_predictions - num_duplicated_predictions)
-        num_filtered_predictions = len(filtered_stemmed_pred_token_2dlist)
-
-        # Remove duplicated targets
-        unique_stemmed_trg_token_2dlist, num_duplicated_trg = find_unique_target(stemmed_trg_token_2dlist)
-        # unique_stemmed_trg_token_2dlist = stemmed_trg_token_2dlist
-        num_unique_targets = len(unique_stemmed_trg_token_2dlist)
-        # max_unique_targets += (num_trg - num_duplicated_trg)
-
-        if num_unique_targets > max_unique_targets:
-            max_unique_targets = num_unique_targets
-
-        # separate present and absent keyphrases
-        present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist, is_present_mask = \
-            separate_present_absent_by_source(stemmed_src_token_list, filtered_stemmed_pred_token_2dlist, False)
-        present_unique_stemmed_trg_token_2dlist, absent_unique_stemmed_trg_token_2dlist, _ = \
-            separate_present_absent_by_source(stemmed_src_token_list, unique_stemmed_trg_token_2dlist, False)
-
-        # save the predicted keyphrases
-        filtered_pred_token_2dlist = [kp_tokens for kp_tokens, is_unique
-                                      in zip(pred_token_2dlist, is_unique_mask) if is_unique]
-        result = {'id': data_idx, 'present': [], 'absent': []}
-        for kp_tokens, is_present in zip(filtered_pred_token_2dlist, is_present_mask):
-            if is_present:
-                result['present'] += [' '.join(kp_tokens)]
-            else:
-                result['absent'] += [' '.join(kp_tokens)]
-        predicted_keyphrases.append(result)
-
-        total_num_present_filtered_predictions += len(present_filtered_stemmed_pred_token_2dlist)
-        total_num_present_unique_targets += len(present_unique_stemmed_trg_token_2dlist)
-        total_num_absent_filtered_predictions += len(absent_filtered_stemmed_pred_token_2dlist)
-        total_num_absent_unique_targets += len(absent_unique_stemmed_trg_token_2dlist)
-        if len(present_unique_stemmed_trg_token_2dlist) > 0:
-            total_num_src_with_present_keyphrases += 1
-        if len(absent_unique_stemmed_trg_token_2dlist) > 0:
-            total_num_src_with_absent_keyphrases += 1
-
-        # compute all the metrics and update the score_dict
-        score_dict = update_score_dict(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist,
-                                       topk_dict['all'], score_dict, 'all')
-        # compute all the metrics and update the score_dict for present keyphrase
-        score_dict = update_score_dict(present_unique_stemmed_trg_token_2dlist,
-                                       present_filtered_stemmed_pred_token_2dlist,
-                                       topk_dict['present'], score_dict, 'present')
-        # compute all the metrics and update the score_dict for absent keyphrase
-        score_dict = update_score_dict(absent_unique_stemmed_trg_token_2dlist,
-                                       absent_filtered_stemmed_pred_token_2dlist,
-                                       topk_dict['absent'], score_dict, 'absent')
-
-    if len(predicted_keyphrases) > 0:
-        with open('{}_predictions.txt'.format(args.file_prefix), 'w') as fw:
-            for item in predicted_keyphrases:
-                fw.write(json.dumps(item) + '\n')
+        is_present_mask = is_present_all_mask[:num_filtered_predictions]
+        reference.is_present_trg_mask = is_present_all_mask[num_filtered_predictions:]
+    is_present_trg_mask = reference.is_present_trg_mask
+    present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist, is_present_mask = \
+        separate_present_absent_by_source(stemmed_src_token_list, filtered_stemmed_pred_token_2dlist, False,
+                                          is_present_mask)
+    present_unique_stemmed_trg_token_2dlist, absent_unique_stemmed_trg_token_2dlist, is_present_trg_mask = \
+        separate_present_absent_by_source(stemmed_src_token_list, unique_stemmed_trg_token_2dlist, False,
+                                          is_present_trg_mask)
+    timer.lap('split')
+
+    unique_trg_ids = reference.unique_trg_ids
+
+    # save the predicted keyphrases
+    filtered_pred_token_2dlist = [kp_tokens for kp_tokens, is_unique
+                                  in zip(pred_token_2dlist, is_unique_mask) if is_unique]
+    result = {'id': data_idx, 'present': [], 'absent': []}
+    for kp_tokens, is_present in zip(filtered_pred_token_2dlist, is_present_mask):
+        if is_present:
+            result['present'] += [' '.join(kp_tokens)]
+        else:
+            result['absent'] += [' '.join(kp_tokens)]
+
+    counters['total_num_present_filtered_predictions'] += len(present_filtered_stemmed_pred_token_2dlist)
+    counters['total_num_present_unique_targets'] += len(present_unique_stemmed_trg_token_2dlist)
+    counters['total_num_absent_filtered_predictions'] += len(absent_filtered_stemmed_pred_token_2dlist)
+    counters['total_num_absent_unique_targets'] += len(absent_unique_stemmed_trg_token_2dlist)
+    if len(present_unique_stemmed_trg_token_2dlist) > 0:
+        counters['total_num_src_with_present_keyphrases'] += 1
+    if len(absent_unique_stemmed_trg_token_2dlist) > 0:
+        counters['total_num_src_with_absent_keyphrases'] += 1
+
+    score_table = accumulator.table
+    row = score_table.add_row()
+    if score_table.ranking:
+        # the substring matches of all the pairs are computed once, present and absent take sub-matrices
+        is_match_substring_2d = compute_substring_match_result_by_ids(unique_trg_ids, filtered_pred_ids,
+                                                                      list(phrase2id), dimension=2)
+        present_is_match_substring_2d = is_match_substring_2d[np.ix_(is_present_trg_mask, is_present_mask)]
+        absent_is_match_substring_2d = is_match_substring_2d[np.ix_(~is_present_trg_mask, ~is_present_mask)]
+    else:
+        is_match_substring_2d = present_is_match_substring_2d = absent_is_match_substring_2d = None
+    # compute all the metrics and update the score_table
+    update_score_table(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist,
+                       score_table, row, 'all',
+                       trg_ids=unique_trg_ids, pred_ids=filtered_pred_ids,
+                       is_match_substring_2d=is_match_substring_2d)
+    # compute all the metrics and update the score_table for present keyphrase
+    update_score_table(present_unique_stemmed_trg_token_2dlist,
+                       present_filtered_stemmed_pred_token_2dlist,
+                       score_table, row, 'present',
+                       trg_ids=unique_trg_ids[is_present_trg_mask],
+                       pred_ids=filtered_pred_ids[is_present_mask],
+                       is_match_substring_2d=present_is_match_substring_2d)
+    # compute all the metrics and update the score_table for absent keyphrase
+    update_score_table(absent_unique_stemmed_trg_token_2dlist,
+                       absent_filtered_stemmed_pred_token_2dlist,
+                       score_table, row, 'absent',
+                       trg_ids=unique_trg_ids[~is_present_trg_mask],
+                       pred_ids=filtered_pred_ids[~is_present_mask],
+                       is_match_substring_2d=absent_is_match_substring_2d)
+    timer.lap('matching')
+    return result
+
+
+def evaluate_chunk(chunk):
+    """
+    Score a chunk of consecutive documents into a fresh accumulator, used by the worker processes
+    :param chunk: (index of the first document, list of (source, target, prediction) triples, k_list,
+                   whether to compute the ranking metrics, whether to time the stages)
+    """
+    start_idx, examples, k_list, ranking, timing = chunk
+    accumulator = ScoreAccumulator(k_list, capacity=len(examples), ranking=ranking, timing=timing)
+    predicted_keyphrases = [evaluate_example(start_idx + i, src_l, trg_l, pred_l, accumulator)
+                            for i, (src_l, trg_l, pred_l) in enumerate(examples)]
+    return accumulator, predicted_keyphrases
+
 
+# the references and hypothesis parser of the worker processes of Evaluator.score_references()
+_worker_references = None
+_worker_parse_hypothesis = None
+
+
+def init_reference_worker(references, parse_hypothesis=None):
+    global _worker_references, _worker_parse_hypothesis
+    _worker_references = references
+    _worker_parse_hypothesis = parse_hypothesis
+
+
+def score_hypothesis_chunk(chunk):
+    """
+    Score a chunk of consecutive hypothesis lines against the references of the worker process
+    :param chunk: (index of the first document, list of hypothesis lines, k_list,
+                   whether to compute the ranking metrics, whether to time the stages)
+    """
+    start_idx, hypotheses, k_list, ranking, timing = chunk
+    accumulator = ScoreAccumulator(k_list, capacity=len(hypotheses), ranking=ranking, timing=timing)
+    predicted_keyphrases = [score_hypothesis(start_idx + i, _worker_references[start_idx + i], candidate,
+                                             accumulator, _worker_parse_hypothesis)
+                            for i, candidate in enumerate(hypotheses)]
+    return accumulator, predicted_keyphrases
+
+
+def split_into_chunks(examples, chunk_size, k_list, ranking=False, timing=False):
+    examples = iter(examples)
+    start_idx = 0
+    while True:
+        chunk = list(itertools.islice(examples, chunk_size))
+        if not chunk:
+            break
+        yield start_idx, chunk, k_list, ranking, timing
+        start_idx += len(chunk)
+
+
+class Evaluator(object):
+    """
+    Importable evaluation API with explicit output paths.
+    The stemmer cache and the worker pool are kept across calls, so a single process can evaluate
+    several datasets in a row. Call close() (or use it as a context manager) when done.
+    """
+
+    def __init__(self, k_list=[5, 'M'], workers=1, chunk_size=500, ranking=False, stem_table=None,
+                 metrics_file=None):
+        """
+        :param k_list: K values for evaluation
+        :param workers: number of processes used to score the documents
+        :param ranking: also compute and report MAP, nDCG and alpha-nDCG
+        :param stem_table: path of an on-disk stem table, loaded now and updated by close()
+        :param metrics_file: if given, every evaluation writes its metrics, stage timings and peak memory
+                             to this json file (appended as one line if it ends with .jsonl)
+        """
+        self.k_list = process_input_ks(k_list)
+        self.topk_dict = {'present': self.k_list, 'absent': self.k_list, 'all': self.k_list}
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ranking = ranking
+        self.stem_table = stem_table
+        self.metrics_file = metrics_file
+        self.pool = None
+        if stem_table:
+            load_stem_table(stem_table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.close_pool()
+        logger.info('Stem cache: {}'.format(cache_info()))
+        if self.stem_table:
+            save_stem_table(self.stem_table)
+
+    def close_pool(self):
+        """
+        Terminate the worker processes, the pool is started again by the next score()
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def score(self, examples, prediction_file=None, keep_document_scores=True, total=None):
+        """
+        Score documents as they are read and write the postprocessed predictions incrementally
+        :param examples: an iterable of (source, target, prediction) strings, keyphrases separated by ';'
+        :param prediction_file: path of the _predictions.txt file, None to skip writing it
+        :param keep_document_scores: False keeps only running sums of the scores, so memory stays flat
+        :param total: number of documents, used to preallocate the score table and for the progress bar
+        :return: the ScoreAccumulator holding the scores of all the documents
+        """
+        accumulator = self.new_accumulator(keep_document_scores, total)
+        if self.workers > 1:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            # chunks come back in order, so merging gives the same state as the serial loop
+            results = imap_bounded(self.pool, evaluate_chunk,
+                                   split_into_chunks(examples, self.chunk_size, self.k_list, self.ranking,
+                                                     self.metrics_file is not None),
+                                   2 * self.workers)
+        else:
+            results = ((None, [evaluate_example(data_idx, src_l, trg_l, pred_l, accumulator)])
+                       for data_idx, (src_l, trg_l, pred_l) in enumerate(examples))
+        return collect_results(results, accumulator, prediction_file, total)
+
+    def score_references(self, references, hypotheses, prediction_file=None, keep_document_scores=True,
+                         disable_progress_bar=False, parse_hypothesis=None):
+        """
+        Score hypothesis lines against prepared references (load_references() or a reference cache),
+        nothing of the references is recomputed
+        :param hypotheses: an iterable of lines, keyphrases separated by KP_SEP as in the _hypotheses.txt files
+        :param keep_document_scores: False keeps only running sums of the scores
+        :param parse_hypothesis: see score_hypotheses(), e.g. to read hypotheses of BPE ids
+        :return: the ScoreAccumulator holding the scores of all the documents
+        """
+        accumulator = self.new_accumulator(keep_document_scores, len(references))
+        if self.workers <= 1:
+            return score_hypotheses(references, hypotheses, accumulator, prediction_file, disable_progress_bar,
+                                    parse_hypothesis)
+        # the references are handed to the workers once, when they start, a chunk only carries its hypotheses
+        pool = Pool(self.workers, initializer=init_reference_worker, initargs=(references, parse_hypothesis))
+        try:
+            results = imap_bounded(pool, score_hypothesis_chunk,
+                                   split_into_chunks(itertools.islice(hypotheses, len(references)), self.chunk_size,
+                                                     self.k_list, self.ranking, self.metrics_file is not None),
+                                   2 * self.workers)
+            return collect_results(results, accumulator, prediction_file, len(references), disable_progress_bar)
+        finally:
+            pool.close()
+            pool.join()
+
+    def new_accumulator(self, keep_document_scores=True, total=None):
+        """
+        :return: an empty ScoreAccumulator for the options of the evaluator
+        """
+        return ScoreAccumulator(self.k_list, keep_document_scores,
+                                capacity=total if total and keep_document_scores else 1024,
+                                ranking=self.ranking, timing=self.metrics_file is not None)
+
+    def report(self, accumulator, results_file=None, score_file=None, description=None, match_file=None):
+        """
+        :param results_file: path of the results_log file to write, None to skip writing it
+        :param score_file: path of a .npz file to save the per-document score table to
+        :param description: dict describing the evaluated data, added to the record of the metrics_file
+        :param match_file: path of a .npy file to save the per-document match vectors to (see diff_runs.py)
+        :return: dict from the reported fields (e.g. macro_avg_f1@5_present) to their values
+        """
+        accumulator.timer.restart()
+        if score_file is not None:
+            accumulator.table.save(score_file)
+        if match_file is not None:
+            accumulator.table.save_match_vectors(match_file)
+        result_txt_str, field_list, result_list = report_scores(accumulator, self.topk_dict)
+        if results_file is not None:
+            with open(results_file, "w") as results_txt_file:
+                results_txt_file.write(result_txt_str)
+        accumulator.timer.lap('reporting')
+        if self.metrics_file is not None:
+            # the peak memory of the workers is only counted once they have terminated
+            self.close_pool()
+            record = dict(description or {}, results_file=results_file, k_list=[str(topk) for topk in self.k_list],
+                          workers=self.workers)
+            record.update(collect_metrics_record(accumulator, self.topk_dict))
+            write_metrics(self.metrics_file, record)
+        return {field: float(result) for field, result in zip(field_list, result_list)}
+
+    def evaluate(self, examples, results_file=None, prediction_file=None, score_file=None,
+                 keep_document_scores=True, total=None, description=None, match_file=None):
+        """
+        :param examples: an iterable of (source, target, prediction) strings, keyphrases separated by ';'
+        :return: dict from the reported fields to their values
+        """
+        accumulator = self.score(examples, prediction_file, keep_document_scores, total)
+        return self.report(accumulator, results_file, score_file, description, match_file)
+
+    def evaluate_src_dir(self, src_dir, hyp_file, results_file=None, prediction_file=None, score_file=None,
+                         keep_document_scores=True, match_file=None):
+        """
+        Evaluate hyp_file against {src_dir}/test.source and {src_dir}/test.target
+        """
+        examples = ((src, ';'.join(ref), ';'.join(hyp)) for hyp, ref, src in iter_src_dir_examples(src_dir, hyp_file))
+        return self.evaluate(examples, results_file, prediction_file, score_file, keep_document_scores,
+                             description={'src_dir': src_dir, 'hyp_file': hyp_file}, match_file=match_file)
+
+    def evaluate_json(self, src_file, pred_file, results_file=None, prediction_file=None, score_file=None,
+                      keep_document_scores=True, match_file=None):
+        """
+        Evaluate pred_file against the json lines of src_file
+        """
+        examples = ((src, ';'.join(ref), ';'.join(hyp)) for hyp, ref, src in iter_json_examples(src_file, pred_file))
+        return self.evaluate(examples, results_file, prediction_file, score_file, keep_document_scores,
+                             description={'src_file': src_file, 'pred_file': pred_file}, match_file=match_file)
+
+    def evaluate_references(self, references, hyp_file, results_file=None, prediction_file=None, score_file=None,
+                            keep_document_scores=True, match_file=None, parse_hypothesis=None):
+        """
+        Evaluate hyp_file against prepared references (load_references() or a reference cache)
+        :param parse_hypothesis: see score_hypotheses(), e.g. to read hypotheses of BPE ids
+        """
+        with open(hyp_file) as f:
+            return self.evaluate_hypotheses(references, f, results_file, prediction_file, score_file,
+                                            keep_document_scores, description={'hyp_file': hyp_file},
+                                            match_file=match_file, parse_hypothesis=parse_hypothesis)
+
+    def evaluate_hypotheses(self, references, hypotheses, results_file=None, prediction_file=None, score_file=None,
+                            keep_document_scores=True, disable_progress_bar=False, description=None,
+                            match_file=None, parse_hypothesis=None):
+        """
+        Evaluate hypothesis lines against prepared references, see score_references()
+        """
+        accumulator = self.score_references(references, hypotheses, prediction_file, keep_document_scores,
+                                            disable_progress_bar, parse_hypothesis)
+        return self.report(accumulator, results_file, score_file, description, match_file)
+
+
+def collect_results(results, accumulator, prediction_file=None, total=None, disable_progress_bar=False):
+    """
+    Merge the scored chunks into the accumulator and write the postprocessed predictions incrementally
+    :param results: an iterable of (accumulator of the chunk or None if scored into accumulator,
+                    the _predictions.txt rows of the chunk), in document order
+    :param prediction_file: path of the _predictions.txt file, None to skip writing it
+    :return: the accumulator
+    """
+    fw = None
+    try:
+        with tqdm(total=total, desc='Evaluating...', disable=disable_progress_bar) as pbar:
+            for chunk_accumulator, predicted_keyphrases in results:
+                if chunk_accumulator is not None:
+                    accumulator.merge(chunk_accumulator)
+                if prediction_file is not None:
+                    if fw is None:
+                        fw = open(prediction_file, 'w')
+                    for item in predicted_keyphrases:
+                        fw.write(json.dumps(item) + '\n')
+                pbar.update(len(predicted_keyphrases))
+    finally:
+        if fw is not None:
+            fw.close()
+    return accumulator
+
+
+def main(predictions, exp_path, result_file_suffix, k_list=[5, 'M'], file_prefix=None, workers=1, chunk_size=500,
+         score_file=None, ranking=False):
+    """
+    Evaluate (hypotheses, references, sources) lists with an Evaluator
+    :param file_prefix: the predictions are written to {file_prefix}_predictions.txt, by default
+                        {exp_path}/{result_file_suffix}_predictions.txt
+    """
+    examples = ((src, ';'.join(ref), ';'.join(hyp)) for hyp, ref, src in zip(predictions[0], predictions[1],
+                                                                              predictions[2]))
+    if file_prefix is None:
+        file_prefix = os.path.join(exp_path, result_file_suffix)
+    with Evaluator(k_list, workers, chunk_size, ranking) as evaluator:
+        evaluator.evaluate(examples, os.path.join(exp_path, "results_log_{}.txt".format(result_file_suffix)),
+                           '{}_predictions.txt'.format(file_prefix), score_file, total=len(predictions[2]))
+    return
+
+
+def report_scores(accumulator, topk_dict):
+    score_table = accumulator.table
+    counters = accumulator.counters
+    total_num_src = counters['total_num_src']
+    total_num_present_filtered_predictions = counters['total_num_present_filtered_predictions']
+    total_num_present_unique_targets = counters['total_num_present_unique_targets']
+    total_num_absent_filtered_predictions = counters['total_num_absent_filtered_predictions']
+    total_num_absent_unique_targets = counters['total_num_absent_unique_targets']
     total_num_unique_targets = total_num_present_unique_targets + total_num_absent_unique_targets
     total_num_filtered_predictions = total_num_present_filtered_predictions + total_num_absent_filtered_predictions
 
@@ -498,58 +1075,106 @@ def main(predictions, exp_path, result_file_suffix, k_list=[5, 'M']):
     # report global statistics
     result_txt_str += (
             'Total #samples: %d\t # samples with present keyphrases: %d\t # samples with absent keyphrases: %d\n' % (
-        total_num_src, total_num_src_with_present_keyphrases, total_num_src_with_absent_keyphrases))
-    result_txt_str += ('Max. unique targets per src: %d\n' % (max_unique_targets))
-    result_txt_str += ('Total #unique predictions: %d\n' % total_num_unique_predictions)
+        total_num_src, counters['total_num_src_with_present_keyphrases'],
+        counters['total_num_src_with_absent_keyphrases']))
+    result_txt_str += ('Max. unique targets per src: %d\n' % (accumulator.max_unique_targets))
+    result_txt_str += ('Total #unique predictions: %d\n' % counters['total_num_unique_predictions'])
 
     # report statistics and scores for all predictions and targets
     result_txt_str_all, field_list_all, result_list_all = report_stat_and_scores(
-        total_num_filtered_predictions, total_num_unique_targets, total_num_src, score_dict,
+        total_num_filtered_predictions, total_num_unique_targets, total_num_src, score_table,
         topk_dict['all'], 'all'
     )
     result_txt_str_present, field_list_present, result_list_present = report_stat_and_scores(
-        total_num_present_filtered_predictions, total_num_present_unique_targets, total_num_src, score_dict,
+        total_num_present_filtered_predictions, total_num_present_unique_targets, total_num_src, score_table,
         topk_dict['present'], 'present'
     )
     result_txt_str_absent, field_list_absent, result_list_absent = report_stat_and_scores(
-        total_num_absent_filtered_predictions, total_num_absent_unique_targets, total_num_src, score_dict,
+        total_num_absent_filtered_predictions, total_num_absent_unique_targets, total_num_src, score_table,
         topk_dict['absent'], 'absent'
     )
     result_txt_str += (result_txt_str_all + result_txt_str_present + result_txt_str_absent)
     field_list = field_list_all + field_list_present + field_list_absent
     result_list = result_list_all + result_list_present + result_list_absent
 
-    # Write to files
-    # topk_dict = {'present': [5, 10, 'M'], 'absent': [5, 10, 50, 'M'], 'all': [5, 10, 'M']}
-    results_txt_file = open(os.path.join(exp_path, "results_log_{}.txt".format(result_file_suffix)), "w")
-
     result_txt_str += "===================================Separation====================================\n"
     result_txt_str += "Avg error fraction for identifying present keyphrases: {:.5}\n".format(
-        sum_incorrect_fraction_for_identifying_present / total_num_src)
+        counters['sum_incorrect_fraction_for_identifying_present'] / total_num_src)
     result_txt_str += "Avg error fraction for identifying absent keyphrases: {:.5}\n".format(
-        sum_incorrect_fraction_for_identifying_absent / total_num_src)
+        counters['sum_incorrect_fraction_for_identifying_absent'] / total_num_src)
 
     # Report MAE on lengths
     result_txt_str += "===================================MAE stat====================================\n"
 
-    num_targets_present_array = np.array(score_dict['num_targets_present'])
-    num_predictions_present_array = np.array(score_dict['num_predictions_present'])
-    num_targets_absent_array = np.array(score_dict['num_targets_absent'])
-    num_predictions_absent_array = np.array(score_dict['num_predictions_absent'])
+    all_mae, present_mae, absent_mae = compute_keyphrase_number_mae(score_table)
+
+    result_txt_str += "MAE on keyphrase numbers (all): {:.5}\n".format(all_mae)
+    result_txt_str += "MAE on keyphrase numbers (present): {:.5}\n".format(present_mae)
+    result_txt_str += "MAE on keyphrase numbers (absent): {:.5}\n".format(absent_mae)
+    return result_txt_str, field_list, result_list
+
+
+def compute_keyphrase_number_mae(score_table):
+    """
+    :return: MAE between the numbers of targets and predictions of the documents, for all, present and absent
+    """
+    num_targets_present_array, num_predictions_present_array = score_table.get_num_keyphrases('present')
+    num_targets_absent_array, num_predictions_absent_array = score_table.get_num_keyphrases('absent')
 
     all_mae = mae(num_targets_present_array + num_targets_absent_array,
                   num_predictions_present_array + num_predictions_absent_array)
     present_mae = mae(num_targets_present_array, num_predictions_present_array)
     absent_mae = mae(num_targets_absent_array, num_predictions_absent_array)
+    return all_mae, present_mae, absent_mae
 
-    result_txt_str += "MAE on keyphrase numbers (all): {:.5}\n".format(all_mae)
-    result_txt_str += "MAE on keyphrase numbers (present): {:.5}\n".format(present_mae)
-    result_txt_str += "MAE on keyphrase numbers (absent): {:.5}\n".format(absent_mae)
-
-    results_txt_file.write(result_txt_str)
-    results_txt_file.close()
 
-    return
+def collect_metrics_record(accumulator, topk_dict):
+    """
+    Everything reported in the results_log as a json-serializable dict: the dataset counts, the micro and macro
+    P/R/F1@k (and the ranking metrics) of all, present and absent keyphrases, the MAE figures,
+    and the time spent in every stage and the peak memory
+    """
+    score_table = accumulator.table
+    score_totals, count_totals = score_table.totals()
+    num_documents = score_table.num_documents
+    metrics = {}
+    for tag in TAGS:
+        tag_idx = TAGS.index(tag)
+        for topk in topk_dict[tag]:
+            k_idx = score_table.k_list.index(topk)
+            num_matches, num_predictions, num_targets = count_totals[tag_idx, k_idx].tolist()
+            micro_precision, micro_recall, micro_f1 = compute_classification_metrics(num_matches, num_predictions,
+                                                                                     num_targets)
+            macro_precision = float(score_totals[tag_idx, k_idx, 0]) / num_documents
+            macro_recall = float(score_totals[tag_idx, k_idx, 1]) / num_documents
+            macro_f1 = compute_f1(macro_precision, macro_recall)
+            metrics.update({
+                'micro_avg_p@{}_{}'.format(topk, tag): micro_precision,
+                'micro_avg_r@{}_{}'.format(topk, tag): micro_recall,
+                'micro_avg_f1@{}_{}'.format(topk, tag): micro_f1,
+                'macro_avg_p@{}_{}'.format(topk, tag): macro_precision,
+                'macro_avg_r@{}_{}'.format(topk, tag): macro_recall,
+                'macro_avg_f1@{}_{}'.format(topk, tag): macro_f1,
+                'num_matches@{}_{}'.format(topk, tag): num_matches,
+                'num_predictions@{}_{}'.format(topk, tag): num_predictions,
+                'num_targets@{}_{}'.format(topk, tag): num_targets
+            })
+            if score_table.ranking:
+                metrics.update({
+                    'MAP@{}_{}'.format(topk, tag): float(score_totals[tag_idx, k_idx, 3]) / num_documents,
+                    'avg_NDCG@{}_{}'.format(topk, tag): float(score_totals[tag_idx, k_idx, 4]) / num_documents,
+                    'AlphaNDCG@{}_{}'.format(topk, tag): float(score_totals[tag_idx, k_idx, 5]) / num_documents
+                })
+    all_mae, present_mae, absent_mae = compute_keyphrase_number_mae(score_table)
+    metrics.update({'mae_all': float(all_mae), 'mae_present': float(present_mae), 'mae_absent': float(absent_mae)})
+
+    counts = {key: int(value) for key, value in accumulator.counters.items()}
+    counts['max_unique_targets'] = accumulator.max_unique_targets
+    record = {'num_documents': num_documents, 'counts': counts, 'metrics': metrics,
+              'stages': accumulator.timer.to_dict(), 'peak_rss_mb': get_peak_rss_mb()}
+    record['wall_seconds'] = time.perf_counter() - accumulator.start_time[0]
+    record['cpu_seconds'] = time.process_time() - accumulator.start_time[1]
+    return record
 
 
 def rmse(a, b):
@@ -560,7 +1185,7 @@ def mae(a, b):
     return (np.abs(a - b)).mean()
 
 
-def report_stat_and_scores(total_num_filtered_predictions, num_unique_trgs, total_num_src, score_dict, topk_list,
+def report_stat_and_scores(total_num_filtered_predictions, num_unique_trgs, total_num_src, score_table, topk_list,
                            present_tag):
     result_txt_str = "===================================%s====================================\n" % (present_tag)
     result_txt_str += "#predictions after filtering: %d\t #predictions after filtering per src:%.3f\n" % \
@@ -569,30 +1194,37 @@ def report_stat_and_scores(total_num_filtered_predictions, num_unique_trgs, tota
                       (num_unique_trgs, num_unique_trgs / total_num_src)
 
     classification_output_str, classification_field_list, classification_result_list = report_classification_scores(
-        score_dict, topk_list, present_tag
+        score_table, topk_list, present_tag
     )
     result_txt_str += classification_output_str
     field_list = classification_field_list
     result_list = classification_result_list
+    if score_table.ranking:
+        ranking_output_str, ranking_field_list, ranking_result_list = report_ranking_scores(
+            score_table, topk_list, present_tag
+        )
+        result_txt_str += ranking_output_str
+        field_list += ranking_field_list
+        result_list += ranking_result_list
     return result_txt_str, field_list, result_list
 
 
-def report_classification_scores(score_dict, topk_list, present_tag):
+def report_classification_scores(score_table, topk_list, present_tag):
     output_str = ""
     result_list = []
     field_list = []
+    tag_idx = TAGS.index(present_tag)
+    score_totals, count_totals = score_table.totals()
+    num_documents = score_table.num_documents
     for topk in topk_list:
-        total_predictions_k = sum(score_dict['num_predictions@{}_{}'.format(topk, present_tag)])
-        total_targets_k = sum(score_dict['num_targets@{}_{}'.format(topk, present_tag)])
-        total_num_matches_k = sum(score_dict['num_matches@{}_{}'.format(topk, present_tag)])
+        k_idx = score_table.k_list.index(topk)
+        total_num_matches_k, total_predictions_k, total_targets_k = count_totals[tag_idx, k_idx]
         # Compute the micro averaged recall, precision and F-1 score
         micro_avg_precision_k, micro_avg_recall_k, micro_avg_f1_score_k = compute_classification_metrics(
             total_num_matches_k, total_predictions_k, total_targets_k)
         # Compute the macro averaged recall, precision and F-1 score
-        macro_avg_precision_k = sum(score_dict['precision@{}_{}'.format(topk, present_tag)]) / len(
-            score_dict['precision@{}_{}'.format(topk, present_tag)])
-        macro_avg_recall_k = sum(score_dict['recall@{}_{}'.format(topk, present_tag)]) / len(
-            score_dict['recall@{}_{}'.format(topk, present_tag)])
+        macro_avg_precision_k = float(score_totals[tag_idx, k_idx, 0]) / num_documents
+        macro_avg_recall_k = float(score_totals[tag_idx, k_idx, 1]) / num_documents
         macro_avg_f1_score_k = (2 * macro_avg_precision_k * macro_avg_recall_k) / \
                                (macro_avg_precision_k + macro_avg_recall_k) if \
             (macro_avg_precision_k + macro_avg_recall_k) > 0 else 0.0
@@ -612,8 +1244,94 @@ def report_classification_scores(score_dict, topk_list, present_tag):
     return output_str, field_list, result_list
 
 
-def run_eval(predictions, dir_name, file_suffix, k_list):
-    main(predictions, dir_name, file_suffix, k_list)
+def iter_json_examples(src_file, pred_file):
+    """
+    Read (hypotheses, references, source) of each document from a json source file and a prediction file
+    """
+    with open(src_file) as f1, open(pred_file) as f2:
+        for source, pred in zip(f1, f2):
+            ex = json.loads(source.strip())
+            references = ex['tgt'].lower().split(' {} '.format(KP_SEP))
+            preds = pred.split(' {} '.format(KP_SEP))
+            preds = [p.replace('[ digit ]', '[digit]') for p in preds]
+            yield preds, references, ex['src'].lower()
+
+
+def clean_keyphrases(line):
+    """
+    Split a line of keyphrases separated by KP_SEP, undo the wordpiece and digit tokenization
+    """
+    keyphrases = []
+    for kp in line.lower().split(KP_SEP):
+        kp = kp.strip()
+        kp = kp.replace(' ##', '')
+        kp = kp.replace('[ digit ]', '[digit]')
+        keyphrases.append(kp)
+    return keyphrases
+
+
+def iter_src_dir_examples(src_dir, hyp_file):
+    """
+    Read (hypotheses, references, source) of each document from {src_dir}/test.source, {src_dir}/test.target
+    and hyp_file (e.g. {file_prefix}_hypotheses.txt)
+    """
+    with open('{}/test.source'.format(src_dir)) as f1, \
+            open(hyp_file) as f2, \
+            open('{}/test.target'.format(src_dir)) as f3:
+        for source, candidate, gold in zip(f1, f2, f3):
+            yield clean_keyphrases(candidate), clean_keyphrases(gold), source.strip().lower()
+
+
+def load_references(src_dir, build_presence_index=True, cache_dir=None):
+    """
+    Read {src_dir}/test.source and {src_dir}/test.target and prepare the reference of every document once
+    :param cache_dir: if given, the references are read from the reference cache of src_dir in cache_dir,
+                      built first if needed (see reference_cache.py)
+    :return: a list of ReferenceDocument, or a CachedReferences sequence of them
+    """
+    if cache_dir is not None:
+        from utils.reference_cache import get_references
+        return get_references(src_dir, cache_dir, build_presence_index)
+    references = []
+    with open('{}/test.source'.format(src_dir)) as f1, open('{}/test.target'.format(src_dir)) as f3:
+        for source, gold in tqdm(zip(f1, f3), desc='Preparing references...'):
+            references.append(prepare_reference(source.strip().lower(), ';'.join(clean_keyphrases(gold)),
+                                                build_presence_index=build_presence_index))
+    return references
+
+
+def score_hypotheses(references, hypotheses, accumulator, prediction_file=None, disable_progress_bar=False,
+                     parse_hypothesis=None):
+    """
+    Score every hypothesis line against the reference of the same document and add the scores to the accumulator
+    :param hypotheses: an iterable of lines, keyphrases separated by KP_SEP as in the _hypotheses.txt files
+    :param parse_hypothesis: if given, reads the hypothesis lines instead of the text parsing, a function from
+                             a line to the keyphrase token 2dlist and its stemmed version (see bpe_hypotheses.py)
+    """
+    results = ((None, [score_hypothesis(data_idx, reference, candidate, accumulator, parse_hypothesis)])
+               for data_idx, (reference, candidate) in enumerate(zip(references, hypotheses)))
+    return collect_results(results, accumulator, prediction_file, len(references), disable_progress_bar)
+
+
+def score_hypothesis(data_idx, reference, candidate, accumulator, parse_hypothesis=None):
+    """
+    Score one hypothesis line against its reference, see score_hypotheses()
+    :return: the postprocessed predictions of the document, one row of the _predictions.txt file
+    """
+    if parse_hypothesis is not None:
+        accumulator.timer.lap('load')
+        pred_token_2dlist, stemmed_pred_token_2dlist = parse_hypothesis(candidate)
+        return score_tokenized_prediction(data_idx, reference, pred_token_2dlist, accumulator,
+                                          stemmed_pred_token_2dlist)
+    pred_l = ';'.join(clean_keyphrases(candidate))
+    accumulator.timer.lap('load')
+    return score_prediction(data_idx, reference, pred_l, accumulator)
+
+
+def run_eval(predictions, dir_name, file_suffix, k_list, file_prefix=None, workers=1, score_file=None,
+             ranking=False):
+    main(predictions, dir_name, file_suffix, k_list, file_prefix, workers=workers, score_file=score_file,
+         ranking=ranking)
 
 
 if __name__ == '__main__':
@@ -626,48 +1344,53 @@ if __name__ == '__main__':
     parser.add_argument('--tgt_dir', type=str, required=True, help="Path of target directory")
     parser.add_argument('--log_file', type=str, required=True, help="Path of the log file")
     parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values for evaluation')
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes used to score the documents")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Read and score the documents one by one, keeping only running sums of the scores")
+    parser.add_argument('--score_file', type=str, default=None,
+                        help="Path of a .npz file to save the per-document score table to")
+    parser.add_argument('--reference_cache', type=str, default=None,
+                        help="Directory of the precomputed reference caches, used with --src_dir")
+    parser.add_argument('--stem_table', type=str, default=None,
+                        help="Path of an on-disk stem table, loaded before and updated after evaluation")
+    parser.add_argument('--ranking_metrics', action='store_true',
+                        help="Also report the ranking metrics MAP@k, NDCG@k and AlphaNDCG@k")
+    parser.add_argument('--match_file', type=str, default=None,
+                        help="Path of a .npy file to save the per-document match vectors to, see diff_runs.py")
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help="Path of a .json (or appended .jsonl) file to write all the metrics, the time spent "
+                             "in every stage and the peak memory to")
+    parser.add_argument('--bpe_encoder_json', type=str, default=None,
+                        help="Path of the GPT-2 encoder.json, the hypothesis file holds the BPE ids written by "
+                             "fairseq-generate and is scored without decoding it to text, used with --src_dir")
     args = parser.parse_args()
 
-    hypotheses = []
-    references = []
-    sources = []
-
-    if args.src_file and args.pred_file:
-        with open(args.src_file) as f1, open(args.pred_file) as f2:
-            for source, pred in zip(f1, f2):
-                ex = json.loads(source.strip())
-                sources.append(ex['src'].lower())
-                references.append(ex['tgt'].lower().split(' {} '.format(KP_SEP)))
-                preds = pred.split(' {} '.format(KP_SEP))
-                preds = [p.replace('[ digit ]', '[digit]') for p in preds]
-                hypotheses.append(preds)
-
-    elif args.src_dir:
-        with open('{}/test.source'.format(args.src_dir)) as f1, \
-                open('{}_hypotheses.txt'.format(args.file_prefix)) as f2, \
-                open('{}/test.target'.format(args.src_dir)) as f3:
-            for source, candidate, gold in zip(f1, f2, f3):
-                sources.append(source.strip().lower())
-
-                refs = gold.lower().split(KP_SEP)
-                mod_refs = []
-                for r in refs:
-                    r = r.strip()
-                    r = r.replace(' ##', '')
-                    r = r.replace('[ digit ]', '[digit]')
-                    mod_refs.append(r)
-                references.append(mod_refs)
-
-                preds = candidate.lower().split(KP_SEP)
-                mod_preds = []
-                for p in preds:
-                    p = p.strip()
-                    p = p.replace(' ##', '')
-                    p = p.replace('[ digit ]', '[digit]')
-                    mod_preds.append(p)
-                hypotheses.append(mod_preds)
-
-    else:
-        raise ValueError('Unknown output format')
-
-    run_eval((hypotheses, references, sources), args.tgt_dir, args.log_file, args.k_list)
+    results_file = os.path.join(args.tgt_dir, 'results_log_{}.txt'.format(args.log_file))
+    prediction_file = '{}_predictions.txt'.format(args.file_prefix)
+    hyp_file = '{}_hypotheses.txt'.format(args.file_prefix)
+    keep_document_scores = not args.streaming
+    if args.streaming and args.score_file:
+        logger.warning('--score_file is ignored with --streaming, the per-document scores are not kept')
+        args.score_file = None
+
+    with Evaluator(args.k_list, workers=args.workers, ranking=args.ranking_metrics,
+                   stem_table=args.stem_table, metrics_file=args.metrics_file) as evaluator:
+        if args.src_dir and args.bpe_encoder_json:
+            from utils.bpe_hypotheses import BPEHypothesisParser
+            references = load_references(args.src_dir, cache_dir=args.reference_cache)
+            evaluator.evaluate_references(references, hyp_file, results_file, prediction_file, args.score_file,
+                                          keep_document_scores, args.match_file,
+                                          parse_hypothesis=BPEHypothesisParser(args.bpe_encoder_json))
+        elif args.src_dir and args.reference_cache:
+            # the stemmed references are memory-mapped from the cache, test.source/test.target are not re-read
+            evaluator.evaluate_references(load_references(args.src_dir, cache_dir=args.reference_cache), hyp_file,
+                                          results_file, prediction_file, args.score_file, keep_document_scores,
+                                          args.match_file)
+        elif args.src_file and args.pred_file:
+            evaluator.evaluate_json(args.src_file, args.pred_file, results_file, prediction_file, args.score_file,
+                                    keep_document_scores, args.match_file)
+        elif args.src_dir:
+            evaluator.evaluate_src_dir(args.src_dir, hyp_file, results_file, prediction_file, args.score_file,
+                                       keep_document_scores, args.match_file)
+        else:
+            raise ValueError('Unknown output format')
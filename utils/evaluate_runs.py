@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from utils.evaluate import Evaluator, load_references
+from utils.bootstrap import compare_score_tables, report_comparison
+
+
+def write_comparison_table(out_file, run_names, field_list, run_results):
+    with open(out_file, 'w') as fw:
+        fw.write('\t'.join(['run'] + field_list) + '\n')
+        for name, result_list in zip(run_names, run_results):
+            fw.write('\t'.join([name] + ['{:.5}'.format(float(v)) for v in result_list]) + '\n')
+
+
+def get_result_file_suffixes(names):
+    """
+    :return: the suffix of the results_log file of every run, the base name of the run name, prefixed with
+             the run index when base names repeat (e.g. runA/kp20k_hypotheses.txt and runB/kp20k_hypotheses.txt)
+    """
+    suffixes = [os.path.basename(name) for name in names]
+    if len(set(suffixes)) < len(suffixes):
+        suffixes = ['{}_{}'.format(idx, suffix) for idx, suffix in enumerate(suffixes)]
+    return suffixes
+
+
+def main(args):
+    names = args.names if args.names else args.hyp_files
+    assert len(names) == len(args.hyp_files), "number of names and hypothesis files should match"
+
+    # the references are read, stemmed, deduplicated and indexed only once
+    references = load_references(args.src_dir, cache_dir=args.cache_dir)
+
+    field_list = None
+    run_results = []
+    run_score_tables = []
+    with Evaluator(args.k_list, ranking=args.ranking_metrics) as evaluator:
+        for name, suffix, hyp_file in zip(names, get_result_file_suffixes(names), args.hyp_files):
+            with open(hyp_file) as f:
+                accumulator = evaluator.score_references(references, f)
+            results_file = None
+            if args.tgt_dir is not None:
+                results_file = os.path.join(args.tgt_dir, 'results_log_{}.txt'.format(suffix))
+            metrics = evaluator.report(accumulator, results_file)
+            run_score_tables.append(accumulator.table)
+            field_list = list(metrics)
+            run_results.append(list(metrics.values()))
+            print('{}\t{}'.format(name, '\t'.join('{}={:.5}'.format(f, v) for f, v in metrics.items()
+                                                  if f.startswith('macro_avg_f1'))))
+        k_list = evaluator.k_list
+
+    write_comparison_table(args.out_file, names, field_list, run_results)
+
+    if args.num_resamples > 0:
+        # every run is compared against the first one
+        bootstrap_topk_list = [topk for topk in [5, 'M'] if topk in k_list]
+        for name, score_table in zip(names[1:], run_score_tables[1:]):
+            rows = compare_score_tables(score_table, run_score_tables[0], bootstrap_topk_list,
+                                        num_resamples=args.num_resamples)
+            print(report_comparison(rows, name, names[0]), end='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate many prediction files against one reference set')
+    parser.add_argument('--src_dir', type=str, required=True, help="Directory with test.source and test.target")
+    parser.add_argument('--hyp_files', nargs='+', required=True, help="Paths of the hypothesis files")
+    parser.add_argument('--names', nargs='+', default=None, help="Name of every run, defaults to the file paths")
+    parser.add_argument('--out_file', type=str, required=True, help="Path of the comparison table (tsv)")
+    parser.add_argument('--tgt_dir', type=str, default=None,
+                        help="If given, results_log_{name}.txt of every run is written to this directory, "
+                             "{name} is prefixed with the run index if the names have the same base name")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Directory of the precomputed reference caches (see reference_cache.py)")
+    parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values for evaluation')
+    parser.add_argument('--ranking_metrics', action='store_true',
+                        help="Also report the ranking metrics MAP@k, NDCG@k and AlphaNDCG@k")
+    parser.add_argument('--num_resamples', type=int, default=0,
+                        help="If > 0, bootstrap CIs of F1@5/F1@M and paired tests of every run against the first")
+    main(parser.parse_args())
@@ -0,0 +1,124 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import argparse
+import contextlib
+import numpy as np
+from tqdm import tqdm
+from utils.evaluate import Evaluator, load_references, score_hypothesis
+
+HYPOTHESIS_PREFIX = 'H-'
+
+
+def parse_generate_line(line):
+    """
+    :param line: a line of the fairseq-generate output
+    :return: (document id, hypothesis) of a H-<id> line, the same as `grep ^H | cut -f3-`, None for other lines
+    """
+    if not line.startswith(HYPOTHESIS_PREFIX):
+        return None
+    fields = line.rstrip('\n').split('\t', 2)
+    return int(fields[0][len(HYPOTHESIS_PREFIX):]), fields[2] if len(fields) == 3 else ''
+
+
+def score_generation_stream(lines, references, accumulator, parse_hypothesis=None, log_file=None, hyp_file=None,
+                            prediction_file=None, disable_progress_bar=False):
+    """
+    Score the hypotheses of fairseq-generate while it is running. fairseq-generate prints the documents in the
+    order of its length-sorted batches; every document is scored as soon as its H-<id> line is read, and the
+    per-document scores are put back in document order at the end, so the scores are the same as those of the
+    sorted hypothesis file. The hypothesis and prediction files are written in document order as the documents
+    before the next missing one complete.
+    :param lines: an iterable of fairseq-generate output lines, e.g. sys.stdin
+    :param accumulator: an empty ScoreAccumulator keeping the document scores
+    :param parse_hypothesis: see score_hypotheses(), e.g. a BPEHypothesisParser for BPE id hypotheses
+    :param log_file: if given, every line is copied to it (the generation log)
+    :param hyp_file: if given, the _hypotheses.txt file to write
+    :param prediction_file: if given, the _predictions.txt file to write
+    :return: the accumulator
+    """
+    num_documents = len(references)
+    hypotheses = [None] * num_documents
+    results = [None] * num_documents
+    document_ids = []
+    num_written = 0
+    with contextlib.ExitStack() as stack:
+        flog = stack.enter_context(open(log_file, 'w')) if log_file is not None else None
+        fhyp = stack.enter_context(open(hyp_file, 'w')) if hyp_file is not None else None
+        fpred = stack.enter_context(open(prediction_file, 'w')) if prediction_file is not None else None
+        pbar = stack.enter_context(tqdm(total=num_documents, desc='Evaluating...', disable=disable_progress_bar))
+        for line in lines:
+            if flog is not None:
+                flog.write(line)
+            parsed = parse_generate_line(line)
+            if parsed is None:
+                continue
+            data_idx, hypothesis = parsed
+            if hypotheses[data_idx] is not None:
+                # n-best output, the first hypothesis is the best one
+                continue
+            hypotheses[data_idx] = hypothesis
+            results[data_idx] = score_hypothesis(data_idx, references[data_idx], hypothesis, accumulator,
+                                                 parse_hypothesis)
+            document_ids.append(data_idx)
+            pbar.update(1)
+            while num_written < num_documents and results[num_written] is not None:
+                if fhyp is not None:
+                    fhyp.write(hypotheses[num_written] + '\n')
+                if fpred is not None:
+                    fpred.write(json.dumps(results[num_written]) + '\n')
+                results[num_written] = None
+                num_written += 1
+    if len(document_ids) != num_documents:
+        raise ValueError('fairseq-generate output has hypotheses of {} of the {} documents'.format(
+            len(document_ids), num_documents))
+    accumulator.table.reorder(np.argsort(document_ids))
+    return accumulator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate the output of fairseq-generate, read from stdin, '
+                                                 'while it is being generated')
+    parser.add_argument('--src_dir', type=str, required=True, help="Directory with test.source and test.target")
+    parser.add_argument('--file_prefix', type=str, required=True,
+                        help="Prefix of the hypothesis and prediction file, the hypotheses are written to "
+                             "_hypotheses_raw.txt with --bpe_encoder_json")
+    parser.add_argument('--tgt_dir', type=str, required=True, help="Path of target directory")
+    parser.add_argument('--log_file', type=str, required=True, help="Path of the log file")
+    parser.add_argument('--out_file', type=str, default=None, help="Path to save the fairseq-generate output to")
+    parser.add_argument('--k_list', nargs='+', default=[5, 'M'], help='K values for evaluation')
+    parser.add_argument('--bpe_encoder_json', type=str, default=None,
+                        help="Path of the GPT-2 encoder.json, the hypotheses are BPE ids (fairseq-generate without "
+                             "--bpe) and are scored without decoding them to text")
+    parser.add_argument('--reference_cache', type=str, default=None,
+                        help="Directory of the precomputed reference caches")
+    parser.add_argument('--ranking_metrics', action='store_true',
+                        help="Also report the ranking metrics MAP@k, NDCG@k and AlphaNDCG@k")
+    parser.add_argument('--score_file', type=str, default=None,
+                        help="Path of a .npz file to save the per-document score table to")
+    parser.add_argument('--match_file', type=str, default=None,
+                        help="Path of a .npy file to save the per-document match vectors to, see diff_runs.py")
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help="Path of a .json (or appended .jsonl) file to write all the metrics to")
+    args = parser.parse_args()
+
+    results_file = os.path.join(args.tgt_dir, 'results_log_{}.txt'.format(args.log_file))
+    # BPE id hypotheses are kept apart from the text ones, as run_test.py does
+    hyp_file = '{}_hypotheses{}.txt'.format(args.file_prefix, '_raw' if args.bpe_encoder_json else '')
+    prediction_file = '{}_predictions.txt'.format(args.file_prefix)
+
+    with Evaluator(args.k_list, ranking=args.ranking_metrics, metrics_file=args.metrics_file) as evaluator:
+        # the references are prepared while the model is loaded, before the first hypothesis is printed
+        references = load_references(args.src_dir, cache_dir=args.reference_cache)
+        parse_hypothesis = None
+        if args.bpe_encoder_json:
+            from utils.bpe_hypotheses import BPEHypothesisParser
+            parse_hypothesis = BPEHypothesisParser(args.bpe_encoder_json)
+        accumulator = evaluator.new_accumulator(total=len(references))
+        score_generation_stream(sys.stdin, references, accumulator, parse_hypothesis, args.out_file, hyp_file,
+                                prediction_file)
+        evaluator.report(accumulator, results_file, args.score_file,
+                         description={'src_dir': args.src_dir, 'hyp_file': hyp_file}, match_file=args.match_file)
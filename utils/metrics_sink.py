@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import datetime
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak memory is then not reported
+    resource = None
+
+STAGES = ('load', 'stemming', 'filtering', 'split', 'matching', 'reporting')
+
+
+class StageTimer(object):
+    """
+    Wall-clock and CPU time spent in every evaluation stage.
+    lap(stage) charges the time since the previous lap to the stage, so consecutive laps cover
+    the whole scoring loop without nested timers.
+    The times of merged worker timers are kept apart as worker-seconds: they are summed over
+    the workers, which run in parallel, so they can exceed the wall-clock time of the run.
+    """
+
+    def __init__(self):
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        self.worker_wall = dict.fromkeys(STAGES, 0.0)
+        self.worker_cpu = dict.fromkeys(STAGES, 0.0)
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+
+    def lap(self, stage):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.wall[stage] += wall - self.last_wall
+        self.cpu[stage] += cpu - self.last_cpu
+        self.last_wall, self.last_cpu = wall, cpu
+
+    def restart(self):
+        """
+        Start the next lap now, the time since the previous lap is not charged to any stage
+        """
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+
+    def merge(self, other):
+        """
+        Add the stage times of the timer of a worker process to the worker-seconds
+        """
+        for stage in STAGES:
+            self.worker_wall[stage] += other.wall[stage] + other.worker_wall[stage]
+            self.worker_cpu[stage] += other.cpu[stage] + other.worker_cpu[stage]
+        return self
+
+    def to_dict(self):
+        return {stage: {'wall_seconds': self.wall[stage], 'cpu_seconds': self.cpu[stage],
+                        'worker_wall_seconds': self.worker_wall[stage], 'worker_cpu_seconds': self.worker_cpu[stage]}
+                for stage in STAGES}
+
+
+class NullTimer(object):
+    """
+    Stands in for a StageTimer when timing is off
+    """
+
+    def lap(self, stage):
+        pass
+
+    def restart(self):
+        pass
+
+    def merge(self, other):
+        return self
+
+    def to_dict(self):
+        return None
+
+
+NULL_TIMER = NullTimer()
+
+
+def get_peak_rss_mb():
+    """
+    :return: peak resident set size of this process and of its terminated child processes (the workers), in MB,
+             None without the resource module
+    """
+    if resource is None:
+        return {'self': None, 'children': None}
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 << 20 if os.uname().sysname == 'Darwin' else 1 << 10
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    }
+
+
+def write_metrics(path, record):
+    """
+    Write a metrics record as json, or append it as one line if path ends with .jsonl
+    """
+    record = dict(record, timestamp=datetime.datetime.now().isoformat())
+    if path.endswith('.jsonl'):
+        with open(path, 'a') as fw:
+            fw.write(json.dumps(record) + '\n')
+    else:
+        with open(path, 'w') as fw:
+            json.dump(record, fw, indent=2)
@@ -0,0 +1,17 @@
+from collections import deque
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """
+    Ordered pool.imap that reads at most max_pending items of the iterable ahead of the consumer.
+    pool.imap feeds all its input to the task queue as fast as it can, which holds a whole file in memory
+    when the consumer (e.g. writing the results) is slower than the workers.
+    :return: generator of func(item) in the order of the iterable
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,196 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from utils.evaluate import load_references, check_present_keyphrases, ReferenceDocument, SourcePresenceIndex
+
+CACHE_VERSION = 1
+ARRAY_NAMES = ['src_ids', 'src_offsets', 'trg_ids', 'trg_offsets', 'doc_trg_offsets', 'trg_is_present']
+
+
+def compute_content_hash(src_dir):
+    """
+    sha1 of {src_dir}/test.source and {src_dir}/test.target, the cache is invalidated when either changes
+    """
+    sha1 = hashlib.sha1()
+    for filename in ['test.source', 'test.target']:
+        with open(os.path.join(src_dir, filename), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def get_file_stamp(src_dir):
+    """
+    :return: size and modification time of {src_dir}/test.source and {src_dir}/test.target
+    """
+    stamp = []
+    for filename in ['test.source', 'test.target']:
+        stat = os.stat(os.path.join(src_dir, filename))
+        stamp.append([stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def get_stamp_path(src_dir, cache_dir):
+    src_dir_hash = hashlib.sha1(os.path.abspath(src_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'stamp.{}.json'.format(src_dir_hash))
+
+
+def get_content_hash(src_dir, cache_dir):
+    """
+    compute_content_hash(src_dir), recomputed only when the size or modification time of the files changed
+    since the last call, the hash and the file stamp are kept in cache_dir
+    """
+    stamp = get_file_stamp(src_dir)
+    stamp_path = get_stamp_path(src_dir, cache_dir)
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            recorded = json.load(f)
+        if recorded['stamp'] == stamp:
+            return recorded['content_hash']
+    content_hash = compute_content_hash(src_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = stamp_path + '.tmp'
+    with open(tmp_path, 'w') as fw:
+        json.dump({'src_dir': os.path.abspath(src_dir), 'stamp': stamp, 'content_hash': content_hash}, fw)
+    os.replace(tmp_path, stamp_path)
+    return content_hash
+
+
+def get_cache_path(src_dir, cache_dir):
+    return os.path.join(cache_dir, '{}.v{}'.format(get_content_hash(src_dir, cache_dir), CACHE_VERSION))
+
+
+def build_reference_cache(src_dir, cache_path):
+    """
+    Write the stemmed references of {src_dir}/test.source and test.target as .npy arrays:
+        src_ids[src_offsets[i]:src_offsets[i + 1]]             stemmed source token ids of document i
+        doc_trg_offsets[i]:doc_trg_offsets[i + 1]              unique target indices of document i
+        trg_ids[trg_offsets[j]:trg_offsets[j + 1]]             stemmed token ids of unique target j
+        trg_is_present[j]                                      whether unique target j is present in the source
+    and vocab.json, the stemmed words in id order.
+    """
+    references = load_references(src_dir, build_presence_index=False)
+    word2id = {}
+
+    def encode(word_list):
+        word_ids = []
+        for w in word_list:
+            word_id = word2id.get(w)
+            if word_id is None:
+                word_id = len(word2id)
+                word2id[w] = word_id
+            word_ids.append(word_id)
+        return word_ids
+
+    src_ids, src_offsets = [], [0]
+    trg_ids, trg_offsets, doc_trg_offsets, trg_is_present = [], [0], [0], []
+    for reference in references:
+        src_ids += encode(reference.stemmed_src_token_list)
+        src_offsets.append(len(src_ids))
+        trg_is_present += check_present_keyphrases(reference.stemmed_src_token_list,
+                                                   reference.unique_stemmed_trg_token_2dlist).tolist()
+        for trg_word_list in reference.unique_stemmed_trg_token_2dlist:
+            trg_ids += encode(trg_word_list)
+            trg_offsets.append(len(trg_ids))
+        doc_trg_offsets.append(len(trg_offsets) - 1)
+
+    arrays = {
+        'src_ids': np.array(src_ids, dtype=np.int32),
+        'src_offsets': np.array(src_offsets, dtype=np.int64),
+        'trg_ids': np.array(trg_ids, dtype=np.int32),
+        'trg_offsets': np.array(trg_offsets, dtype=np.int64),
+        'doc_trg_offsets': np.array(doc_trg_offsets, dtype=np.int64),
+        'trg_is_present': np.array(trg_is_present, dtype=bool)
+    }
+    # write to a temporary directory first, so an interrupted build never leaves a partial cache behind
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_path, '{}.npy'.format(name)), arrays[name])
+    with open(os.path.join(tmp_path, 'vocab.json'), 'w', encoding='utf-8') as fw:
+        json.dump(list(word2id), fw)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fw:
+        json.dump({'src_dir': os.path.abspath(src_dir), 'num_documents': len(references),
+                   'version': CACHE_VERSION}, fw)
+    os.rename(tmp_path, cache_path)
+    return cache_path
+
+
+class CachedReferences(object):
+    """
+    Read-only sequence of ReferenceDocument backed by the memory-mapped arrays of a reference cache.
+    The text files are never read. A document is decoded (and its source indexed) at its first access,
+    and the ReferenceDocument is kept, so later passes over the references do no per-document work.
+    """
+
+    def __init__(self, cache_path, build_presence_index=True):
+        self.cache_path = cache_path
+        self.build_presence_index = build_presence_index
+        with open(os.path.join(cache_path, 'vocab.json'), encoding='utf-8') as f:
+            self.id2word = json.load(f)
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(cache_path, '{}.npy'.format(name)), mmap_mode='r'))
+        self.documents = [None] * (len(self.src_offsets) - 1)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getitem__(self, idx):
+        document = self.documents[idx]
+        if document is None:
+            idx = range(len(self))[idx]
+            document = self.documents[idx] = self.decode(idx)
+        return document
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def decode(self, idx):
+        id2word = self.id2word
+        src_start, src_end = self.src_offsets[idx], self.src_offsets[idx + 1]
+        stemmed_src_token_list = [id2word[i] for i in self.src_ids[src_start:src_end].tolist()]
+        trg_start, trg_end = self.doc_trg_offsets[idx], self.doc_trg_offsets[idx + 1]
+        unique_stemmed_trg_token_2dlist = [
+            [id2word[i] for i in self.trg_ids[self.trg_offsets[j]:self.trg_offsets[j + 1]].tolist()]
+            for j in range(trg_start, trg_end)
+        ]
+        presence_index = SourcePresenceIndex(stemmed_src_token_list) if self.build_presence_index else None
+        return ReferenceDocument(stemmed_src_token_list, unique_stemmed_trg_token_2dlist, presence_index,
+                                 is_present_trg_mask=np.array(self.trg_is_present[trg_start:trg_end]))
+
+
+def get_references(src_dir, cache_dir, build_presence_index=True):
+    """
+    Load the references of src_dir from cache_dir, building the cache first if the data changed
+    """
+    cache_path = get_cache_path(src_dir, cache_dir)
+    if not os.path.exists(cache_path):
+        build_reference_cache(src_dir, cache_path)
+    return CachedReferences(cache_path, build_presence_index=build_presence_index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the reference caches of the benchmark test sets')
+    parser.add_argument('--src_dirs', nargs='+', required=True,
+                        help="Directories with test.source and test.target, e.g. data/scikp/kp20k/fairseq")
+    parser.add_argument('--cache_dir', type=str, required=True, help="Directory of the reference caches")
+    args = parser.parse_args()
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    for src_dir in args.src_dirs:
+        cache_path = get_cache_path(src_dir, args.cache_dir)
+        if os.path.exists(cache_path):
+            print('{}: up to date ({})'.format(src_dir, cache_path))
+        else:
+            build_reference_cache(src_dir, cache_path)
+            print('{}: built {}'.format(src_dir, cache_path))
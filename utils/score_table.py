@@ -0,0 +1,205 @@
+import numpy as np
+
+TAGS = ('all', 'present', 'absent')
+SCORE_FIELDS = ('precision', 'recall', 'f1_score')
+RANKING_FIELDS = ('AP', 'NDCG', 'AlphaNDCG')
+COUNT_FIELDS = ('num_matches', 'num_predictions', 'num_targets')
+KEYPHRASE_FIELDS = ('num_targets', 'num_predictions')
+# 'M' and 'G' are resolved per document, to #predictions and max(#predictions, #targets)
+K_SENTINELS = {'M': -1, 'G': -2}
+
+
+class ScoreTable(object):
+    """
+    NumPy-backed per-document scores, one row per document:
+        scores[doc, tag, k, score_fields]          float64, SCORE_FIELDS (+ RANKING_FIELDS if ranking)
+        counts[doc, tag, k, COUNT_FIELDS]          int64
+        num_keyphrases[doc, tag, KEYPHRASE_FIELDS] int64
+        num_matches[doc, tag, k]                   int32
+        f1_scores[doc, tag, k]                     float32
+    Rows are preallocated and the capacity doubles when it runs out.
+    With keep_rows=False the score rows are folded into running totals whenever the buffer is full,
+    only num_keyphrases (needed for the MAE) and the compact match vectors (num_matches, f1_scores)
+    grow with the number of documents.
+    """
+
+    def __init__(self, k_list, capacity=1024, keep_rows=True, ranking=False):
+        self.k_list = list(k_list)
+        self.keep_rows = keep_rows
+        self.ranking = ranking
+        self.k_array = np.array([K_SENTINELS.get(topk, topk) for topk in self.k_list], dtype=np.int64)
+        self.score_fields = SCORE_FIELDS + (RANKING_FIELDS if ranking else ())
+        self.num_rows = 0
+        self.num_documents = 0
+        num_tags, num_ks = len(TAGS), len(self.k_list)
+        self.scores = np.zeros((capacity, num_tags, num_ks, len(self.score_fields)), dtype=np.float64)
+        self.counts = np.zeros((capacity, num_tags, num_ks, len(COUNT_FIELDS)), dtype=np.int64)
+        self.num_keyphrases = np.zeros((capacity, num_tags, len(KEYPHRASE_FIELDS)), dtype=np.int64)
+        self.num_matches = np.zeros((capacity, num_tags, num_ks), dtype=np.int32)
+        self.f1_scores = np.zeros((capacity, num_tags, num_ks), dtype=np.float32)
+        # totals of the rows folded so far (keep_rows=False)
+        self.folded_scores = np.zeros((num_tags, num_ks, len(self.score_fields)), dtype=np.float64)
+        self.folded_counts = np.zeros((num_tags, num_ks, len(COUNT_FIELDS)), dtype=np.int64)
+
+    def reserve(self, num_new_rows):
+        """
+        Make room for num_new_rows more documents, folding the buffer or doubling the capacity
+        """
+        if self.num_rows + num_new_rows > self.scores.shape[0] and not self.keep_rows:
+            self.fold()
+        capacity = max(self.scores.shape[0], 1)
+        while self.num_rows + num_new_rows > capacity:
+            capacity *= 2
+        if capacity > self.scores.shape[0]:
+            self.scores = _grow(self.scores, capacity)
+            self.counts = _grow(self.counts, capacity)
+        capacity = max(self.num_keyphrases.shape[0], 1)
+        while self.num_documents + num_new_rows > capacity:
+            capacity *= 2
+        if capacity > self.num_keyphrases.shape[0]:
+            self.num_keyphrases = _grow(self.num_keyphrases, capacity)
+            self.num_matches = _grow(self.num_matches, capacity)
+            self.f1_scores = _grow(self.f1_scores, capacity)
+
+    def add_row(self):
+        """
+        :return: index of the row of a new document
+        """
+        self.reserve(1)
+        row = self.num_rows
+        self.num_rows += 1
+        self.num_documents += 1
+        return row
+
+    def set_scores(self, row, tag, precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks,
+                   num_targets, num_predictions):
+        tag_idx = TAGS.index(tag)
+        scores = self.scores[row, tag_idx]
+        scores[:, 0] = precision_ks
+        scores[:, 1] = recall_ks
+        scores[:, 2] = f1_ks
+        counts = self.counts[row, tag_idx]
+        counts[:, 0] = num_matches_ks
+        counts[:, 1] = num_predictions_ks
+        counts[:, 2] = num_targets
+        document_idx = self.num_documents - self.num_rows + row
+        self.num_keyphrases[document_idx, tag_idx] = (num_targets, num_predictions)
+        self.num_matches[document_idx, tag_idx] = num_matches_ks
+        self.f1_scores[document_idx, tag_idx] = f1_ks
+
+    def set_ranking_scores(self, row, tag, ap_ks, ndcg_ks, alpha_ndcg_ks):
+        scores = self.scores[row, TAGS.index(tag)]
+        scores[:, 3] = ap_ks
+        scores[:, 4] = ndcg_ks
+        scores[:, 5] = alpha_ndcg_ks
+
+    def fold(self):
+        """
+        Add the buffered rows to the running totals and empty the buffer
+        """
+        self.folded_scores, self.folded_counts = self.totals()
+        self.num_rows = 0
+
+    def totals(self):
+        """
+        Column sums over all documents.
+        The rows are added one after another (cumsum, no pairwise summation), the same as sum() over a list.
+        :return: scores totals [tag, k, score_fields], counts totals [tag, k, COUNT_FIELDS]
+        """
+        scores = np.concatenate([self.folded_scores[None], self.scores[:self.num_rows]])
+        counts = np.concatenate([self.folded_counts[None], self.counts[:self.num_rows]])
+        return np.cumsum(scores, axis=0)[-1], counts.sum(axis=0)
+
+    def get_num_keyphrases(self, tag):
+        """
+        :return: per-document number of targets and number of predictions of the tag
+        """
+        num_keyphrases = self.num_keyphrases[:self.num_documents, TAGS.index(tag)]
+        return num_keyphrases[:, 0], num_keyphrases[:, 1]
+
+    def merge(self, other):
+        """
+        Append the rows of a table that kept all its rows (e.g. the table of a worker chunk)
+        """
+        assert other.keep_rows and other.k_list == self.k_list and other.ranking == self.ranking
+        num_new_rows = other.num_rows
+        self.reserve(num_new_rows)
+        self.scores[self.num_rows:self.num_rows + num_new_rows] = other.scores[:num_new_rows]
+        self.counts[self.num_rows:self.num_rows + num_new_rows] = other.counts[:num_new_rows]
+        self.num_keyphrases[self.num_documents:self.num_documents + num_new_rows] = \
+            other.num_keyphrases[:num_new_rows]
+        self.num_matches[self.num_documents:self.num_documents + num_new_rows] = other.num_matches[:num_new_rows]
+        self.f1_scores[self.num_documents:self.num_documents + num_new_rows] = other.f1_scores[:num_new_rows]
+        self.num_rows += num_new_rows
+        self.num_documents += num_new_rows
+        return self
+
+    def reorder(self, order):
+        """
+        Permute the documents of a table that kept all its rows, e.g. scored in the order they were generated
+        :param order: row index of every document in the new order, e.g. np.argsort of their document ids
+        """
+        assert self.keep_rows and len(order) == self.num_rows == self.num_documents
+        num_rows = self.num_rows
+        for name in ('scores', 'counts', 'num_keyphrases', 'num_matches', 'f1_scores'):
+            array = getattr(self, name)
+            array[:num_rows] = array[:num_rows][order]
+        return self
+
+    def save(self, path):
+        assert self.keep_rows, "only tables that keep their rows can be saved"
+        np.savez(path, k_list=np.array([str(topk) for topk in self.k_list]), tags=np.array(TAGS),
+                 score_fields=np.array(self.score_fields), count_fields=np.array(COUNT_FIELDS),
+                 scores=self.scores[:self.num_rows], counts=self.counts[:self.num_rows],
+                 num_keyphrases=self.num_keyphrases[:self.num_documents])
+
+    def save_match_vectors(self, path):
+        """
+        Write the compact per-document match vectors as a .npy structured array, one record per document
+        with the fields hits@{k}_{tag}, f1@{k}_{tag}, num_targets_{tag} and num_predictions_{tag}.
+        The file can be memory-mapped, see load_match_vectors().
+        """
+        fields = []
+        for tag in TAGS:
+            fields += [('hits@{}_{}'.format(topk, tag), np.int32) for topk in self.k_list]
+            fields += [('f1@{}_{}'.format(topk, tag), np.float32) for topk in self.k_list]
+            fields += [('num_targets_{}'.format(tag), np.int32), ('num_predictions_{}'.format(tag), np.int32)]
+        match_vectors = np.zeros(self.num_documents, dtype=fields)
+        for tag_idx, tag in enumerate(TAGS):
+            for k_idx, topk in enumerate(self.k_list):
+                match_vectors['hits@{}_{}'.format(topk, tag)] = self.num_matches[:self.num_documents, tag_idx, k_idx]
+                match_vectors['f1@{}_{}'.format(topk, tag)] = self.f1_scores[:self.num_documents, tag_idx, k_idx]
+            match_vectors['num_targets_{}'.format(tag)] = self.num_keyphrases[:self.num_documents, tag_idx, 0]
+            match_vectors['num_predictions_{}'.format(tag)] = self.num_keyphrases[:self.num_documents, tag_idx, 1]
+        np.save(path, match_vectors)
+
+
+def load_score_table(path):
+    """
+    Read a table written by ScoreTable.save()
+    """
+    with np.load(path) as data:
+        k_list = [topk if topk in K_SENTINELS else int(topk) for topk in data['k_list'].tolist()]
+        score_table = ScoreTable(k_list, capacity=0,
+                                 ranking=len(data['score_fields']) > len(SCORE_FIELDS))
+        score_table.scores = data['scores']
+        score_table.counts = data['counts']
+        score_table.num_keyphrases = data['num_keyphrases']
+    # the match vectors are not part of the .npz, they are recovered from the rows
+    score_table.num_matches = score_table.counts[:, :, :, 0].astype(np.int32)
+    score_table.f1_scores = score_table.scores[:, :, :, 2].astype(np.float32)
+    score_table.num_rows = score_table.num_documents = score_table.scores.shape[0]
+    return score_table
+
+
+def load_match_vectors(path):
+    """
+    Memory-map the match vectors written by ScoreTable.save_match_vectors()
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def _grow(array, capacity):
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
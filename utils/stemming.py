@@ -0,0 +1,127 @@
+import os
+import json
+from nltk.stem.porter import PorterStemmer
+
+DEFAULT_CACHE_SIZE = 1 << 20
+
+
+class CachedStemmer(object):
+    """
+    Porter stemmer memoized on the lowercased, stripped token.
+    The cache is a bounded dict, the oldest entries are evicted first once it is full.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.stemmer = PorterStemmer()
+        self.max_size = max_size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _stem_and_cache(self, key):
+        stemmed = self.stemmer.stem(key)
+        if len(self.cache) >= self.max_size:
+            del self.cache[next(iter(self.cache))]
+        self.cache[key] = stemmed
+        return stemmed
+
+    def stem(self, word):
+        key = word.strip().lower()
+        stemmed = self.cache.get(key)
+        if stemmed is None:
+            self.misses += 1
+            return self._stem_and_cache(key)
+        self.hits += 1
+        return stemmed
+
+    def stem_tokens(self, words):
+        """
+        Stem a list of tokens, every distinct token is looked up (and stemmed) only once
+        :param words: a list of tokens
+        :return: a list of stemmed tokens
+        """
+        keys = [w.strip().lower() for w in words]
+        stems = dict.fromkeys(keys)
+        num_misses = 0
+        for key in stems:
+            stemmed = self.cache.get(key)
+            if stemmed is None:
+                num_misses += 1
+                stemmed = self._stem_and_cache(key)
+            stems[key] = stemmed
+        self.misses += num_misses
+        self.hits += len(keys) - num_misses
+        return [stems[key] for key in keys]
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self):
+        num_lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'max_size': self.max_size,
+            'hit_rate': self.hits / num_lookups if num_lookups > 0 else 0.0
+        }
+
+    def load(self, path):
+        """
+        Warm-start the cache from a stem table written by save()
+        :return: number of entries added to the cache, at most up to max_size
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, encoding='utf-8') as f:
+            table = json.load(f)
+        num_loaded = 0
+        for key, stemmed in table.items():
+            if len(self.cache) >= self.max_size:
+                break
+            if key not in self.cache:
+                self.cache[key] = stemmed
+                num_loaded += 1
+        return num_loaded
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as fw:
+            json.dump(self.cache, fw)
+
+
+# process-wide instance, every module that stems goes through it
+_stemmer = CachedStemmer()
+
+
+def stem(word):
+    return _stemmer.stem(word)
+
+
+def stem_tokens(words):
+    return _stemmer.stem_tokens(words)
+
+
+def stem_word_list(word_list):
+    return _stemmer.stem_tokens(word_list)
+
+
+def stem_text(text):
+    return ' '.join(_stemmer.stem_tokens(text.split()))
+
+
+def cache_info():
+    return _stemmer.cache_info()
+
+
+def clear_cache():
+    _stemmer.clear()
+
+
+def load_stem_table(path):
+    return _stemmer.load(path)
+
+
+def save_stem_table(path):
+    _stemmer.save(path)
@@ -0,0 +1,137 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import random
+import argparse
+from utils.constants import KP_SEP, TITLE_SEP, DIGIT, UNK_WORD
+
+# inflections, so that the stemmer maps several surface words to one stem
+SUFFIXES = ['', '', '', 's', 'ing', 'ed', 'ation', 'al', 'er', 'ly']
+CONSONANTS = 'bcdfghklmnprstvz'
+VOWELS = 'aeiou'
+
+
+def make_vocabulary(vocab_size, rng):
+    """
+    Pronounceable pseudo words, deterministic given the rng
+    """
+    vocabulary = set()
+    while len(vocabulary) < vocab_size:
+        num_syllables = rng.choice([1, 2, 2, 3, 3, 4])
+        stem = ''.join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(num_syllables))
+        vocabulary.add(stem + rng.choice(SUFFIXES))
+    # the position in the list is the Zipf rank
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    return vocabulary
+
+
+class SyntheticCorpus(object):
+    """
+    Deterministic KP20k-shaped documents: a title and an abstract of Zipf-distributed words, about five
+    keyphrases of which roughly 60% appear in the source, and a list of predictions per document that mixes
+    copied targets, source spans, inflected variants, invalid and duplicated phrases, like beam search output.
+    """
+
+    def __init__(self, num_documents, num_predictions=200, seed=0, vocab_size=20000, title_length=10,
+                 abstract_length=170, num_targets=5.3, present_ratio=0.6):
+        self.num_documents = num_documents
+        self.num_predictions = num_predictions
+        self.seed = seed
+        self.title_length = title_length
+        self.abstract_length = abstract_length
+        self.num_targets = num_targets
+        self.present_ratio = present_ratio
+        rng = random.Random(seed)
+        self.vocabulary = make_vocabulary(vocab_size, rng) + [DIGIT]
+        self.cum_weights = []
+        total = 0.0
+        for rank in range(len(self.vocabulary)):
+            total += 1.0 / (rank + 1)
+            self.cum_weights.append(total)
+
+    def sample_words(self, rng, num_words):
+        return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=num_words)
+
+    def sample_span(self, rng, tokens):
+        length = min(rng.choice([1, 2, 2, 2, 3, 3, 4]), len(tokens))
+        start = rng.randrange(len(tokens) - length + 1)
+        return tokens[start:start + length]
+
+    def inflect(self, rng, phrase_words):
+        idx = rng.randrange(len(phrase_words))
+        return phrase_words[:idx] + [phrase_words[idx] + rng.choice(SUFFIXES[3:])] + phrase_words[idx + 1:]
+
+    def generate_document(self, doc_idx):
+        """
+        :return: (source, target line, hypothesis line), keyphrases separated by ' ; '
+        """
+        rng = random.Random('{}-{}'.format(self.seed, doc_idx))
+        title = self.sample_words(rng, max(1, int(rng.gauss(self.title_length, 3))))
+        abstract = self.sample_words(rng, max(10, int(rng.gauss(self.abstract_length, 60))))
+        src_tokens = title + abstract
+
+        targets = []
+        for _ in range(min(int(rng.expovariate(1.0 / self.num_targets)) + 1, 30)):
+            if rng.random() < self.present_ratio:
+                targets.append(self.sample_span(rng, src_tokens))
+            else:
+                targets.append(self.sample_words(rng, rng.choice([1, 2, 2, 3])))
+
+        predictions = []
+        while len(predictions) < self.num_predictions:
+            kind = rng.random()
+            if kind < 0.15:
+                predictions.append(list(rng.choice(targets)))
+            elif kind < 0.25:
+                predictions.append(self.inflect(rng, rng.choice(targets)))
+            elif kind < 0.55:
+                predictions.append(self.sample_span(rng, src_tokens))
+            elif kind < 0.80:
+                predictions.append(self.sample_words(rng, rng.choice([1, 2, 2, 3, 4])))
+            elif kind < 0.83:
+                predictions.append(self.sample_words(rng, 2) + [UNK_WORD])
+            elif predictions:
+                # beam search repeats earlier predictions
+                predictions.append(list(rng.choice(predictions)))
+
+        source = ' '.join(title) + ' {} '.format(TITLE_SEP) + ' '.join(abstract)
+        target_line = ' {} '.format(KP_SEP).join(' '.join(words) for words in targets)
+        hypothesis_line = ' {} '.format(KP_SEP).join(' '.join(words) for words in predictions)
+        return source, target_line, hypothesis_line
+
+    def __len__(self):
+        return self.num_documents
+
+    def __iter__(self):
+        for doc_idx in range(self.num_documents):
+            yield self.generate_document(doc_idx)
+
+
+def write_corpus(corpus, out_dir, file_prefix='synthetic'):
+    """
+    Write {out_dir}/test.source, {out_dir}/test.target and {out_dir}/{file_prefix}_hypotheses.txt,
+    the layout read by evaluate.py --src_dir
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'test.source'), 'w') as fs, \
+            open(os.path.join(out_dir, 'test.target'), 'w') as ft, \
+            open(os.path.join(out_dir, '{}_hypotheses.txt'.format(file_prefix)), 'w') as fh:
+        for source, target_line, hypothesis_line in corpus:
+            fs.write(source + '\n')
+            ft.write(target_line + '\n')
+            fh.write(hypothesis_line + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a deterministic KP20k-shaped synthetic test set')
+    parser.add_argument('--out_dir', type=str, required=True, help="Output directory")
+    parser.add_argument('--num_documents', type=int, default=20000, help="Number of documents")
+    parser.add_argument('--num_predictions', type=int, default=200, help="Number of predictions per document")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--file_prefix', type=str, default='synthetic', help="Prefix of the hypothesis file")
+    args = parser.parse_args()
+
+    write_corpus(SyntheticCorpus(args.num_documents, args.num_predictions, args.seed), args.out_dir, args.file_prefix)